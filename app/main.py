@@ -1,20 +1,24 @@
 import os
+import time
 import asyncio
+import inspect
+from contextlib import asynccontextmanager
 from typing import List, Optional
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
-from vllm import LLM, SamplingParams
+from vllm import AsyncEngineArgs, AsyncLLMEngine, RequestOutput, SamplingParams
 from langfuse import Langfuse
 from langfuse.model import CreateTrace
+from context_budget import trim_messages
+from client_disconnect import CLIENT_CLOSED_REQUEST, ClientDisconnected, run_until_disconnect
+from prefix_cache import PrefixCacheEstimator, cached_tokens_from_usage, set_cached_tokens, token_blocks
 import logging
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Initialize FastAPI app
-app = FastAPI(title="vLLM API with Langfuse", version="1.0.0")
-
 # Initialize Langfuse client
 langfuse = Langfuse(
     public_key=os.getenv("LANGFUSE_PUBLIC_KEY", "default-public-key"),
@@ -26,14 +30,109 @@ langfuse = Langfuse(
 MODEL_NAME = os.getenv("MODEL_NAME", "Qwen/Qwen2.5-7B-Instruct")
 GPU_MEMORY_UTILIZATION = float(os.getenv("GPU_MEMORY_UTILIZATION", "0.7"))
 PROJECT_NAME = os.getenv("PROJECT_NAME", "default-project")
+# Opt-in: trim history to this many prompt tokens (0 = off); requests may set "context_budget"
+CONTEXT_BUDGET_TOKENS = int(os.getenv("CONTEXT_BUDGET_TOKENS", "0"))
+# <|im_start|>{role}\n ... <|im_end|>\n around every message
+TOKENS_PER_MESSAGE = 5
+# Comma-separated prompt lengths (tokens) run once before /readyz reports ready; empty = no warm-up
+WARMUP_PROMPT_LENGTHS = [int(n) for n in os.getenv("WARMUP_PROMPT_LENGTHS", "").split(",") if n.strip()]
+WARMUP_MAX_TOKENS = int(os.getenv("WARMUP_MAX_TOKENS", "16"))
+# Opt-in: reuse KV cache across requests sharing a prefix (long system prompts)
+ENABLE_PREFIX_CACHING = os.getenv("ENABLE_PREFIX_CACHING", "false").lower() == "true"
 
-# Initialize LLM
-logger.info(f"Loading model: {MODEL_NAME}")
-llm = LLM(
-    model=MODEL_NAME,
-    gpu_memory_utilization=GPU_MEMORY_UTILIZATION,
-    trust_remote_code=True
-)
+# Loaded by a background task started in lifespan; requests get 503 until ready
+llm = None
+tokenizer = None
+# Estimates cached prompt tokens when the engine doesn't report them (vLLM < 0.6); trace metadata only
+prefix_cache = None
+# cached_tokens: "engine" (reported in usage), "estimate" (trace metadata only) or "disabled"
+model_state = {"phase": "starting", "error": None, "timings": {}, "cached_tokens": None}
+
+async def warm_up(engine, timings):
+    """Chạy một request cho mỗi prompt length trong WARMUP_PROMPT_LENGTHS (CUDA graphs, allocator, ...)"""
+    max_prompt_len = engine.engine.model_config.max_model_len - WARMUP_MAX_TOKENS
+    filler = tokenizer.encode("The quick brown fox jumps over the lazy dog. " * 16, add_special_tokens=False)
+    sampling_params = SamplingParams(max_tokens=WARMUP_MAX_TOKENS, temperature=0, ignore_eos=True)
+    for length in WARMUP_PROMPT_LENGTHS:
+        length = min(length, max_prompt_len)
+        token_ids = (filler * (length // len(filler) + 1))[:length]
+        started = time.monotonic()
+        async for _ in engine.generate({"prompt_token_ids": token_ids}, sampling_params, f"warmup-{length}"):
+            pass
+        timings[f"warmup_{length}"] = round(time.monotonic() - started, 3)
+        logger.info(f"Warm-up with {length} prompt tokens took {timings[f'warmup_{length}']:.2f}s")
+
+def load_engine():
+    """Load model weights và KV cache (blocking, chạy trong thread)"""
+    logger.info(f"Loading model: {MODEL_NAME}")
+    return AsyncLLMEngine.from_engine_args(AsyncEngineArgs(
+        model=MODEL_NAME,
+        gpu_memory_utilization=GPU_MEMORY_UTILIZATION,
+        trust_remote_code=True,
+        enable_prefix_caching=ENABLE_PREFIX_CACHING,
+        disable_log_requests=True
+    ))
+
+async def load_model_task():
+    """Load engine rồi warm-up; ghi thời gian từng phase"""
+    global llm, tokenizer, prefix_cache
+    timings = model_state["timings"]
+    started = time.monotonic()
+    try:
+        model_state["phase"] = "loading"
+        engine = await asyncio.to_thread(load_engine)
+        tokenizer = engine.engine.get_tokenizer()
+        if not ENABLE_PREFIX_CACHING:
+            model_state["cached_tokens"] = "disabled"
+        elif "num_cached_tokens" in inspect.signature(RequestOutput.__init__).parameters:
+            model_state["cached_tokens"] = "engine"
+        else:
+            cache_config = engine.engine.cache_config
+            prefix_cache = PrefixCacheEstimator(
+                cache_config.num_gpu_blocks * cache_config.block_size, cache_config.block_size
+            )
+            model_state["cached_tokens"] = "estimate"
+        timings["load"] = round(time.monotonic() - started, 3)
+        logger.info(f"Model loaded in {timings['load']:.2f}s")
+
+        if WARMUP_PROMPT_LENGTHS:
+            model_state["phase"] = "warming_up"
+            warmup_started = time.monotonic()
+            await warm_up(engine, timings)
+            timings["warmup"] = round(time.monotonic() - warmup_started, 3)
+
+        timings["total"] = round(time.monotonic() - started, 3)
+        llm = engine
+        model_state["phase"] = "ready"
+        logger.info(f"Model ready in {timings['total']:.2f}s: {timings}")
+    except Exception as e:
+        model_state["phase"] = "failed"
+        model_state["error"] = str(e)
+        logger.exception(f"Failed to load model {MODEL_NAME}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    logger.info(f"vLLM API server started with model: {MODEL_NAME}")
+    logger.info(f"GPU memory utilization: {GPU_MEMORY_UTILIZATION}")
+    logger.info(f"Project name: {PROJECT_NAME}")
+    # Serve /livez and /readyz while the model loads in the background
+    loader = asyncio.create_task(load_model_task())
+    yield
+    if not loader.done():
+        logger.warning("Shutting down before the model finished loading")
+
+# Initialize FastAPI app
+app = FastAPI(title="vLLM API with Langfuse", version="1.0.0", lifespan=lifespan)
+
+def require_llm():
+    """503 (kèm Retry-After) khi model đang load hoặc load lỗi"""
+    if llm is None:
+        raise HTTPException(
+            status_code=503,
+            detail=f"Model is not ready ({model_state['phase']})",
+            headers={"Retry-After": "5"}
+        )
+    return llm
 
 # Pydantic models
 class ChatMessage(BaseModel):
@@ -46,45 +145,164 @@ class ChatRequest(BaseModel):
     temperature: Optional[float] = 0.7
     top_p: Optional[float] = 0.9
     trace_id: Optional[str] = None
+    context_budget: Optional[int] = None
 
 class ChatResponse(BaseModel):
     response: str
     usage: dict
     trace_id: str
+    context: Optional[dict] = None
 
-@app.on_event("startup")
-async def startup_event():
-    logger.info(f"vLLM API server started with model: {MODEL_NAME}")
-    logger.info(f"GPU memory utilization: {GPU_MEMORY_UTILIZATION}")
-    logger.info(f"Project name: {PROJECT_NAME}")
+class BatchRequest(BaseModel):
+    requests: List[ChatRequest]
+    trace_id: Optional[str] = None
+
+class BatchResponse(BaseModel):
+    results: List[ChatResponse]
+    usage: dict
+    trace_id: str
+
+def format_chat_prompt(messages: List[ChatMessage]) -> str:
+    """Format messages for Qwen"""
+    formatted_prompt = ""
+    for message in messages:
+        if message.role == "user":
+            formatted_prompt += f"<|im_start|>user\n{message.content}<|im_end|>\n"
+        elif message.role == "assistant":
+            formatted_prompt += f"<|im_start|>assistant\n{message.content}<|im_end|>\n"
+
+    formatted_prompt += "<|im_start|>assistant\n"
+    return formatted_prompt
+
+def apply_context_budget(messages: List[ChatMessage], budget: Optional[int] = None):
+    """Keep the system prompt and the most recent turns within `budget` tokens.
+
+    Returns (messages, report); report is None when nothing was dropped.
+    """
+    budget = budget or CONTEXT_BUDGET_TOKENS
+    if not budget:
+        return messages, None
+
+    def count_tokens(message):
+        return len(tokenizer.encode(message["content"], add_special_tokens=False)) + TOKENS_PER_MESSAGE
+
+    kept, dropped_messages, dropped_tokens = trim_messages(
+        [msg.dict() for msg in messages], budget, count_tokens
+    )
+    if not dropped_messages:
+        return messages, None
+    return [ChatMessage(**msg) for msg in kept], {
+        "budget": budget,
+        "dropped_messages": dropped_messages,
+        "dropped_tokens": dropped_tokens
+    }
+
+def estimate_cached_tokens(output) -> Optional[int]:
+    """Simulated prefix-cache hit for trace metadata; never reported as usage"""
+    if prefix_cache is None or output is None:
+        return None
+    return prefix_cache.observe(token_blocks(output.prompt_token_ids, prefix_cache.block_size))
+
+def build_usage(output, prompt: str) -> dict:
+    """Usage from a vLLM RequestOutput (completion token_ids exclude the prompt).
+
+    `output` is None when the request was cancelled before producing a token.
+    prompt_tokens_details.cached_tokens (OpenAI format) is only set when the
+    engine reports it (vLLM 0.6+).
+    """
+    if output is None:
+        prompt_tokens = len(tokenizer.encode(prompt))
+        completion_tokens = 0
+    else:
+        prompt_tokens = len(output.prompt_token_ids)
+        completion_tokens = len(output.outputs[0].token_ids)
+    usage = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens
+    }
+    if output is not None and model_state["cached_tokens"] == "engine":
+        set_cached_tokens(usage, output.num_cached_tokens or 0)
+    return usage
+
+def output_text(output) -> str:
+    return output.outputs[0].text.strip() if output is not None else ""
+
+async def run_generations(prompts, sampling_params, http_request: Request):
+    """Chạy các prompts song song trên engine (continuous batching), abort tất cả khi client disconnect.
+
+    Returns (outputs, cancelled). Mỗi output là RequestOutput mới nhất của prompt
+    đó: kết quả cuối, hoặc phần đã sinh nếu bị hủy (None nếu chưa có token nào).
+    """
+    outputs = [None] * len(prompts)
+
+    async def consume(index, prompt, params):
+        # Cancelling this consumer makes AsyncLLMEngine abort the request
+        async for output in llm.generate(prompt, params, os.urandom(8).hex()):
+            outputs[index] = output
+
+    try:
+        await run_until_disconnect(
+            asyncio.gather(*(
+                consume(index, prompt, params)
+                for index, (prompt, params) in enumerate(zip(prompts, sampling_params))
+            )),
+            http_request
+        )
+        return outputs, False
+    except ClientDisconnected:
+        logger.info(f"Client disconnected, aborted {len(prompts)} engine request(s)")
+        return outputs, True
 
 @app.get("/")
 async def root():
     return {
         "message": "vLLM API with Langfuse Integration",
         "model": MODEL_NAME,
-        "project": PROJECT_NAME
+        "project": PROJECT_NAME,
+        "phase": model_state["phase"]
     }
 
+@app.get("/livez")
+async def liveness():
+    """Process còn sống; chỉ fail khi load model lỗi (cần restart)"""
+    failed = model_state["phase"] == "failed"
+    return JSONResponse(
+        {"status": "failed" if failed else "alive", "phase": model_state["phase"], "error": model_state["error"]},
+        status_code=503 if failed else 200
+    )
+
+@app.get("/readyz")
+async def readiness():
+    """Sẵn sàng nhận traffic: model đã load và warm-up xong"""
+    return JSONResponse(
+        {
+            "status": model_state["phase"],
+            "model": MODEL_NAME,
+            "timings": model_state["timings"],
+            "cached_tokens": model_state["cached_tokens"]
+        },
+        status_code=200 if llm is not None else 503
+    )
+
 @app.get("/health")
 async def health_check():
+    if llm is None:
+        return JSONResponse({"status": model_state["phase"], "model": MODEL_NAME}, status_code=503)
     return {"status": "healthy", "model": MODEL_NAME}
 
 @app.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
+async def chat(request: ChatRequest, http_request: Request):
+    require_llm()
     try:
         # Create trace if trace_id is provided
         trace_id = request.trace_id or f"{PROJECT_NAME}-{os.urandom(8).hex()}"
+
+        # Trim long histories to the context budget (opt-in)
+        messages, context_report = apply_context_budget(request.messages, request.context_budget)
         
         # Format messages for Qwen
-        formatted_prompt = ""
-        for message in request.messages:
-            if message.role == "user":
-                formatted_prompt += f"<|im_start|>user\n{message.content}<|im_end|>\n"
-            elif message.role == "assistant":
-                formatted_prompt += f"<|im_start|>assistant\n{message.content}<|im_end|>\n"
-        
-        formatted_prompt += "<|im_start|>assistant\n"
+        formatted_prompt = format_chat_prompt(messages)
 
         # Create sampling parameters
         sampling_params = SamplingParams(
@@ -93,29 +311,22 @@ async def chat(request: ChatRequest):
             top_p=request.top_p
         )
 
-        # Generate response
-        outputs = llm.generate([formatted_prompt], sampling_params)
-        response_text = outputs[0].outputs[0].text.strip()
+        # Generate response (aborted if the client disconnects)
+        outputs, cancelled = await run_generations([formatted_prompt], [sampling_params], http_request)
+        response_text = output_text(outputs[0])
 
         # Get usage information - separate prompt and completion tokens
-        # vLLM returns all token IDs including prompt and completion
-        # We need to count prompt tokens from the original prompt
-        prompt_tokens = len(llm.get_tokenizer().encode(formatted_prompt))
-        completion_tokens = len(outputs[0].outputs[0].token_ids) - prompt_tokens
-        
-        usage = {
-            "prompt_tokens": prompt_tokens,
-            "completion_tokens": completion_tokens,
-            "total_tokens": prompt_tokens + completion_tokens
-        }
+        usage = build_usage(outputs[0], formatted_prompt)
+        cached_estimate = estimate_cached_tokens(outputs[0])
 
         # Send trace to Langfuse
         try:
             langfuse.trace(
                 id=trace_id,
                 name=f"{PROJECT_NAME}-chat",
+                tags=["cancelled"] if cancelled else None,
                 input={
-                    "messages": [msg.dict() for msg in request.messages],
+                    "messages": [msg.dict() for msg in messages],
                     "max_tokens": request.max_tokens,
                     "temperature": request.temperature,
                     "top_p": request.top_p
@@ -127,25 +338,163 @@ async def chat(request: ChatRequest):
                 metadata={
                     "model": MODEL_NAME,
                     "project": PROJECT_NAME,
-                    "gpu_memory_utilization": GPU_MEMORY_UTILIZATION
+                    "gpu_memory_utilization": GPU_MEMORY_UTILIZATION,
+                    "context": context_report,
+                    "cancelled": cancelled,
+                    "cached_tokens_source": model_state["cached_tokens"],
+                    "cached_tokens_estimate": cached_estimate
                 }
             )
             langfuse.flush()
         except Exception as e:
             logger.warning(f"Failed to send trace to Langfuse: {e}")
 
+        if cancelled:
+            raise HTTPException(status_code=CLIENT_CLOSED_REQUEST, detail="Client closed request")
         return ChatResponse(
             response=response_text,
             usage=usage,
-            trace_id=trace_id
+            trace_id=trace_id,
+            context=context_report
         )
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in chat endpoint: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/v1/batch", response_model=BatchResponse)
+async def batch_chat(request: BatchRequest, http_request: Request):
+    """Run many chat requests in a single engine submission"""
+    require_llm()
+    try:
+        if not request.requests:
+            raise HTTPException(status_code=400, detail="requests must not be empty")
+
+        batch_trace_id = request.trace_id or f"{PROJECT_NAME}-batch-{os.urandom(8).hex()}"
+        trace_ids = [
+            item.trace_id or f"{PROJECT_NAME}-{os.urandom(8).hex()}"
+            for item in request.requests
+        ]
+
+        budgeted = [apply_context_budget(item.messages, item.context_budget) for item in request.requests]
+
+        # One prompt and one SamplingParams per item, submitted together so
+        # vLLM can schedule the whole batch with continuous batching
+        prompts = [format_chat_prompt(messages) for messages, _ in budgeted]
+        sampling_params = [
+            SamplingParams(
+                max_tokens=item.max_tokens,
+                temperature=item.temperature,
+                top_p=item.top_p
+            )
+            for item in request.requests
+        ]
+
+        outputs, cancelled = await run_generations(prompts, sampling_params, http_request)
+
+        results = []
+        total_prompt = 0
+        total_completion = 0
+        total_cached = 0
+        for item, trace_id, output, prompt, (messages, context_report) in zip(
+            request.requests, trace_ids, outputs, prompts, budgeted
+        ):
+            response_text = output_text(output)
+            usage = build_usage(output, prompt)
+            cached_estimate = estimate_cached_tokens(output)
+            # Items that finished before the disconnect are complete answers
+            item_cancelled = cancelled and (output is None or not output.finished)
+            total_prompt += usage["prompt_tokens"]
+            total_completion += usage["completion_tokens"]
+            total_cached += cached_tokens_from_usage(usage) or 0
+            results.append(ChatResponse(
+                response=response_text,
+                usage=usage,
+                trace_id=trace_id,
+                context=context_report
+            ))
+
+            try:
+                langfuse.trace(
+                    id=trace_id,
+                    name=f"{PROJECT_NAME}-chat",
+                    session_id=batch_trace_id,
+                    tags=["cancelled"] if item_cancelled else None,
+                    input={
+                        "messages": [msg.dict() for msg in messages],
+                        "max_tokens": item.max_tokens,
+                        "temperature": item.temperature,
+                        "top_p": item.top_p
+                    },
+                    output={
+                        "response": response_text,
+                        "usage": usage
+                    },
+                    metadata={
+                        "model": MODEL_NAME,
+                        "project": PROJECT_NAME,
+                        "gpu_memory_utilization": GPU_MEMORY_UTILIZATION,
+                        "batch_trace_id": batch_trace_id,
+                        "context": context_report,
+                        "cancelled": item_cancelled,
+                        "cached_tokens_source": model_state["cached_tokens"],
+                        "cached_tokens_estimate": cached_estimate
+                    }
+                )
+            except Exception as e:
+                logger.warning(f"Failed to send trace to Langfuse: {e}")
+
+        batch_usage = {
+            "prompt_tokens": total_prompt,
+            "completion_tokens": total_completion,
+            "total_tokens": total_prompt + total_completion
+        }
+        if model_state["cached_tokens"] == "engine":
+            set_cached_tokens(batch_usage, total_cached)
+
+        # Parent trace for the batch. Totals are stored under "batch_usage"
+        # rather than "usage" so the summary tools don't count them twice.
+        try:
+            langfuse.trace(
+                id=batch_trace_id,
+                name=f"{PROJECT_NAME}-batch",
+                session_id=batch_trace_id,
+                tags=["cancelled"] if cancelled else None,
+                input={"size": len(request.requests)},
+                output={
+                    "trace_ids": trace_ids,
+                    "batch_usage": batch_usage
+                },
+                metadata={
+                    "model": MODEL_NAME,
+                    "project": PROJECT_NAME,
+                    "gpu_memory_utilization": GPU_MEMORY_UTILIZATION,
+                    "cancelled": cancelled
+                }
+            )
+            langfuse.flush()
+        except Exception as e:
+            logger.warning(f"Failed to send trace to Langfuse: {e}")
+
+        if cancelled:
+            raise HTTPException(status_code=CLIENT_CLOSED_REQUEST, detail="Client closed request")
+        return BatchResponse(
+            results=results,
+            usage=batch_usage,
+            trace_id=batch_trace_id
+        )
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error in batch endpoint: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/generate")
-async def generate_text(prompt: str, max_tokens: int = 1024, temperature: float = 0.7):
+async def generate_text(http_request: Request, prompt: str, max_tokens: int = 1024, temperature: float = 0.7):
+    require_llm()
     try:
         # Create sampling parameters
         sampling_params = SamplingParams(
@@ -153,25 +502,22 @@ async def generate_text(prompt: str, max_tokens: int = 1024, temperature: float
             temperature=temperature
         )
 
-        # Generate response
-        outputs = llm.generate([prompt], sampling_params)
-        response_text = outputs[0].outputs[0].text.strip()
+        # Generate response (aborted if the client disconnects)
+        outputs, cancelled = await run_generations([prompt], [sampling_params], http_request)
+        if cancelled:
+            raise HTTPException(status_code=CLIENT_CLOSED_REQUEST, detail="Client closed request")
+        response_text = output_text(outputs[0])
 
         # Get usage information - separate prompt and completion tokens
-        prompt_tokens = len(llm.get_tokenizer().encode(prompt))
-        completion_tokens = len(outputs[0].outputs[0].token_ids) - prompt_tokens
-        
-        usage = {
-            "prompt_tokens": prompt_tokens,
-            "completion_tokens": completion_tokens,
-            "total_tokens": prompt_tokens + completion_tokens
-        }
+        usage = build_usage(outputs[0], prompt)
 
         return {
             "response": response_text,
             "usage": usage
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in generate endpoint: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Batch Runner - Chạy offline jobs từ file JSONL
+Đọc chat requests từ JSONL (mỗi dòng giống body của /chat), chạy qua vLLM
+in-process hoặc qua proxy/backend URL, ghi kết quả JSONL dần dần và lưu
+checkpoint để job bị ngắt có thể chạy tiếp từ chỗ đã dừng.
+
+Input line:  {"messages": [...], "max_tokens": 100, "temperature": 0.7, "trace_id": "..."}
+Output line: {"line": 0, "trace_id": "...", "response": "...", "usage": {...}, "error": null}
+"""
+
+import os
+import json
+import uuid
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import requests
+from requests.adapters import HTTPAdapter
+
+PROJECT_NAME = os.getenv("PROJECT_NAME", "default-project")
+MODEL_NAME = os.getenv("MODEL_NAME", "Qwen/Qwen2.5-7B-Instruct")
+
+def load_checkpoint(path):
+    """Đọc checkpoint (hoặc trạng thái ban đầu nếu chưa có)"""
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {
+        "lines_done": 0,
+        "input_offset": 0,
+        "output_offset": 0,
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "errors": 0,
+        "traces_uploaded": False
+    }
+
+def save_checkpoint(path, checkpoint):
+    """Ghi checkpoint atomically (write + rename)"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def read_chunks(input_file, chunk_size):
+    """Yield từng chunk [(line_bytes, request_or_error)] mà không đọc cả file vào memory"""
+    while True:
+        raw_lines = list(islice(input_file, chunk_size))
+        if not raw_lines:
+            return
+        chunk = []
+        for raw in raw_lines:
+            try:
+                item = json.loads(raw)
+                if not isinstance(item, dict) or "messages" not in item:
+                    raise ValueError("missing 'messages'")
+            except ValueError as e:
+                item = {"_error": f"invalid input line: {e}"}
+            chunk.append((len(raw), item))
+        yield chunk
+
+def make_trace_id(item):
+    return item.get("trace_id") or f"{PROJECT_NAME}-{uuid.uuid4().hex[:8]}"
+
+def error_result(trace_id, error):
+    return {"trace_id": trace_id, "response": None, "usage": None, "error": error}
+
+class LocalBackend:
+    """Chạy trực tiếp bằng vLLM LLM, mỗi chunk là một lần llm.generate"""
+
+    def __init__(self, model, gpu_memory_utilization):
+        from vllm import LLM, SamplingParams
+
+        self.SamplingParams = SamplingParams
+        self.llm = LLM(
+            model=model,
+            gpu_memory_utilization=gpu_memory_utilization,
+            trust_remote_code=True
+        )
+        self.tokenizer = self.llm.get_tokenizer()
+
+    def run(self, items):
+        results = [None] * len(items)
+        prompts = []
+        sampling_params = []
+        indexes = []
+        for i, item in enumerate(items):
+            if "_error" in item:
+                results[i] = error_result(None, item["_error"])
+                continue
+            prompts.append(self.tokenizer.apply_chat_template(
+                item["messages"], tokenize=False, add_generation_prompt=True
+            ))
+            sampling_params.append(self.SamplingParams(
+                max_tokens=item.get("max_tokens", 1024),
+                temperature=item.get("temperature", 0.7),
+                top_p=item.get("top_p", 0.9)
+            ))
+            indexes.append(i)
+
+        if prompts:
+            outputs = self.llm.generate(prompts, sampling_params, use_tqdm=False)
+            for i, output in zip(indexes, outputs):
+                prompt_tokens = len(output.prompt_token_ids)
+                completion_tokens = len(output.outputs[0].token_ids)
+                results[i] = {
+                    "trace_id": make_trace_id(items[i]),
+                    "response": output.outputs[0].text.strip(),
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": completion_tokens,
+                        "total_tokens": prompt_tokens + completion_tokens
+                    },
+                    "error": None
+                }
+        return results
+
+class HTTPBackend:
+    """Gửi requests tới proxy/backend với số request đồng thời giới hạn"""
+
+    def __init__(self, url, endpoint, concurrency, timeout):
+        self.url = url.rstrip("/") + endpoint
+        self.openai_format = endpoint.startswith("/v1/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def _post(self, item):
+        if "_error" in item:
+            return error_result(None, item["_error"])
+        trace_id = make_trace_id(item)
+        body = dict(item)
+        if self.openai_format:
+            body.setdefault("model", "qwen2.5-7b-it")
+        else:
+            body["trace_id"] = trace_id
+        try:
+            response = self.session.post(self.url, json=body, timeout=self.timeout)
+            if response.status_code != 200:
+                return error_result(trace_id, f"HTTP {response.status_code}: {response.text[:500]}")
+            result = response.json()
+        except Exception as e:
+            return error_result(trace_id, str(e))
+
+        if self.openai_format:
+            choices = result.get("choices") or [{}]
+            response_text = choices[0].get("message", {}).get("content", "")
+        else:
+            response_text = result.get("response", "")
+        return {
+            "trace_id": result.get("trace_id", trace_id),
+            "response": response_text,
+            "usage": result.get("usage", {}),
+            "error": None
+        }
+
+    def run(self, items):
+        # map() keeps input order, so results are written in the same order as the input
+        return list(self.executor.map(self._post, items))
+
+def upload_traces(output_path, flush_every=500):
+    """Đọc lại output file và gửi traces lên Langfuse theo lô"""
+    from langfuse import Langfuse
+
+    langfuse = Langfuse(
+        public_key=os.getenv("LANGFUSE_PUBLIC_KEY", "default-public-key"),
+        secret_key=os.getenv("LANGFUSE_SECRET_KEY", "default-secret-key"),
+        host=os.getenv("LANGFUSE_HOST", "http://langfuse:3000")
+    )
+
+    uploaded = 0
+    with open(output_path) as f:
+        for line in f:
+            result = json.loads(line)
+            if result.get("error"):
+                continue
+            langfuse.trace(
+                id=result["trace_id"],
+                name=f"{PROJECT_NAME}-batch-runner",
+                output={
+                    "response": result["response"],
+                    "usage": result["usage"]
+                },
+                metadata={
+                    "model": MODEL_NAME,
+                    "project": PROJECT_NAME,
+                    "line": result["line"]
+                }
+            )
+            uploaded += 1
+            # Flush periodically so the SDK queue never holds the whole job
+            if uploaded % flush_every == 0:
+                langfuse.flush()
+    langfuse.flush()
+    return uploaded
+
+def run_job(backend, input_path, output_path, checkpoint_path, chunk_size):
+    checkpoint = load_checkpoint(checkpoint_path)
+
+    if checkpoint["lines_done"]:
+        print(f"♻️  Resuming from line {checkpoint['lines_done']:,}")
+
+    with open(input_path, "rb") as input_file, open(output_path, "ab") as output_file:
+        input_file.seek(checkpoint["input_offset"])
+        # Drop results written after the last checkpoint (crash between write and save)
+        output_file.truncate(checkpoint["output_offset"])
+        output_file.seek(checkpoint["output_offset"])
+
+        for chunk in read_chunks(input_file, chunk_size):
+            items = [item for _, item in chunk]
+            results = backend.run(items)
+
+            for offset, result in enumerate(results):
+                result["line"] = checkpoint["lines_done"] + offset
+                if result["error"]:
+                    checkpoint["errors"] += 1
+                else:
+                    checkpoint["prompt_tokens"] += result["usage"].get("prompt_tokens", 0)
+                    checkpoint["completion_tokens"] += result["usage"].get("completion_tokens", 0)
+                output_file.write((json.dumps(result, ensure_ascii=False) + "\n").encode("utf-8"))
+            output_file.flush()
+            os.fsync(output_file.fileno())
+
+            checkpoint["lines_done"] += len(chunk)
+            checkpoint["input_offset"] += sum(size for size, _ in chunk)
+            checkpoint["output_offset"] = output_file.tell()
+            save_checkpoint(checkpoint_path, checkpoint)
+
+            print(f"✅ {checkpoint['lines_done']:,} lines done "
+                  f"(IN: {checkpoint['prompt_tokens']:,}, OUT: {checkpoint['completion_tokens']:,}, "
+                  f"errors: {checkpoint['errors']:,})")
+
+    return checkpoint
+
+def main():
+    parser = argparse.ArgumentParser(description='Batch Runner - Chạy offline jobs từ file JSONL')
+    parser.add_argument('input', help='Input JSONL file (một chat request mỗi dòng)')
+    parser.add_argument('output', help='Output JSONL file')
+    parser.add_argument('--checkpoint', help='Checkpoint file (mặc định: <output>.ckpt)')
+    parser.add_argument('--url', help='Proxy/backend URL; nếu bỏ trống thì chạy vLLM in-process')
+    parser.add_argument('--endpoint', default='/chat', help='Endpoint khi dùng --url (/chat hoặc /v1/chat/completions)')
+    parser.add_argument('--concurrency', type=int, default=8, help='Số requests đồng thời khi dùng --url')
+    parser.add_argument('--timeout', type=float, default=120.0, help='Timeout mỗi request (giây)')
+    parser.add_argument('--model', default=MODEL_NAME, help='Model cho chế độ in-process')
+    parser.add_argument('--gpu-memory-utilization', type=float,
+                        default=float(os.getenv("GPU_MEMORY_UTILIZATION", "0.7")))
+    parser.add_argument('--chunk-size', type=int, default=256, help='Số dòng mỗi chunk/checkpoint')
+    parser.add_argument('--upload-traces', action='store_true',
+                        help='Gửi usage traces lên Langfuse khi job xong (proxy đã tự trace nên chỉ cần cho in-process)')
+
+    args = parser.parse_args()
+    checkpoint_path = args.checkpoint or f"{args.output}.ckpt"
+
+    if args.url:
+        print(f"🔗 Sending requests to {args.url}{args.endpoint} (concurrency {args.concurrency})")
+        backend = HTTPBackend(args.url, args.endpoint, args.concurrency, args.timeout)
+    else:
+        print(f"🚀 Loading model in-process: {args.model}")
+        backend = LocalBackend(args.model, args.gpu_memory_utilization)
+
+    checkpoint = run_job(backend, args.input, args.output, checkpoint_path, args.chunk_size)
+
+    if args.upload_traces and not checkpoint["traces_uploaded"]:
+        print("📤 Uploading traces to Langfuse...")
+        uploaded = upload_traces(args.output)
+        checkpoint["traces_uploaded"] = True
+        save_checkpoint(checkpoint_path, checkpoint)
+        print(f"✅ Uploaded {uploaded:,} traces")
+
+    print("\n📊 BATCH SUMMARY")
+    print("=" * 40)
+    print(f"🔢 Lines: {checkpoint['lines_done']:,}")
+    print(f"📥 Total IN (prompt): {checkpoint['prompt_tokens']:,}")
+    print(f"📤 Total OUT (completion): {checkpoint['completion_tokens']:,}")
+    print(f"❌ Errors: {checkpoint['errors']:,}")
+    print("=" * 40)
+
+if __name__ == "__main__":
+    main()
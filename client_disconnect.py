@@ -0,0 +1,42 @@
+"""
+Client disconnect detection
+Chạy một coroutine (generation, request tới backend) song song với việc lắng
+nghe http.disconnect; khi client đóng connection, coroutine bị cancel để
+GPU không tiếp tục sinh câu trả lời không ai đọc. Dùng chung bởi
+app/main.py và langfuse_proxy.py.
+"""
+
+import asyncio
+import contextlib
+
+# nginx convention for "client closed request"; the client never sees it
+CLIENT_CLOSED_REQUEST = 499
+
+class ClientDisconnected(Exception):
+    """Client đóng connection trước khi response được gửi"""
+
+async def wait_for_disconnect(request):
+    """Chờ tới khi client disconnect; chỉ dùng sau khi request body đã được đọc hết"""
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+async def run_until_disconnect(coro, request):
+    """Returns kết quả của `coro`, hoặc cancel nó và raise ClientDisconnected"""
+    work = asyncio.ensure_future(coro)
+    watcher = asyncio.ensure_future(wait_for_disconnect(request))
+    try:
+        done, _ = await asyncio.wait({work, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        work.cancel()
+        raise
+    finally:
+        watcher.cancel()
+    if work in done:
+        return work.result()
+
+    work.cancel()
+    with contextlib.suppress(asyncio.CancelledError, Exception):
+        await work
+    raise ClientDisconnected()
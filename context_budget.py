@@ -0,0 +1,34 @@
+"""
+Context budgeting cho hội thoại dài
+Cắt history về một token budget trước khi gửi tới model: giữ system prompt ở
+đầu và các turns gần nhất, bỏ các messages ở giữa. Dùng chung bởi
+app/main.py và langfuse_proxy.py (mỗi bên tự đếm tokens bằng tokenizer của
+mình).
+"""
+
+def trim_messages(messages, budget, count_tokens):
+    """Returns (kept_messages, dropped_messages, dropped_tokens).
+
+    `count_tokens(message)` trả về số tokens của một message. Message cuối
+    cùng (turn hiện tại) luôn được giữ kể cả khi riêng nó đã vượt budget;
+    phần còn lại được thêm từ mới nhất về cũ nhất cho tới khi hết budget.
+    """
+    leading = 0
+    while leading < len(messages) and messages[leading].get("role") == "system":
+        leading += 1
+    system, history = messages[:leading], messages[leading:]
+    if not history:
+        return messages, 0, 0
+
+    costs = [count_tokens(message) for message in history]
+    remaining = budget - sum(count_tokens(message) for message in system) - costs[-1]
+    start = len(history) - 1
+    while start > 0 and costs[start - 1] <= remaining:
+        remaining -= costs[start - 1]
+        start -= 1
+
+    # Don't open the kept history with a dangling assistant reply
+    while start < len(history) - 1 and history[start].get("role") == "assistant":
+        start += 1
+
+    return system + history[start:], start, sum(costs[:start])
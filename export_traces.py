@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Export Traces - Xuất toàn bộ usage data từ Langfuse ra Parquet / Arrow IPC
+Phân trang qua traces API, ghi từng row group ra file ngay khi đủ rows nên
+memory không phụ thuộc số traces; có thể partition theo ngày/project và chạy
+tiếp khi export bị ngắt.
+
+Cần pyarrow: pip install pyarrow
+"""
+
+import os
+import json
+import glob
+import argparse
+from datetime import datetime, timedelta, timezone
+
+import requests
+
+from proxy_dedup import is_content_trace
+
+def load_pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.ipc
+        import pyarrow.parquet
+        return pa
+    except ImportError:
+        raise SystemExit("❌ pyarrow is required: pip install pyarrow")
+
+def trace_schema(pa):
+    return pa.schema([
+        ("timestamp", pa.timestamp("ms", tz="UTC")),
+        ("project", pa.string()),
+        ("model", pa.string()),
+        ("prompt_tokens", pa.int64()),
+        ("completion_tokens", pa.int64()),
+        ("latency", pa.float64()),
+        ("trace_id", pa.string())
+    ])
+
+def trace_to_row(trace):
+    """Chỉ lấy các cột usage; trace không có usage vẫn được giữ với tokens = None"""
+    metadata = trace.get("metadata") or {}
+    output = trace.get("output")
+    usage = output.get("usage") if isinstance(output, dict) else None
+    usage = usage if isinstance(usage, dict) else {}
+    timestamp = trace.get("timestamp")
+    latency = trace.get("latency", metadata.get("latency"))
+    # Traces written before the model was in metadata still have it in the input
+    trace_input = trace.get("input")
+    model = metadata.get("model") or (trace_input.get("model") if isinstance(trace_input, dict) else None)
+    return {
+        "timestamp": datetime.fromisoformat(timestamp.replace("Z", "+00:00")) if timestamp else None,
+        "project": metadata.get("project"),
+        "model": model,
+        "prompt_tokens": usage.get("prompt_tokens"),
+        "completion_tokens": usage.get("completion_tokens"),
+        "latency": float(latency) if latency is not None else None,
+        "trace_id": trace.get("id")
+    }
+
+def partition_key(row, partition_by):
+    parts = []
+    if "day" in partition_by:
+        day = row["timestamp"].strftime("%Y-%m-%d") if row["timestamp"] else "unknown"
+        parts.append(f"day={day}")
+    if "project" in partition_by:
+        parts.append(f"project={row['project'] or 'unknown'}")
+    return tuple(parts)
+
+class PartitionedWriter:
+    """Gom rows theo partition, mỗi lần flush ghi một file part đã đóng hoàn chỉnh"""
+
+    def __init__(self, pa, output_dir, file_format, partition_by, part_number=0):
+        self.pa = pa
+        self.schema = trace_schema(pa)
+        self.output_dir = output_dir
+        self.file_format = file_format
+        self.partition_by = partition_by
+        self.part_number = part_number
+        self.buffers = {}
+        self.buffered = 0
+
+    def add(self, row):
+        columns = self.buffers.setdefault(
+            partition_key(row, self.partition_by),
+            {name: [] for name in self.schema.names}
+        )
+        for name in self.schema.names:
+            columns[name].append(row[name])
+        self.buffered += 1
+
+    def _write(self, path, table):
+        if self.file_format == "parquet":
+            self.pa.parquet.write_table(table, path, compression="zstd")
+        else:
+            with self.pa.OSFile(path, "wb") as sink:
+                with self.pa.ipc.new_file(sink, self.schema) as writer:
+                    writer.write_table(table)
+
+    def flush(self):
+        if not self.buffered:
+            return
+        self.part_number += 1
+        extension = "parquet" if self.file_format == "parquet" else "arrow"
+        for key, columns in self.buffers.items():
+            directory = os.path.join(self.output_dir, *key)
+            os.makedirs(directory, exist_ok=True)
+            table = self.pa.table(columns, schema=self.schema)
+            path = os.path.join(directory, f"part-{self.part_number:06d}.{extension}")
+            tmp_path = f"{path}.tmp"
+            self._write(tmp_path, table)
+            os.replace(tmp_path, path)
+        self.buffers = {}
+        self.buffered = 0
+
+def remove_uncommitted_parts(output_dir, part_number):
+    """Xóa file parts được ghi sau checkpoint cuối (export bị ngắt giữa chừng)"""
+    for path in glob.glob(os.path.join(output_dir, "**", "part-*.*"), recursive=True):
+        name = os.path.basename(path)
+        try:
+            number = int(name.split("-")[1].split(".")[0])
+        except (IndexError, ValueError):
+            continue
+        if number > part_number or name.endswith(".tmp"):
+            os.remove(path)
+
+def load_checkpoint(path, since, until):
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {
+        "from": since.isoformat(),
+        "to": until.isoformat(),
+        "next_page": 1,
+        "part_number": 0,
+        "rows": 0,
+        "done": False
+    }
+
+def save_checkpoint(path, checkpoint):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+def fetch_page(session, host, since, until, page, limit):
+    params = {
+        "page": page,
+        "limit": limit,
+        "fromTimestamp": since.isoformat().replace("+00:00", "Z"),
+        "toTimestamp": until.isoformat().replace("+00:00", "Z"),
+        "orderBy": "timestamp.asc"
+    }
+    response = session.get(f"{host}/api/public/traces", params=params, timeout=60)
+    response.raise_for_status()
+    return response.json()
+
+def export(host, output_dir, file_format, partition_by, days, page_size, row_group_size, auth):
+    pa = load_pyarrow()
+    os.makedirs(output_dir, exist_ok=True)
+    checkpoint_path = os.path.join(output_dir, "_checkpoint.json")
+
+    until = datetime.now(timezone.utc)
+    checkpoint = load_checkpoint(checkpoint_path, until - timedelta(days=days), until)
+    if checkpoint["done"]:
+        print(f"✅ Export already complete ({checkpoint['rows']:,} rows). Delete {checkpoint_path} to re-export.")
+        return checkpoint
+
+    # The time range is frozen in the checkpoint so page numbers stay stable across resumes
+    since = datetime.fromisoformat(checkpoint["from"])
+    until = datetime.fromisoformat(checkpoint["to"])
+    if checkpoint["next_page"] > 1:
+        print(f"♻️  Resuming at page {checkpoint['next_page']:,} ({checkpoint['rows']:,} rows exported)")
+    remove_uncommitted_parts(output_dir, checkpoint["part_number"])
+
+    session = requests.Session()
+    session.auth = auth
+    writer = PartitionedWriter(pa, output_dir, file_format, partition_by, checkpoint["part_number"])
+
+    page = checkpoint["next_page"]
+    rows = checkpoint["rows"]
+    while True:
+        result = fetch_page(session, host, since, until, page, page_size)
+        data = result.get("data") or []
+        for trace in data:
+            # Dedup content traces hold a message, not a request
+            if is_content_trace(trace):
+                continue
+            writer.add(trace_to_row(trace))
+            rows += 1
+
+        total_pages = (result.get("meta") or {}).get("totalPages")
+        last_page = not data or len(data) < page_size or (total_pages is not None and page >= total_pages)
+
+        # Flush only on page boundaries so the checkpoint can point at the next page
+        if writer.buffered >= row_group_size or last_page:
+            writer.flush()
+            checkpoint.update(next_page=page + 1, part_number=writer.part_number, rows=rows, done=last_page)
+            save_checkpoint(checkpoint_path, checkpoint)
+            print(f"💾 {rows:,} rows written (page {page:,}{f'/{total_pages:,}' if total_pages else ''})")
+
+        if last_page:
+            return checkpoint
+        page += 1
+
+def main():
+    parser = argparse.ArgumentParser(description='Export Traces - Xuất usage data từ Langfuse ra Parquet/Arrow')
+    parser.add_argument('output_dir', help='Thư mục output')
+    parser.add_argument('--host', default='http://localhost:3000', help='Langfuse host')
+    parser.add_argument('--public-key', default=os.getenv("LANGFUSE_PUBLIC_KEY"), help='Langfuse public key')
+    parser.add_argument('--secret-key', default=os.getenv("LANGFUSE_SECRET_KEY"), help='Langfuse secret key')
+    parser.add_argument('--days', type=int, default=30, help='Số ngày gần nhất để export')
+    parser.add_argument('--format', choices=['parquet', 'ipc'], default='parquet', help='Định dạng file')
+    parser.add_argument('--partition-by', nargs='*', choices=['day', 'project'], default=[],
+                        help='Partition output theo day và/hoặc project')
+    parser.add_argument('--page-size', type=int, default=100, help='Số traces mỗi request')
+    parser.add_argument('--row-group-size', type=int, default=50000, help='Số rows tối đa giữ trong memory trước khi ghi')
+
+    args = parser.parse_args()
+    auth = (args.public_key, args.secret_key) if args.public_key and args.secret_key else None
+
+    print(f"🔍 Exporting traces from {args.host} (last {args.days} days) to {args.output_dir}...")
+    checkpoint = export(
+        args.host.rstrip('/'),
+        args.output_dir,
+        args.format,
+        args.partition_by,
+        args.days,
+        args.page_size,
+        args.row_group_size,
+        auth
+    )
+    print(f"✅ Done: {checkpoint['rows']:,} rows in {checkpoint['part_number']:,} parts")
+
+if __name__ == "__main__":
+    main()
@@ -7,14 +7,58 @@ Sử dụng khi không có GUI để truy cập Langfuse dashboard
 import requests
 import json
 import argparse
-from datetime import datetime, timedelta
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from requests.adapters import HTTPAdapter
 from tabulate import tabulate
+from urllib.parse import quote
 import os
 
+from proxy_dedup import is_content_trace, is_reference, reassemble
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "langfuse_cli")
+
 class LangfuseCLI:
-    def __init__(self, host="http://localhost:3000"):
+    def __init__(self, host="http://localhost:3000", cache_dir=DEFAULT_CACHE_DIR, workers=8):
         self.host = host
         self.base_url = f"{host}/api/public"
+        self.cache_dir = cache_dir
+        self.workers = workers
+        
+        # Pooled session: connections are reused across (concurrent) requests
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+    
+    def _cache_path(self, trace_id):
+        host_dir = quote(self.host, safe="")
+        return os.path.join(self.cache_dir, host_dir, f"{quote(trace_id, safe='')}.json")
+    
+    def _read_cache(self, trace_id):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._cache_path(trace_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+    
+    def _write_cache(self, trace_id, trace):
+        """Chỉ cache trace đã hoàn thành (có output) vì sau đó trace không đổi nữa"""
+        if not self.cache_dir or not trace or trace.get('output') is None:
+            return
+        path = self._cache_path(trace_id)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(trace, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"⚠️  Cannot write cache for {trace_id}: {e}")
         
     def get_traces(self, limit=20, days=1):
         """Lấy danh sách traces"""
@@ -30,9 +74,12 @@ class LangfuseCLI:
                 "orderDirection": "desc"
             }
             
-            response = requests.get(url, params=params)
+            response = self.session.get(url, params=params)
             if response.status_code == 200:
-                return response.json()
+                traces = response.json()
+                # Dedup content traces hold a message, not a request
+                traces['data'] = [trace for trace in traces.get('data') or [] if not is_content_trace(trace)]
+                return traces
             else:
                 print(f"❌ Error: {response.status_code}")
                 return None
@@ -41,14 +88,19 @@ class LangfuseCLI:
             return None
     
     def get_trace_details(self, trace_id):
-        """Lấy chi tiết của một trace"""
+        """Lấy chi tiết của một trace (ưu tiên on-disk cache)"""
+        cached = self._read_cache(trace_id)
+        if cached is not None:
+            return cached
         try:
             url = f"{self.base_url}/traces/{trace_id}"
-            response = requests.get(url)
+            response = self.session.get(url)
             if response.status_code == 200:
-                return response.json()
+                trace = response.json()
+                self._write_cache(trace_id, trace)
+                return trace
             else:
-                print(f"❌ Error: {response.status_code}")
+                print(f"❌ Error {response.status_code} for trace {trace_id}")
                 return None
         except Exception as e:
             print(f"❌ Connection error: {e}")
@@ -58,7 +110,7 @@ class LangfuseCLI:
         """Lấy observations của một trace"""
         try:
             url = f"{self.base_url}/traces/{trace_id}/observations"
-            response = requests.get(url)
+            response = self.session.get(url)
             if response.status_code == 200:
                 return response.json()
             else:
@@ -68,6 +120,39 @@ class LangfuseCLI:
             print(f"❌ Connection error: {e}")
             return None
     
+    def get_traces_since(self, since, limit=100, page=1):
+        """Lấy traces có timestamp >= since (datetime UTC), cũ nhất trước"""
+        try:
+            url = f"{self.base_url}/traces"
+            params = {
+                "limit": limit,
+                "page": page,
+                "fromTimestamp": since.isoformat().replace("+00:00", "Z"),
+                "orderBy": "timestamp.asc"
+            }
+            response = self.session.get(url, params=params, timeout=10)
+            if response.status_code == 200:
+                return response.json()
+            else:
+                print(f"❌ Error: {response.status_code}")
+                return None
+        except Exception as e:
+            print(f"❌ Connection error: {e}")
+            return None
+    
+    def get_trace_details_batch(self, trace_ids):
+        """Lấy chi tiết nhiều traces song song (tối đa `workers` requests cùng lúc), giữ thứ tự"""
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(self.get_trace_details, trace_ids))
+    
+    def reassemble_input(self, trace):
+        """Khôi phục input messages đầy đủ từ references (trace dedup của proxy)"""
+        trace_input = trace.get('input') if trace else None
+        if not isinstance(trace_input, dict) or not isinstance(trace_input.get('messages'), list):
+            return trace_input, []
+        messages, missing = reassemble(trace_input['messages'], self.get_trace_details)
+        return {**trace_input, 'messages': messages}, missing
+    
     def display_traces(self, traces):
         """Hiển thị danh sách traces dạng table"""
         if not traces or not traces.get('data'):
@@ -129,6 +214,9 @@ class LangfuseCLI:
                 if 'messages' in trace['input']:
                     for i, msg in enumerate(trace['input']['messages']):
                         role = msg.get('role', 'unknown')
+                        if is_reference(msg):
+                            print(f"   {i+1}. [{role}]: ↪ {msg['ref']} (trace {msg.get('trace_id')})")
+                            continue
                         content = msg.get('content', '')[:100]
                         print(f"   {i+1}. [{role}]: {content}...")
                 
@@ -163,21 +251,198 @@ class LangfuseCLI:
             for key, value in trace['metadata'].items():
                 print(f"   {key}: {value}")
 
+def parse_timestamp(timestamp):
+    try:
+        return datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    except (AttributeError, ValueError):
+        return None
+
+def trace_usage(trace):
+    output = trace.get('output')
+    if isinstance(output, dict) and isinstance(output.get('usage'), dict):
+        usage = output['usage']
+        return usage.get('prompt_tokens', 0) or 0, usage.get('completion_tokens', 0) or 0
+    return 0, 0
+
+class TraceFollower:
+    """Live tail: poll traces mới theo timestamp cursor, chỉ in traces chưa thấy"""
+    
+    def __init__(self, cli, min_interval=1.0, max_interval=30.0, window=60, page_size=100, seen_size=10000,
+                 lag=30.0):
+        self.cli = cli
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.window = window
+        self.page_size = page_size
+        self.seen_size = seen_size
+        # Overlap window: once every `lag` seconds a poll re-reads the last
+        # `lag` seconds, so traces ingested late (timestamp older than the
+        # cursor) are still picked up without re-reading it on every poll
+        self.lag = lag
+        self._last_overlap = time.monotonic()
+        # Bounded dedup set: ids of traces already printed, oldest evicted first
+        self.seen = OrderedDict()
+        # Rolling (timestamp, project, prompt_tokens, completion_tokens) for rate stats
+        self.recent = deque()
+    
+    def _mark_seen(self, trace_id):
+        if trace_id in self.seen:
+            return False
+        self.seen[trace_id] = True
+        if len(self.seen) > self.seen_size:
+            self.seen.popitem(last=False)
+        return True
+    
+    def poll(self, cursor):
+        """Lấy tất cả traces mới từ cursor (định kỳ từ cursor - lag). Returns (new_traces, new_cursor)"""
+        new_traces = []
+        page = 1
+        since = cursor
+        if self.lag and time.monotonic() - self._last_overlap >= self.lag:
+            since = cursor - timedelta(seconds=self.lag)
+            self._last_overlap = time.monotonic()
+        while True:
+            result = self.cli.get_traces_since(since, limit=self.page_size, page=page)
+            if not result:
+                break
+            data = result.get('data') or []
+            for trace in data:
+                # Content traces written by the proxy's message dedup are not requests
+                if is_content_trace(trace):
+                    continue
+                if self._mark_seen(trace.get('id')):
+                    new_traces.append(trace)
+            # Only page further when the page was full (a traffic burst)
+            if len(data) < self.page_size:
+                break
+            page += 1
+        
+        for trace in new_traces:
+            ts = parse_timestamp(trace.get('timestamp'))
+            # The cursor tracks the newest timestamp seen; traces re-read from
+            # the overlap window are dropped by the dedup set
+            if ts is not None and ts > cursor:
+                cursor = ts
+        return new_traces, cursor
+    
+    def _adapt_interval(self, new_count):
+        if new_count:
+            self.interval = max(self.min_interval, self.interval / 2)
+        else:
+            self.interval = min(self.max_interval, self.interval * 1.5)
+    
+    def _record(self, trace):
+        prompt_tokens, completion_tokens = trace_usage(trace)
+        project = (trace.get('metadata') or {}).get('project', 'unknown')
+        self.recent.append((time.time(), project, prompt_tokens, completion_tokens))
+    
+    def rates(self):
+        """Request rate và tokens/s theo project trong `window` giây gần nhất"""
+        cutoff = time.time() - self.window
+        while self.recent and self.recent[0][0] < cutoff:
+            self.recent.popleft()
+        projects = {}
+        for _, project, prompt_tokens, completion_tokens in self.recent:
+            stats = projects.setdefault(project, [0, 0, 0])
+            stats[0] += 1
+            stats[1] += prompt_tokens
+            stats[2] += completion_tokens
+        return {
+            project: {
+                "req_per_s": requests / self.window,
+                "prompt_tokens_per_s": prompt / self.window,
+                "completion_tokens_per_s": completion / self.window
+            }
+            for project, (requests, prompt, completion) in projects.items()
+        }
+    
+    def print_trace(self, trace):
+        prompt_tokens, completion_tokens = trace_usage(trace)
+        ts = parse_timestamp(trace.get('timestamp'))
+        when = ts.astimezone().strftime('%H:%M:%S') if ts else 'N/A'
+        project = (trace.get('metadata') or {}).get('project', 'N/A')
+        print(f"{when}  {project:<20} {trace.get('id', 'N/A'):<36} P:{prompt_tokens} C:{completion_tokens}")
+    
+    def print_rates(self):
+        rates = self.rates()
+        if not rates:
+            return
+        parts = [
+            f"{project}: {r['req_per_s']:.2f} req/s, "
+            f"IN {r['prompt_tokens_per_s']:.1f} tok/s, OUT {r['completion_tokens_per_s']:.1f} tok/s"
+            for project, r in rates.items()
+        ]
+        print(f"📈 last {self.window}s | " + " | ".join(parts) + f" | next poll in {self.interval:.1f}s")
+    
+    def run(self, since_seconds=60):
+        cursor = datetime.now(timezone.utc) - timedelta(seconds=since_seconds)
+        print(f"👀 Following traces on {self.cli.host} (Ctrl+C to stop)...")
+        try:
+            while True:
+                new_traces, cursor = self.poll(cursor)
+                for trace in new_traces:
+                    self._record(trace)
+                    self.print_trace(trace)
+                self._adapt_interval(len(new_traces))
+                if new_traces:
+                    self.print_rates()
+                time.sleep(self.interval)
+        except KeyboardInterrupt:
+            print("\n👋 Stopped following")
+
 def main():
     parser = argparse.ArgumentParser(description='Langfuse CLI Tool')
     parser.add_argument('--host', default='http://localhost:3000', help='Langfuse host')
     parser.add_argument('--limit', type=int, default=20, help='Number of traces to show')
     parser.add_argument('--days', type=int, default=1, help='Days back to search')
-    parser.add_argument('--trace-id', help='Show details of specific trace ID')
+    parser.add_argument('--trace-id', nargs='+', help='Show details of one or more trace IDs')
+    parser.add_argument('--trace-file', help='File chứa trace IDs (mỗi dòng một ID)')
+    parser.add_argument('--workers', type=int, default=8, help='Số requests song song khi lấy nhiều traces')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help='Thư mục cache traces đã hoàn thành')
+    parser.add_argument('--no-cache', action='store_true', help='Không dùng on-disk cache')
+    parser.add_argument('--full-input', action='store_true',
+                        help='In input đầy đủ (JSON) của --trace-id, khôi phục các message references')
+    parser.add_argument('--follow', '-f', action='store_true', help='Live tail: chỉ in traces mới')
+    parser.add_argument('--min-interval', type=float, default=1.0, help='Poll interval nhỏ nhất khi có traffic (giây)')
+    parser.add_argument('--max-interval', type=float, default=30.0, help='Poll interval lớn nhất khi không có traffic (giây)')
+    parser.add_argument('--rate-window', type=int, default=60, help='Cửa sổ tính req/s và tokens/s (giây)')
+    parser.add_argument('--follow-lag', type=float, default=30.0,
+                        help='Mỗi N giây đọc lại N giây trước cursor một lần để không bỏ sót traces ingest trễ')
     
     args = parser.parse_args()
     
-    cli = LangfuseCLI(args.host)
+    cli = LangfuseCLI(args.host, cache_dir=None if args.no_cache else args.cache_dir, workers=args.workers)
+    
+    trace_ids = list(args.trace_id or [])
+    if args.trace_file:
+        with open(args.trace_file) as f:
+            trace_ids.extend(line.strip() for line in f if line.strip())
     
-    if args.trace_id:
+    if args.follow:
+        follower = TraceFollower(
+            cli,
+            min_interval=args.min_interval,
+            max_interval=args.max_interval,
+            window=args.rate_window,
+            lag=args.follow_lag
+        )
+        follower.run()
+    elif trace_ids:
         # Show specific trace details
-        trace = cli.get_trace_details(args.trace_id)
-        cli.display_trace_detail(trace)
+        traces = cli.get_trace_details_batch(trace_ids)
+        for trace in traces:
+            if args.full_input:
+                if trace:
+                    full_input, missing = cli.reassemble_input(trace)
+                    print(json.dumps({'id': trace.get('id'), 'input': full_input}, ensure_ascii=False, indent=2))
+                    if missing:
+                        print(f"⚠️  {len(missing)} message references could not be resolved: {', '.join(missing)}")
+                continue
+            cli.display_trace_detail(trace)
+        if len(trace_ids) > 1:
+            found = sum(1 for trace in traces if trace)
+            print(f"\n📊 Fetched {found}/{len(trace_ids)} traces")
     else:
         # Show list of traces
         print(f"🔍 Fetching traces from {args.host}...")
@@ -0,0 +1,92 @@
+"""
+Langfuse Hosts - Danh sách Langfuse hosts/keys cho các summary tools
+Mỗi GPU trong docker-compose-multi.yml có Langfuse host và keys riêng
+(LANGFUSE_HOST_GPU0, LANGFUSE_PUBLIC_KEY_GPU0, ...); các tools query tất cả
+hosts song song bằng pooled sessions có auth rồi gộp kết quả.
+
+Nguồn (có thể kết hợp):
+  --host URL [--host URL ...]     dùng chung --public-key/--secret-key
+  --env-suffix GPU0 GPU1          đọc LANGFUSE_HOST_<S>, LANGFUSE_PUBLIC_KEY_<S>, LANGFUSE_SECRET_KEY_<S>
+  --hosts-file hosts.json         [{"name": "gpu0", "host": "...", "public_key": "...", "secret_key": "..."}]
+                                  (giá trị dạng ${VAR} được lấy từ environment)
+"""
+
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_HOST = "http://localhost:3000"
+
+class LangfuseHost:
+    def __init__(self, name, host, public_key=None, secret_key=None):
+        self.name = name
+        self.host = host.rstrip("/")
+        self.public_key = public_key
+        self.secret_key = secret_key
+
+    @property
+    def auth(self):
+        return (self.public_key, self.secret_key) if self.public_key and self.secret_key else None
+
+    def session(self, pool_size=4):
+        """Pooled session có Basic auth (public key / secret key)"""
+        session = requests.Session()
+        session.auth = self.auth
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+def add_host_arguments(parser):
+    parser.add_argument('--host', action='append', help=f'Langfuse host (lặp lại cho nhiều hosts, mặc định {DEFAULT_HOST})')
+    parser.add_argument('--public-key', default=os.getenv("LANGFUSE_PUBLIC_KEY"), help='Langfuse public key cho --host')
+    parser.add_argument('--secret-key', default=os.getenv("LANGFUSE_SECRET_KEY"), help='Langfuse secret key cho --host')
+    parser.add_argument('--env-suffix', nargs='+', default=[],
+                        help='Đọc host/keys từ LANGFUSE_HOST_<SUFFIX>, LANGFUSE_PUBLIC_KEY_<SUFFIX>, ... (vd: GPU0 GPU1)')
+    parser.add_argument('--hosts-file', help='JSON file chứa danh sách hosts và keys')
+
+def load_hosts_file(path):
+    with open(path) as f:
+        entries = json.load(f)
+    hosts = []
+    for index, entry in enumerate(entries):
+        entry = {key: os.path.expandvars(value) if isinstance(value, str) else value for key, value in entry.items()}
+        hosts.append(LangfuseHost(
+            entry.get("name") or f"host-{index}",
+            entry["host"],
+            entry.get("public_key"),
+            entry.get("secret_key")
+        ))
+    return hosts
+
+def hosts_from_args(args):
+    hosts = []
+    for url in args.host or []:
+        hosts.append(LangfuseHost(url, url, args.public_key, args.secret_key))
+    for suffix in args.env_suffix:
+        url = os.getenv(f"LANGFUSE_HOST_{suffix}")
+        if not url:
+            raise SystemExit(f"❌ LANGFUSE_HOST_{suffix} is not set")
+        hosts.append(LangfuseHost(
+            suffix,
+            url,
+            os.getenv(f"LANGFUSE_PUBLIC_KEY_{suffix}"),
+            os.getenv(f"LANGFUSE_SECRET_KEY_{suffix}")
+        ))
+    if args.hosts_file:
+        hosts.extend(load_hosts_file(args.hosts_file))
+    if not hosts:
+        hosts.append(LangfuseHost(DEFAULT_HOST, DEFAULT_HOST, args.public_key, args.secret_key))
+    return hosts
+
+def query_hosts(hosts, fetch, max_workers=8):
+    """Gọi fetch(host, session) cho mọi host song song; returns [(host, result)] theo thứ tự hosts"""
+    def run(host):
+        with host.session() as session:
+            return fetch(host, session)
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(hosts)) or 1) as executor:
+        return list(zip(hosts, executor.map(run, hosts)))
@@ -8,14 +8,33 @@ import os
 import asyncio
 import json
 import uuid
-from datetime import datetime
+import time
+import contextlib
+import hashlib
 from typing import List, Optional
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
+import anyio
 import httpx
 from langfuse import Langfuse
 import logging
+from proxy_tokens import TOKENS_PER_REPLY, TokenCounter
+from proxy_backends import BackendPool, NoBackendAvailable
+from proxy_usage import UsageRollup
+from proxy_stream import BoundedCapture, UsageSniffer, forward_headers, request_stream_usage
+from proxy_compression import CompressionMiddleware, enable_langfuse_gzip
+from proxy_dedup import MessageDeduplicator, langfuse_exporter, message_hash
+from proxy_capture import RequestCapture
+from proxy_shadow import ShadowMirror
+from proxy_heavy_hitters import HeavyHitters
+from proxy_telemetry import TelemetryCollector
+from proxy_sessions import SessionStore
+from context_budget import trim_messages
+from client_disconnect import CLIENT_CLOSED_REQUEST, ClientDisconnected, run_until_disconnect
+from prefix_cache import PrefixCacheEstimator, cached_tokens_from_usage
+from langfuse_tracing import TRACED_ENDPOINTS, build_trace_input
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -30,10 +49,100 @@ langfuse = Langfuse(
     secret_key=os.getenv("LANGFUSE_SECRET_KEY", "default-secret-key"),
     host=os.getenv("LANGFUSE_HOST", "http://langfuse:3000")
 )
+# Gzip trace payloads sent to Langfuse (server must accept Content-Encoding: gzip)
+if os.getenv("LANGFUSE_GZIP", "false").lower() == "true":
+    enable_langfuse_gzip(langfuse)
 
 # Get environment variables
 PROJECT_NAME = os.getenv("PROJECT_NAME", "default-project")
 VLLM_API_URL = os.getenv("VLLM_API_URL", "http://localhost:8000")
+# Comma-separated list of vLLM backends; defaults to the single VLLM_API_URL
+VLLM_API_URLS = [url.strip() for url in os.getenv("VLLM_API_URLS", VLLM_API_URL).split(",") if url.strip()]
+UPSTREAM_TIMEOUT = float(os.getenv("UPSTREAM_TIMEOUT", "60"))
+# Hedging: bật cho mọi request ngắn bằng HEDGE_ENABLED, hoặc từng request bằng header X-Hedge
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() == "true"
+HEDGE_MAX_TOKENS = int(os.getenv("HEDGE_MAX_TOKENS", "256"))
+TOKENIZER_NAME = os.getenv("TOKENIZER_NAME", os.getenv("MODEL_NAME", "Qwen/Qwen2.5-7B-Instruct"))
+MAX_MODEL_LEN = int(os.getenv("MAX_MODEL_LEN", "32768"))
+# "reject": trả 400 khi prompt + max_tokens vượt context; "truncate": giảm max_tokens cho vừa
+CONTEXT_OVERFLOW_POLICY = os.getenv("CONTEXT_OVERFLOW_POLICY", "reject")
+# Opt-in: cắt history về số prompt tokens này (0 = tắt); request có thể gửi "context_budget" riêng
+CONTEXT_BUDGET_TOKENS = int(os.getenv("CONTEXT_BUDGET_TOKENS", "0"))
+
+token_counter = TokenCounter(
+    TOKENIZER_NAME,
+    MAX_MODEL_LEN,
+    cache_size=int(os.getenv("TOKEN_CACHE_SIZE", "4096"))
+)
+
+backend_pool = BackendPool(
+    VLLM_API_URLS,
+    hedge_percentile=float(os.getenv("HEDGE_PERCENTILE", "95")),
+    hedge_min_delay=float(os.getenv("HEDGE_MIN_DELAY", "0.05")),
+    hedge_max_ratio=float(os.getenv("HEDGE_MAX_RATIO", "0.1")),
+    failure_threshold=int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "3")),
+    reset_timeout=float(os.getenv("CIRCUIT_RESET_TIMEOUT", "10")),
+    probe_interval=float(os.getenv("HEALTH_PROBE_INTERVAL", "5")),
+    probe_timeout=float(os.getenv("HEALTH_PROBE_TIMEOUT", "2"))
+)
+
+# Scrape vLLM /metrics of every backend (queue depth, KV-cache usage); 0 disables
+backend_telemetry = TelemetryCollector(
+    backend_pool,
+    interval=float(os.getenv("BACKEND_METRICS_INTERVAL", "2")),
+    timeout=float(os.getenv("BACKEND_METRICS_TIMEOUT", "1"))
+)
+
+# Opt-in per-backend prefix-cache model (tokens); its estimates go to trace metadata only (0 disables)
+PREFIX_CACHE_ESTIMATE_TOKENS = int(os.getenv("PREFIX_CACHE_ESTIMATE_TOKENS", "0"))
+prefix_estimators = {
+    backend.url: PrefixCacheEstimator(PREFIX_CACHE_ESTIMATE_TOKENS)
+    for backend in backend_pool.backends
+} if PREFIX_CACHE_ESTIMATE_TOKENS else {}
+
+usage_rollup = UsageRollup()
+# Top token consumers (count-min sketch, fixed memory) by project, user/API key and system prompt
+heavy_hitters = HeavyHitters(
+    width=int(os.getenv("HEAVY_HITTER_WIDTH", "2048")),
+    depth=int(os.getenv("HEAVY_HITTER_DEPTH", "4")),
+    top_k=int(os.getenv("HEAVY_HITTER_TOP_K", "10"))
+)
+
+# Client <-> proxy compression: gzip/deflate/zstd request bodies, Accept-Encoding responses
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=int(os.getenv("COMPRESSION_MIN_SIZE", "1024")),
+    max_request_size=int(os.getenv("MAX_REQUEST_BODY_BYTES", str(64 * 1024 * 1024)))
+)
+
+# Max bytes of a pass-through request body kept for the trace input
+TRACE_CAPTURE_BYTES = int(os.getenv("TRACE_CAPTURE_BYTES", str(256 * 1024)))
+# Trace input messages: full content only the first time, references afterwards
+TRACE_DEDUP = os.getenv("TRACE_DEDUP", "true").lower() == "true"
+message_dedup = MessageDeduplicator(
+    langfuse_exporter(langfuse, PROJECT_NAME),
+    cache_size=int(os.getenv("TRACE_DEDUP_CACHE_SIZE", "100000")),
+    min_chars=int(os.getenv("TRACE_DEDUP_MIN_CHARS", "64"))
+)
+# JSONL capture of traced requests for replay_traffic.py (disabled when empty)
+request_capture = RequestCapture(os.getenv("REQUEST_CAPTURE_PATH", ""))
+# Shadow traffic: mirror SHADOW_FRACTION of traced requests to a candidate backend (disabled when empty)
+shadow_mirror = ShadowMirror(
+    os.getenv("SHADOW_URL", ""),
+    fraction=float(os.getenv("SHADOW_FRACTION", "0.1")),
+    max_inflight=int(os.getenv("SHADOW_MAX_INFLIGHT", "4")),
+    timeout=float(os.getenv("SHADOW_TIMEOUT", "120")),
+    model=os.getenv("SHADOW_MODEL") or None
+)
+
+# Server-side chat history for /chat requests carrying a session_id (SESSION_DIR enables persistence)
+session_store = SessionStore(
+    max_sessions=int(os.getenv("SESSION_MAX_SESSIONS", "10000")),
+    max_bytes=int(os.getenv("SESSION_MAX_BYTES", str(256 * 1024 * 1024))),
+    ttl=float(os.getenv("SESSION_TTL", "3600")),
+    persist_dir=os.getenv("SESSION_DIR", ""),
+    max_session_bytes=int(os.getenv("SESSION_MAX_SESSION_BYTES", str(1024 * 1024)))
+)
 
 # Pydantic models
 class ChatMessage(BaseModel):
@@ -46,186 +155,801 @@ class ChatRequest(BaseModel):
     temperature: Optional[float] = 0.7
     top_p: Optional[float] = 0.9
     trace_id: Optional[str] = None
+    context_budget: Optional[int] = None
+    # Proxy keeps the history: `messages` only holds the new turn
+    session_id: Optional[str] = None
 
 class ChatResponse(BaseModel):
     response: str
     usage: dict
     trace_id: str
+    context: Optional[dict] = None
+    session: Optional[dict] = None
 
 @app.on_event("startup")
 async def startup_event():
     logger.info(f"Langfuse Proxy started for project: {PROJECT_NAME}")
-    logger.info(f"vLLM API URL: {VLLM_API_URL}")
+    logger.info(f"vLLM API URLs: {VLLM_API_URLS}")
+    await backend_pool.start()
+    backend_telemetry.start()
+    request_capture.start()
+    await shadow_mirror.start()
+    await asyncio.to_thread(session_store.load)
+    session_store.start()
+    # Load the tokenizer in the background so startup doesn't block on a download;
+    # token counting is skipped until token_counter.ready
+    token_counter.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await backend_telemetry.close()
+    await backend_pool.close()
+    request_capture.close()
+    await shadow_mirror.close()
+    session_store.close()
+
+def trace_messages(messages, trace_id):
+    """Messages cho trace input (dedup theo content hash nếu TRACE_DEDUP)"""
+    if not TRACE_DEDUP or not isinstance(messages, list):
+        return messages
+    return message_dedup.compact(messages, trace_id)
+
+def short_hash(value):
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()[:12]
+
+def api_key_id(headers):
+    """Hash của API key trong request (Authorization: Bearer / X-Api-Key), None nếu không có"""
+    authorization = headers.get("authorization", "")
+    api_key = headers.get("x-api-key") or authorization.removeprefix("Bearer ").strip()
+    return f"key-{short_hash(api_key)}" if api_key else None
+
+def session_key(headers, session_id):
+    """Key của session trong store: session ids do client chọn, nên được scope theo
+    API key (hoặc X-User-Id) của caller để không ai đọc/ghi/xóa được session của người khác
+    """
+    owner = api_key_id(headers) or headers.get("x-user-id") or "anonymous"
+    return f"{owner}:{session_id}"
+
+def track_heavy_hitters(headers, request_body, usage):
+    """Ghi tokens của request vào heavy-hitter sketches; API keys chỉ được lưu dạng hash"""
+    request_body = request_body if isinstance(request_body, dict) else {}
+    user = headers.get("x-user-id") or request_body.get("user") or api_key_id(headers) or "anonymous"
+
+    system_prompt = next(
+        (
+            message.get("content")
+            for message in request_body.get("messages") or []
+            if isinstance(message, dict) and message.get("role") == "system"
+        ),
+        None
+    )
+    if not isinstance(system_prompt, str):
+        system_prompt = None
+    keys = {
+        "project": PROJECT_NAME,
+        "user": str(user),
+        "system_prompt": f"sp-{short_hash(system_prompt)}" if system_prompt else "none"
+    }
+    labels = {"system_prompt": system_prompt[:80]} if system_prompt else None
+    heavy_hitters.record(
+        keys, (usage.get("prompt_tokens") or 0) + (usage.get("completion_tokens") or 0), labels=labels
+    )
+
+def apply_context_budget(messages, budget):
+    """Giữ system prompt và các turns gần nhất trong `budget` tokens.
+
+    Returns (messages, report); report là None khi không có gì bị bỏ (hoặc
+    chưa có tokenizer để đếm).
+    """
+    budget = budget or CONTEXT_BUDGET_TOKENS
+    if not budget or not token_counter.ready or not isinstance(messages, list):
+        return messages, None
+    kept, dropped_messages, dropped_tokens = trim_messages(messages, budget, token_counter.count_message)
+    if not dropped_messages:
+        return messages, None
+    logger.info(f"Context budget {budget}: dropped {dropped_messages} messages ({dropped_tokens} tokens)")
+    return kept, {
+        "budget": budget,
+        "dropped_messages": dropped_messages,
+        "dropped_tokens": dropped_tokens
+    }
+
+def check_context_length(messages, max_tokens):
+    """Đếm prompt tokens và reject/truncate trước khi gửi tới backend.
+
+    Returns (prompt_tokens, max_tokens); prompt_tokens là None nếu chưa có tokenizer.
+    max_tokens None (client không gửi): vLLM sinh tới hết context còn lại, nên
+    chỉ reject khi riêng prompt đã chiếm hết MAX_MODEL_LEN.
+    """
+    prompt_tokens = token_counter.count_messages(messages)
+    if prompt_tokens is None:
+        return prompt_tokens, max_tokens
+    if max_tokens is None:
+        if prompt_tokens >= MAX_MODEL_LEN:
+            raise HTTPException(
+                status_code=400,
+                detail=(
+                    f"This model's maximum context length is {MAX_MODEL_LEN} tokens. "
+                    f"However, your messages resulted in {prompt_tokens} tokens."
+                )
+            )
+        return prompt_tokens, max_tokens
+
+    if prompt_tokens + max_tokens > MAX_MODEL_LEN:
+        available = MAX_MODEL_LEN - prompt_tokens
+        if CONTEXT_OVERFLOW_POLICY == "truncate" and available > 0:
+            logger.info(f"Truncating max_tokens {max_tokens} -> {available} to fit context")
+            return prompt_tokens, available
+        raise HTTPException(
+            status_code=400,
+            detail=(
+                f"This model's maximum context length is {MAX_MODEL_LEN} tokens. "
+                f"However, you requested {prompt_tokens + max_tokens} tokens "
+                f"({prompt_tokens} in the messages, {max_tokens} in the completion)."
+            )
+        )
+    return prompt_tokens, max_tokens
+
+def fill_usage(usage, prompt_tokens, response_content):
+    """Bổ sung usage bằng tokenizer của proxy khi backend không trả về"""
+    usage = dict(usage or {})
+    if not usage.get("prompt_tokens") and prompt_tokens is not None:
+        usage["prompt_tokens"] = prompt_tokens
+    if "completion_tokens" not in usage and token_counter.ready:
+        usage["completion_tokens"] = token_counter.count_text(response_content)
+    # Consumers sum these keys; unknown counts are 0 rather than missing
+    usage.setdefault("prompt_tokens", 0)
+    usage.setdefault("completion_tokens", 0)
+    usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+    return usage
+
+def cached_tokens_report(usage, backend, request_body):
+    """Nguồn và ước lượng cached prompt tokens cho trace metadata, returns (source, estimate).
+
+    Chỉ con số backend tự báo nằm trong usage (prompt_tokens_details.cached_tokens);
+    ước lượng không bao giờ được ghi vào usage để không thành discount giả khi tính cost.
+    - "backend": backend báo cached_tokens, estimate là None
+    - "hit_rate": prompt_tokens × vllm:gpu_prefix_cache_hit_rate gần nhất của backend
+    - "estimate": mô phỏng prefix cache theo messages (PREFIX_CACHE_ESTIMATE_TOKENS)
+    - None: không biết
+    """
+    if cached_tokens_from_usage(usage) is not None:
+        return "backend", None
+    prompt_tokens = usage.get("prompt_tokens", 0)
+    # Negative when prefix caching is disabled on the backend
+    hit_rate = (backend.telemetry or {}).get("prefix_cache_hit_rate")
+    if hit_rate is not None and hit_rate >= 0:
+        return "hit_rate", int(prompt_tokens * min(hit_rate, 1.0))
+    messages = request_body.get("messages") if isinstance(request_body, dict) else None
+    if not prefix_estimators or not token_counter.ready or not isinstance(messages, list):
+        return None, None
+    segments = [(message_hash(message), token_counter.count_message(message)) for message in messages]
+    return "estimate", min(prefix_estimators[backend.url].observe(segments), prompt_tokens)
+
+def get_deadline(request: Request):
+    """Deadline (monotonic) từ header X-Deadline-Ms = thời gian client còn chờ, tính bằng ms"""
+    value = request.headers.get("x-deadline-ms")
+    if value is None:
+        return None
+    try:
+        return time.monotonic() + float(value) / 1000
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid X-Deadline-Ms header")
+
+async def forward_chat(body, deadline, max_tokens, request: Request, affinity=None):
+    """Gửi chat completion tới backend, áp dụng deadline và hedging.
+
+    `affinity` (session id) gắn request vào cùng backend với các turns trước.
+    Returns (backend, response, hedged). Raises ClientDisconnected nếu client
+    đóng connection trước khi backend trả lời; request tới backend bị cancel
+    (connection đóng nên vLLM abort generation).
+    """
+    timeout = UPSTREAM_TIMEOUT
+    headers = None
+    if deadline is not None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise HTTPException(status_code=504, detail="Request deadline exceeded")
+        timeout = min(timeout, remaining)
+        # Propagate the remaining budget so a chained proxy/backend can use it too
+        headers = {"X-Deadline-Ms": str(int(timeout * 1000))}
+
+    hedge_requested = HEDGE_ENABLED or request.headers.get("x-hedge", "").lower() in ("1", "true")
+    # Short requests set the hedge delay whether or not this one asked to be hedged
+    hedgeable = not body.get("stream") and max_tokens is not None and max_tokens <= HEDGE_MAX_TOKENS
+    hedge = hedge_requested and hedgeable
+
+    try:
+        return await run_until_disconnect(backend_pool.request(
+            "POST", "/v1/chat/completions", headers=headers, timeout=timeout, hedge=hedge,
+            hedgeable=hedgeable, affinity=affinity, json=body
+        ), request)
+    except NoBackendAvailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except httpx.TimeoutException:
+        raise HTTPException(status_code=504, detail="Upstream request timed out")
+
+def trace_cancelled(trace_id, trace_input, prompt_tokens, latency, shadow_request=None, context_report=None,
+                    model=None):
+    """Trace cho chat request bị hủy vì client disconnect trước khi backend trả lời.
+
+    Chưa có response nên completion tokens là 0; prompt tokens là ước lượng của proxy.
+    """
+    if shadow_request is not None:
+        shadow_request.record_primary(latency, ok=False)
+    usage = {"prompt_tokens": prompt_tokens or 0, "completion_tokens": 0, "total_tokens": prompt_tokens or 0}
+    logger.info(f"Client disconnected, cancelled upstream request: {trace_id}")
+    try:
+        langfuse.trace(
+            id=trace_id,
+            name=f"{PROJECT_NAME}-chat",
+            input=trace_input,
+            output={
+                "response": "",
+                "usage": usage
+            },
+            metadata={
+                "project": PROJECT_NAME,
+                "model": model,
+                "cancelled": True,
+                "prompt_tokens_estimate": prompt_tokens,
+                "latency": round(latency, 4),
+                "context": context_report
+            },
+            tags=["cancelled"]
+        )
+        langfuse.flush()
+    except Exception as e:
+        logger.warning(f"Failed to send trace to Langfuse: {e}")
 
 @app.get("/")
 async def root():
     return {
         "message": "vLLM Langfuse Proxy",
         "project": PROJECT_NAME,
-        "vllm_api": VLLM_API_URL
+        "vllm_api": VLLM_API_URL,
+        "backends": backend_pool.stats(),
+        "tokenizer": token_counter.stats(),
+        "trace_dedup": message_dedup.stats() if TRACE_DEDUP else None,
+        "request_capture": request_capture.stats() if request_capture.enabled else None,
+        "sessions": session_store.stats(),
+        "prefix_cache_estimate": {
+            url: estimator.stats() for url, estimator in prefix_estimators.items()
+        } if prefix_estimators else None
     }
 
 @app.get("/health")
 async def health_check():
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{VLLM_API_URL}/health")
-            if response.status_code == 200:
-                return {"status": "healthy", "project": PROJECT_NAME}
-            else:
-                return {"status": "unhealthy", "vllm_status": response.status_code}
-    except Exception as e:
-        return {"status": "error", "error": str(e)}
+    """Trả lời ngay từ trạng thái của background prober, không gọi backend"""
+    stats = backend_pool.stats()
+    return {
+        "status": "healthy" if stats["healthy"] else "unhealthy",
+        "project": PROJECT_NAME,
+        "backends": stats["backends"]
+    }
+
+@app.get("/usage")
+async def usage_report(window: str = "minute", format: str = "json"):
+    """Token usage gần đây theo phút/giờ/ngày (format=json hoặc text)"""
+    if window not in usage_rollup.windows:
+        raise HTTPException(
+            status_code=400,
+            detail=f"window must be one of {list(usage_rollup.windows)}"
+        )
+    if format == "text":
+        return PlainTextResponse(usage_rollup.report_text(window))
+    return usage_rollup.report(window)
+
+@app.get("/heavy-hitters")
+async def heavy_hitters_report(window: str = "minute", k: Optional[int] = None):
+    """Top token consumers hiện tại theo project, user/API key và system prompt"""
+    if window not in heavy_hitters.windows:
+        raise HTTPException(
+            status_code=400,
+            detail=f"window must be one of {heavy_hitters.windows}"
+        )
+    return heavy_hitters.top(window, k)
+
+@app.get("/telemetry")
+async def telemetry_report():
+    """Snapshot /metrics mới nhất của từng vLLM backend (queue depth, KV-cache usage, ...)"""
+    return backend_telemetry.snapshot()
+
+@app.get("/shadow")
+async def shadow_report():
+    """Latency / TTFT / tokens của primary và shadow backend trên cùng requests"""
+    return shadow_mirror.stats()
+
+@app.get("/sessions/{session_id}")
+async def session_info(session_id: str, request: Request):
+    info = session_store.info(session_key(request.headers, session_id))
+    if info is None:
+        raise HTTPException(status_code=404, detail="Session not found or expired")
+    return {**info, "session_id": session_id}
+
+@app.delete("/sessions/{session_id}")
+async def delete_session(session_id: str, request: Request):
+    if not session_store.delete(session_key(request.headers, session_id)):
+        raise HTTPException(status_code=404, detail="Session not found or expired")
+    return {"deleted": session_id}
 
 @app.post("/v1/chat/completions")
 async def chat_completions(request: Request):
     """Proxy chat completions với Langfuse tracing"""
     
     try:
+        started = time.monotonic()
+        deadline = get_deadline(request)
+
         # Parse request body
         body = await request.json()
         
-        # Create trace ID
-        trace_id = body.get("trace_id") or f"{PROJECT_NAME}-{uuid.uuid4().hex[:8]}"
+        # Create trace ID (body field or X-Trace-Id header); vLLM rejects unknown fields
+        trace_id = body.pop("trace_id", None) or request.headers.get("x-trace-id") or f"{PROJECT_NAME}-{uuid.uuid4().hex[:8]}"
         
-        # Extract messages for logging
-        messages = body.get("messages", [])
-        max_tokens = body.get("max_tokens", 1024)
+        # Trim long histories to the context budget (opt-in)
+        messages, context_report = apply_context_budget(body.get("messages", []), body.pop("context_budget", None))
+        if context_report:
+            body["messages"] = messages
+        # None: vLLM defaults it to the rest of the context
+        max_tokens = body.get("max_tokens")
         temperature = body.get("temperature", 0.7)
+
+        # Count prompt tokens and reject/truncate before wasting a backend round-trip
+        prompt_estimate, allowed_max_tokens = check_context_length(messages, max_tokens)
+        if allowed_max_tokens != max_tokens:
+            body["max_tokens"] = max_tokens = allowed_max_tokens
         
         logger.info(f"Processing request with trace_id: {trace_id}")
+
+        # Streaming responses are relayed chunk by chunk instead of parsed here
+        if body.get("stream"):
+            return await passthrough(
+                request, "v1/chat/completions", body=json.dumps(body).encode("utf-8"), trace_id=trace_id,
+                context_report=context_report
+            )
         
-        # Forward request to vLLM API
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{VLLM_API_URL}/v1/chat/completions",
-                json=body,
-                timeout=60.0
+        # Forward request to vLLM API (least-loaded backend, optionally hedged)
+        shadow_request = shadow_mirror.mirror("/v1/chat/completions", body)
+        backend_load = backend_telemetry.capture()
+        try:
+            backend, response, hedged = await forward_chat(body, deadline, max_tokens, request)
+        except ClientDisconnected:
+            trace_cancelled(
+                trace_id,
+                {"messages": trace_messages(messages, trace_id), "max_tokens": max_tokens, "temperature": temperature},
+                prompt_estimate, time.monotonic() - started, shadow_request, context_report, body.get("model")
             )
+            raise HTTPException(status_code=CLIENT_CLOSED_REQUEST, detail="Client closed request")
+        
+        if response.status_code == 200:
+            result = response.json()
             
-            if response.status_code == 200:
-                result = response.json()
-                
-                # Extract usage information
-                usage = result.get("usage", {})
-                prompt_tokens = usage.get("prompt_tokens", 0)
-                completion_tokens = usage.get("completion_tokens", 0)
-                total_tokens = usage.get("total_tokens", 0)
-                
-                # Get response content
-                response_content = ""
-                if result.get("choices") and len(result["choices"]) > 0:
-                    response_content = result["choices"][0].get("message", {}).get("content", "")
-                
-                # Send trace to Langfuse
-                try:
-                    langfuse.trace(
-                        id=trace_id,
-                        name=f"{PROJECT_NAME}-chat",
-                        input={
-                            "messages": messages,
-                            "max_tokens": max_tokens,
-                            "temperature": temperature
-                        },
-                        output={
-                            "response": response_content,
-                            "usage": {
-                                "prompt_tokens": prompt_tokens,
-                                "completion_tokens": completion_tokens,
-                                "total_tokens": total_tokens
-                            }
-                        },
-                        metadata={
-                            "project": PROJECT_NAME,
-                            "vllm_api": VLLM_API_URL
-                        }
-                    )
-                    langfuse.flush()
-                    logger.info(f"Trace sent to Langfuse: {trace_id}")
-                except Exception as e:
-                    logger.warning(f"Failed to send trace to Langfuse: {e}")
-                
-                # Add trace_id to response
-                result["trace_id"] = trace_id
-                return result
-            else:
-                logger.error(f"vLLM API error: {response.status_code}")
-                raise HTTPException(status_code=response.status_code, detail=response.text)
-                
+            # Get response content
+            response_content = ""
+            if result.get("choices") and len(result["choices"]) > 0:
+                response_content = result["choices"][0].get("message", {}).get("content", "")
+
+            # Extract usage information (filled in by the proxy if the backend omitted it)
+            usage = fill_usage(result.get("usage"), prompt_estimate, response_content)
+            cached_source, cached_estimate = cached_tokens_report(usage, backend, body)
+            result["usage"] = usage
+            prompt_tokens = usage.get("prompt_tokens", 0)
+            completion_tokens = usage.get("completion_tokens", 0)
+            latency = time.monotonic() - started
+            usage_rollup.record(PROJECT_NAME, body.get("model"), backend.url, prompt_tokens, completion_tokens)
+            track_heavy_hitters(request.headers, body, usage)
+            request_capture.record("/v1/chat/completions", body, response.status_code, latency, usage, trace_id)
+            if shadow_request is not None:
+                shadow_request.record_primary(latency, usage=usage)
+            
+            # Send trace to Langfuse
+            try:
+                langfuse.trace(
+                    id=trace_id,
+                    name=f"{PROJECT_NAME}-chat",
+                    input={
+                        "messages": trace_messages(messages, trace_id),
+                        "max_tokens": max_tokens,
+                        "temperature": temperature
+                    },
+                    output={
+                        "response": response_content,
+                        "usage": usage
+                    },
+                    metadata={
+                        "project": PROJECT_NAME,
+                        "model": body.get("model"),
+                        "vllm_api": backend.url,
+                        "hedged": hedged,
+                        "prompt_tokens_estimate": prompt_estimate,
+                        "latency": round(latency, 4),
+                        "context": context_report,
+                        "backend_load": backend_load.get(backend.url),
+                        "cached_tokens_source": cached_source,
+                        "cached_tokens_estimate": cached_estimate
+                    }
+                )
+                langfuse.flush()
+                logger.info(f"Trace sent to Langfuse: {trace_id}")
+            except Exception as e:
+                logger.warning(f"Failed to send trace to Langfuse: {e}")
+            
+            # Add trace_id (and dropped history, if any) to response
+            result["trace_id"] = trace_id
+            if context_report:
+                result["context"] = context_report
+            return result
+        else:
+            logger.error(f"vLLM API error: {response.status_code}")
+            raise HTTPException(status_code=response.status_code, detail=response.text)
+            
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in chat_completions: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/chat")
-async def chat(request: ChatRequest):
+async def chat(request: ChatRequest, http_request: Request):
     """Custom chat endpoint với Langfuse tracing"""
-    
+    if request.session_id:
+        # One turn at a time per session, so each turn sees the previous reply
+        async with session_store.turn(session_key(http_request.headers, request.session_id)):
+            return await chat_turn(request, http_request)
+    return await chat_turn(request, http_request)
+
+def session_budget(request: ChatRequest):
+    """Token budget của prompt trong session: budget của request/proxy, mặc định là
+    phần context còn lại sau max_tokens, để history không bao giờ vượt MAX_MODEL_LEN
+    """
+    return request.context_budget or CONTEXT_BUDGET_TOKENS or \
+        max(1, MAX_MODEL_LEN - (request.max_tokens or 0) - TOKENS_PER_REPLY)
+
+async def chat_turn(request: ChatRequest, http_request: Request):
     try:
+        started = time.monotonic()
+        deadline = get_deadline(http_request)
+
         # Create trace ID
-        trace_id = request.trace_id or f"{PROJECT_NAME}-{uuid.uuid4().hex[:8]}"
+        trace_id = request.trace_id or http_request.headers.get("x-trace-id") or f"{PROJECT_NAME}-{uuid.uuid4().hex[:8]}"
+        new_messages = [msg.dict() for msg in request.messages]
+        history = []
+        budget = request.context_budget
+        store_key = session_key(http_request.headers, request.session_id) if request.session_id else None
+        if store_key:
+            # Unknown or expired sessions start empty; the response says how much history was used
+            history = session_store.get(store_key) or []
+            budget = session_budget(request)
+        messages, context_report = apply_context_budget(history + new_messages, budget)
+
+        # Count prompt tokens and reject/truncate before wasting a backend round-trip
+        prompt_estimate, max_tokens = check_context_length(messages, request.max_tokens)
         
         # Convert to OpenAI format
         openai_request = {
             "model": "qwen2.5-7b-it",
-            "messages": [msg.dict() for msg in request.messages],
-            "max_tokens": request.max_tokens,
+            "messages": messages,
+            "max_tokens": max_tokens,
             "temperature": request.temperature,
             "top_p": request.top_p
         }
         
-        # Forward to vLLM API
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{VLLM_API_URL}/v1/chat/completions",
-                json=openai_request,
-                timeout=60.0
+        # Forward to vLLM API (least-loaded backend, optionally hedged)
+        shadow_request = shadow_mirror.mirror("/v1/chat/completions", openai_request)
+        backend_load = backend_telemetry.capture()
+        try:
+            backend, response, hedged = await forward_chat(
+                openai_request, deadline, max_tokens, http_request, affinity=store_key
+            )
+        except ClientDisconnected:
+            trace_cancelled(
+                trace_id,
+                {
+                    "messages": trace_messages(messages, trace_id),
+                    "max_tokens": request.max_tokens,
+                    "temperature": request.temperature,
+                    "top_p": request.top_p
+                },
+                prompt_estimate, time.monotonic() - started, shadow_request, context_report,
+                openai_request["model"]
+            )
+            raise HTTPException(status_code=CLIENT_CLOSED_REQUEST, detail="Client closed request")
+        
+        if response.status_code == 200:
+            result = response.json()
+            
+            # Extract usage and response
+            response_content = ""
+            if result.get("choices") and len(result["choices"]) > 0:
+                response_content = result["choices"][0].get("message", {}).get("content", "")
+            usage = fill_usage(result.get("usage"), prompt_estimate, response_content)
+            cached_source, cached_estimate = cached_tokens_report(usage, backend, openai_request)
+            latency = time.monotonic() - started
+            usage_rollup.record(
+                PROJECT_NAME, openai_request["model"], backend.url,
+                usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
             )
+            track_heavy_hitters(http_request.headers, openai_request, usage)
+            request_capture.record("/v1/chat/completions", openai_request, response.status_code, latency, usage, trace_id)
+            if shadow_request is not None:
+                shadow_request.record_primary(latency, usage=usage)
+
+            session = None
+            if store_key:
+                # Stored already trimmed: what the budget dropped now is never sent again
+                turns = session_store.save(
+                    store_key, messages + [{"role": "assistant", "content": response_content}]
+                )
+                session = {"id": request.session_id, "history_messages": len(history), "turns": turns}
             
-            if response.status_code == 200:
-                result = response.json()
-                
-                # Extract usage and response
-                usage = result.get("usage", {})
-                response_content = ""
-                if result.get("choices") and len(result["choices"]) > 0:
-                    response_content = result["choices"][0].get("message", {}).get("content", "")
-                
-                # Send trace to Langfuse
-                try:
-                    langfuse.trace(
-                        id=trace_id,
-                        name=f"{PROJECT_NAME}-chat",
-                        input={
-                            "messages": [msg.dict() for msg in request.messages],
-                            "max_tokens": request.max_tokens,
-                            "temperature": request.temperature,
-                            "top_p": request.top_p
-                        },
-                        output={
-                            "response": response_content,
-                            "usage": usage
-                        },
-                        metadata={
-                            "project": PROJECT_NAME,
-                            "vllm_api": VLLM_API_URL
-                        }
-                    )
-                    langfuse.flush()
-                except Exception as e:
-                    logger.warning(f"Failed to send trace to Langfuse: {e}")
-                
-                return ChatResponse(
-                    response=response_content,
-                    usage=usage,
-                    trace_id=trace_id
+            # Send trace to Langfuse
+            try:
+                langfuse.trace(
+                    id=trace_id,
+                    name=f"{PROJECT_NAME}-chat",
+                    session_id=store_key,
+                    input={
+                        "messages": trace_messages(messages, trace_id),
+                        "max_tokens": request.max_tokens,
+                        "temperature": request.temperature,
+                        "top_p": request.top_p
+                    },
+                    output={
+                        "response": response_content,
+                        "usage": usage
+                    },
+                    metadata={
+                        "project": PROJECT_NAME,
+                        "model": openai_request["model"],
+                        "vllm_api": backend.url,
+                        "hedged": hedged,
+                        "prompt_tokens_estimate": prompt_estimate,
+                        "latency": round(latency, 4),
+                        "context": context_report,
+                        "backend_load": backend_load.get(backend.url),
+                        "cached_tokens_source": cached_source,
+                        "cached_tokens_estimate": cached_estimate,
+                        "session": session
+                    }
                 )
-            else:
-                raise HTTPException(status_code=response.status_code, detail=response.text)
-                
+                langfuse.flush()
+            except Exception as e:
+                logger.warning(f"Failed to send trace to Langfuse: {e}")
+            
+            return ChatResponse(
+                response=response_content,
+                usage=usage,
+                trace_id=trace_id,
+                context=context_report,
+                session=session
+            )
+        else:
+            raise HTTPException(status_code=response.status_code, detail=response.text)
+            
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in chat: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def estimate_prompt_tokens(request_body):
+    """Prompt tokens theo tokenizer của proxy cho chat (messages) hoặc completion (prompt)"""
+    if not isinstance(request_body, dict) or not token_counter.ready:
+        return None
+    if isinstance(request_body.get("messages"), list):
+        return token_counter.count_messages(request_body["messages"])
+    if isinstance(request_body.get("prompt"), str):
+        return token_counter.count_text(request_body["prompt"])
+    return None
+
+def trace_passthrough(path, trace_id, backend, body_capture, sniffer, status_code, latency, headers,
+                      context_report=None, backend_load=None, cancelled=False):
+    """Gửi trace cho pass-through request sau khi response đã stream xong (hoặc client đã disconnect)"""
+    usage, response_text = sniffer.finish()
+    request_body = body_capture.json()
+    usage = dict(usage or {})
+    if "completion_tokens" not in usage and sniffer.sse and sniffer.content_events:
+        # No final usage chunk (stream cut short): one token per event over the
+        # whole stream, not the tokenizer over the truncated response text
+        usage["completion_tokens"] = sniffer.content_events
+    usage = fill_usage(usage, estimate_prompt_tokens(request_body), response_text)
+    cached_source, cached_estimate = cached_tokens_report(usage, backend, request_body)
+    model = request_body.get("model") if isinstance(request_body, dict) else None
+    usage_rollup.record(
+        PROJECT_NAME, model, backend.url, usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+    )
+    track_heavy_hitters(headers, request_body, usage)
+
+    if isinstance(request_body, dict):
+        trace_input = build_trace_input(request_body)
+        if "messages" in trace_input:
+            trace_input["messages"] = trace_messages(trace_input["messages"], trace_id)
+        request_capture.record(f"/{path}", request_body, status_code, latency, usage, trace_id, streamed=sniffer.sse)
+    else:
+        trace_input = {"bytes": body_capture.size, "truncated": True}
+
+    try:
+        langfuse.trace(
+            id=trace_id,
+            name=f"{PROJECT_NAME}-{TRACED_ENDPOINTS[path]}",
+            input=trace_input,
+            output={
+                "response": response_text,
+                "usage": usage
+            },
+            metadata={
+                "project": PROJECT_NAME,
+                "model": model,
+                "vllm_api": backend.url,
+                "endpoint": f"/{path}",
+                "status_code": status_code,
+                "streamed": sniffer.sse,
+                "latency": round(latency, 4),
+                "context": context_report,
+                "backend_load": backend_load,
+                "cached_tokens_source": cached_source,
+                "cached_tokens_estimate": cached_estimate,
+                "cancelled": cancelled
+            },
+            tags=["cancelled"] if cancelled else None
+        )
+        langfuse.flush()
+    except Exception as e:
+        logger.warning(f"Failed to send trace to Langfuse: {e}")
+    return usage
+
+async def passthrough(request: Request, path, body=None, trace_id=None, context_report=None):
+    """Forward request tới backend và stream response về client, không buffer body.
+
+    `body` (bytes) dùng khi handler đã đọc body; nếu không request body được
+    stream thẳng lên backend. `context_report`: history đã bị cắt bởi context budget.
+    """
+    traced = path in TRACED_ENDPOINTS
+    trace_id = trace_id or request.headers.get("x-trace-id") or f"{PROJECT_NAME}-{uuid.uuid4().hex[:8]}"
+    body_capture = BoundedCapture(TRACE_CAPTURE_BYTES)
+    started = time.monotonic()
+    shadow_request = None
+    deadline = get_deadline(request)
+    timeout = UPSTREAM_TIMEOUT
+    if deadline is not None:
+        remaining = deadline - started
+        if remaining <= 0:
+            raise HTTPException(status_code=504, detail="Request deadline exceeded")
+        timeout = min(timeout, remaining)
+
+    def start_shadow():
+        # Mirrored once the full request body is known, while the primary is still running
+        nonlocal shadow_request
+        request_body = body_capture.json()
+        if traced and shadow_mirror.enabled and isinstance(request_body, dict):
+            shadow_request = shadow_mirror.mirror(f"/{path}", request_body)
+
+    # Streamed chat/completions: ask vLLM for the final usage chunk; the proxy
+    # drops it again when the client did not ask for it itself
+    strip_usage = False
+    if traced and path != "v1/embeddings" and request.method == "POST":
+        if body is None and 0 < int(request.headers.get("content-length") or 0) <= TRACE_CAPTURE_BYTES:
+            body = await request.body()
+        if body is not None:
+            body_capture.feed(body)
+            request_body = body_capture.json()
+            if request_stream_usage(request_body):
+                strip_usage = True
+                body = json.dumps(request_body).encode("utf-8")
+
+    headers = forward_headers(request.headers)
+    if deadline is not None:
+        # Propagate the remaining budget, not the client's original one
+        headers = {name: value for name, value in headers.items() if name.lower() != "x-deadline-ms"}
+        headers["X-Deadline-Ms"] = str(int(timeout * 1000))
+    if traced:
+        # The usage sniffer needs an uncompressed upstream body
+        headers["accept-encoding"] = "identity"
+    if body is not None:
+        headers.pop("content-length", None)
+        if not body_capture.size:
+            body_capture.feed(body)
+        content = body
+        start_shadow()
+    elif "content-length" in request.headers or "transfer-encoding" in request.headers:
+        async def content():
+            async for chunk in request.stream():
+                if traced:
+                    body_capture.feed(chunk)
+                yield chunk
+            start_shadow()
+        content = content()
+    else:
+        content = None
+
+    upstream_path = f"/{path}"
+    if request.url.query:
+        upstream_path += f"?{request.url.query}"
+
+    backend_load = backend_telemetry.capture()
+    stack = contextlib.AsyncExitStack()
+    try:
+        backend, upstream = await stack.enter_async_context(backend_pool.stream(
+            request.method, upstream_path, headers=headers, content=content, timeout=timeout
+        ))
+    except NoBackendAvailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except httpx.TimeoutException:
+        raise HTTPException(status_code=504, detail="Upstream request timed out")
+    except httpx.TransportError as e:
+        raise HTTPException(status_code=502, detail=f"Upstream connection error: {e}")
+
+    sniffer = UsageSniffer(upstream.headers.get("content-type"), strip_usage=strip_usage)
+
+    async def response_body():
+        ttft = None
+        usage = None
+        completed = False
+        expired = False
+        try:
+            # aiter_raw: relay bytes exactly as sent (no decompression, no re-chunking)
+            async for chunk in upstream.aiter_raw():
+                if ttft is None:
+                    ttft = time.monotonic() - started
+                if traced:
+                    chunk = sniffer.feed(chunk)
+                if chunk:
+                    yield chunk
+                # httpx timeouts are per read; the client stops waiting at the deadline
+                if deadline is not None and time.monotonic() >= deadline:
+                    expired = True
+                    break
+            if not expired:
+                tail = sniffer.flush()
+                if tail:
+                    yield tail
+            completed = not expired
+        finally:
+            # A client disconnect cancels this generator; closing the upstream
+            # response must still happen so vLLM aborts the generation
+            with anyio.CancelScope(shield=True):
+                await stack.aclose()
+            latency = time.monotonic() - started
+            if expired:
+                logger.info(f"Deadline exceeded, closed upstream stream: {trace_id}")
+            elif not completed:
+                logger.info(f"Client disconnected, closed upstream stream: {trace_id}")
+            if traced and upstream.status_code == 200:
+                usage = trace_passthrough(
+                    path, trace_id, backend, body_capture, sniffer, upstream.status_code, latency,
+                    request.headers, context_report, backend_load.get(backend.url), cancelled=not completed
+                )
+            if shadow_request is not None:
+                shadow_request.record_primary(
+                    latency, ttft if sniffer.sse else None, usage, ok=upstream.status_code == 200 and completed
+                )
+
+    response_headers = forward_headers(upstream.headers)
+    # uvicorn adds its own
+    response_headers.pop("date", None)
+    response_headers.pop("server", None)
+    if sniffer.strip_usage:
+        # The relayed body is shorter than the upstream one
+        response_headers.pop("content-length", None)
+    if traced:
+        response_headers["X-Trace-Id"] = trace_id
+    if context_report:
+        response_headers["X-Context-Dropped-Messages"] = str(context_report["dropped_messages"])
+        response_headers["X-Context-Dropped-Tokens"] = str(context_report["dropped_tokens"])
+    return StreamingResponse(
+        response_body(),
+        status_code=upstream.status_code,
+        headers=response_headers,
+        # Closes the upstream response even if the body is never iterated
+        background=BackgroundTask(stack.aclose)
+    )
+
+@app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "PATCH", "DELETE"])
+async def proxy_passthrough(path: str, request: Request):
+    """Catch-all: mọi endpoint khác của vLLM (/v1/completions, /v1/models, /v1/embeddings, /tokenize, ...)"""
+    return await passthrough(request, path)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000) 
\ No newline at end of file
@@ -0,0 +1,207 @@
+"""
+In-process Langfuse tracing
+ASGI middleware gắn Langfuse tracing trực tiếp vào OpenAI-compatible server
+(vLLM api_server, app/main.py, ...), không cần proxy hop: request body được
+đọc một lần, response đi thẳng tới client và usage được trích trong lúc
+stream, giống langfuse_proxy.py nhưng trong cùng process.
+
+vLLM OpenAI server:
+    python -m vllm.entrypoints.openai.api_server --model ... \\
+        --middleware langfuse_tracing.LangfuseTracingMiddleware
+
+FastAPI app có sẵn:
+    app.add_middleware(LangfuseTracingMiddleware, langfuse=langfuse, project="my-project")
+
+Cấu hình mặc định lấy từ environment giống proxy: LANGFUSE_PUBLIC_KEY,
+LANGFUSE_SECRET_KEY, LANGFUSE_HOST, PROJECT_NAME, TRACE_DEDUP.
+"""
+
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+
+from proxy_stream import UsageSniffer, request_stream_usage
+from proxy_dedup import MessageDeduplicator, langfuse_exporter
+
+logger = logging.getLogger(__name__)
+
+# Endpoints whose usage is traced -> trace name suffix
+TRACED_ENDPOINTS = {
+    "v1/chat/completions": "chat",
+    "v1/completions": "completion",
+    "v1/embeddings": "embeddings"
+}
+# Request fields kept as trace input
+TRACE_INPUT_KEYS = ("model", "messages", "prompt", "input", "max_tokens", "temperature", "top_p")
+
+def build_trace_input(request_body):
+    """Trace input từ request body đã parse (messages chưa dedup)"""
+    return {key: request_body[key] for key in TRACE_INPUT_KEYS if key in request_body}
+
+class LangfuseTracingMiddleware:
+    def __init__(self, app, langfuse=None, project=None, endpoints=None, dedup=None,
+                 max_body_size=None, stream_usage=None):
+        self.app = app
+        if langfuse is None:
+            from langfuse import Langfuse
+            langfuse = Langfuse(
+                public_key=os.getenv("LANGFUSE_PUBLIC_KEY", "default-public-key"),
+                secret_key=os.getenv("LANGFUSE_SECRET_KEY", "default-secret-key"),
+                host=os.getenv("LANGFUSE_HOST", "http://langfuse:3000")
+            )
+        self.langfuse = langfuse
+        self.project = project or os.getenv("PROJECT_NAME", "default-project")
+        self.endpoints = endpoints or TRACED_ENDPOINTS
+        if dedup is None and os.getenv("TRACE_DEDUP", "true").lower() == "true":
+            dedup = MessageDeduplicator(langfuse_exporter(self.langfuse, self.project))
+        self.dedup = dedup
+        # Larger bodies are still served, but traced without input
+        self.max_body_size = max_body_size or int(os.getenv("TRACE_CAPTURE_BYTES", str(256 * 1024)))
+        # Ask for the final usage chunk on streams, otherwise they carry no token counts
+        if stream_usage is None:
+            stream_usage = os.getenv("TRACE_STREAM_USAGE", "true").lower() == "true"
+        self.stream_usage = stream_usage
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.app(scope, self._lifespan_receive(receive), send)
+        elif (scope["type"] == "http" and scope["method"] == "POST"
+              and scope["path"].strip("/") in self.endpoints):
+            await self._traced(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+    def _lifespan_receive(self, receive):
+        async def wrapped():
+            message = await receive()
+            if message["type"] == "lifespan.shutdown":
+                # Traces are queued by the SDK; send what is left before exiting
+                await asyncio.to_thread(self.langfuse.flush)
+            return message
+        return wrapped
+
+    async def _traced(self, scope, receive, send):
+        started = time.monotonic()
+        path = scope["path"].strip("/")
+        headers = dict((name.lower(), value) for name, value in scope["headers"])
+
+        # The whole body is needed anyway by the endpoint; read it once here
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] != "http.request":
+                # Client went away before sending the body
+                return
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        body = b"".join(chunks)
+
+        request_body = None
+        changed = False
+        if len(body) <= self.max_body_size:
+            try:
+                request_body = json.loads(body)
+            except ValueError:
+                pass
+        trace_id = None
+        # Usage chunk added for tracing only: dropped before it reaches the client
+        strip_usage = False
+        if isinstance(request_body, dict):
+            # vLLM rejects unknown fields
+            trace_id = request_body.pop("trace_id", None)
+            changed = trace_id is not None
+            if self.stream_usage and request_stream_usage(request_body):
+                strip_usage = changed = True
+        if changed:
+            body = json.dumps(request_body).encode("utf-8")
+            scope = dict(scope)
+            scope["headers"] = [
+                (name, value) for name, value in scope["headers"] if name.lower() != b"content-length"
+            ] + [(b"content-length", str(len(body)).encode("latin-1"))]
+        trace_id = trace_id or headers.get(b"x-trace-id", b"").decode("latin-1") or \
+            f"{self.project}-{uuid.uuid4().hex[:8]}"
+
+        body_sent = False
+
+        async def replay_receive():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        response = {"status": None, "sniffer": None, "ttft": None}
+
+        async def traced_send(message):
+            if message["type"] == "http.response.start":
+                response_headers = dict((name.lower(), value) for name, value in message.get("headers", []))
+                response["status"] = message["status"]
+                response_headers_list = list(message.get("headers", []))
+                if b"content-encoding" not in response_headers:
+                    response["sniffer"] = UsageSniffer(
+                        response_headers.get(b"content-type", b"").decode("latin-1"), strip_usage=strip_usage
+                    )
+                    if response["sniffer"].strip_usage:
+                        # The relayed body is shorter than the app's
+                        response_headers_list = [
+                            (name, value) for name, value in response_headers_list if name.lower() != b"content-length"
+                        ]
+                message = {
+                    **message,
+                    "headers": response_headers_list + [(b"x-trace-id", trace_id.encode("latin-1"))]
+                }
+            elif message["type"] == "http.response.body":
+                chunk = message.get("body", b"")
+                if chunk and response["ttft"] is None:
+                    response["ttft"] = time.monotonic() - started
+                sniffer = response["sniffer"]
+                if sniffer is not None:
+                    chunk = sniffer.feed(chunk)
+                    if not message.get("more_body"):
+                        chunk += sniffer.flush()
+                    message = {**message, "body": chunk}
+            await send(message)
+
+        try:
+            await self.app(scope, replay_receive, traced_send)
+        finally:
+            if response["status"] == 200 and response["sniffer"] is not None:
+                self._trace(path, trace_id, request_body, len(body), response, time.monotonic() - started)
+
+    def _trace(self, path, trace_id, request_body, body_size, response, latency):
+        sniffer = response["sniffer"]
+        usage, response_text = sniffer.finish()
+        if isinstance(request_body, dict):
+            trace_input = build_trace_input(request_body)
+            if "messages" in trace_input and self.dedup is not None:
+                trace_input["messages"] = self.dedup.compact(trace_input["messages"], trace_id)
+        else:
+            trace_input = {"bytes": body_size, "truncated": True}
+
+        try:
+            self.langfuse.trace(
+                id=trace_id,
+                name=f"{self.project}-{self.endpoints[path]}",
+                input=trace_input,
+                output={
+                    "response": response_text,
+                    "usage": usage or {}
+                },
+                metadata={
+                    "project": self.project,
+                    "model": request_body.get("model") if isinstance(request_body, dict) else None,
+                    "endpoint": f"/{path}",
+                    "status_code": response["status"],
+                    "streamed": sniffer.sse,
+                    "latency": round(latency, 4),
+                    "ttft": None if response["ttft"] is None else round(response["ttft"], 4),
+                    "tracing": "in-process"
+                }
+            )
+            # No flush per request: the SDK sends batches from its own thread
+        except Exception as e:
+            logger.warning(f"Failed to send trace to Langfuse: {e}")
@@ -0,0 +1,260 @@
+"""
+LLM Client - Python client cho Langfuse proxy / vLLM API
+Sync (LLMClient) và asyncio (AsyncLLMClient) dùng chung connection pool,
+giới hạn số requests đồng thời, stream SSE theo từng event, tự retry
+429/503 (theo Retry-After, ngược lại exponential backoff có jitter) và
+truyền trace_id qua header X-Trace-Id.
+
+    with LLMClient("http://localhost:9000") as client:
+        result = client.chat([{"role": "user", "content": "Hello"}], max_tokens=100)
+        for event in client.stream_chat_completions(messages, model="Qwen/Qwen2.5-7B-Instruct"):
+            print(event["choices"][0]["delta"].get("content", ""), end="")
+
+    async with AsyncLLMClient("http://localhost:9000", max_concurrency=32) as client:
+        results = await asyncio.gather(*(client.chat(m) for m in batch))
+"""
+
+import os
+import json
+import time
+import uuid
+import random
+import asyncio
+import threading
+from email.utils import parsedate_to_datetime
+
+import httpx
+
+PROJECT_NAME = os.getenv("PROJECT_NAME", "default-project")
+MODEL_NAME = os.getenv("MODEL_NAME", "Qwen/Qwen2.5-7B-Instruct")
+
+RETRY_STATUS_CODES = (429, 503)
+
+class LLMClientError(Exception):
+    """Response lỗi (sau khi đã hết retries)"""
+
+    def __init__(self, status_code, detail, trace_id=None):
+        super().__init__(f"{status_code}: {detail}")
+        self.status_code = status_code
+        self.detail = detail
+        self.trace_id = trace_id
+
+def new_trace_id():
+    return f"{PROJECT_NAME}-{uuid.uuid4().hex[:8]}"
+
+def parse_retry_after(value):
+    """Retry-After là số giây hoặc HTTP-date; None nếu không parse được"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def parse_sse_line(line):
+    """Event dict cho một dòng "data: {...}", None cho dòng khác hoặc [DONE]"""
+    if not line.startswith("data:"):
+        return None
+    data = line[5:].strip()
+    if not data or data == "[DONE]":
+        return None
+    return json.loads(data)
+
+class _ClientBase:
+    def __init__(self, base_url, timeout, max_connections, max_concurrency,
+                 max_retries, backoff_base, backoff_max, model):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections
+        )
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.model = model
+
+    def _should_retry(self, response, attempt):
+        return response.status_code in RETRY_STATUS_CODES and attempt < self.max_retries
+
+    def _retry_delay(self, attempt, response=None):
+        retry_after = parse_retry_after(response.headers.get("retry-after")) if response is not None else None
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        # Full jitter: spreads retries from many callers hitting the same overloaded backend
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _chat_request(self, messages, trace_id, params):
+        return "/chat", {"messages": messages, "trace_id": trace_id, **params}
+
+    def _completions_request(self, messages, model, stream, params):
+        body = {"model": model or self.model, "messages": messages, **params}
+        if stream:
+            body["stream"] = True
+        return "/v1/chat/completions", body
+
+    @staticmethod
+    def _raise_for_status(response, trace_id):
+        if response.status_code >= 400:
+            try:
+                detail = response.json().get("detail", response.text)
+            except ValueError:
+                detail = response.text
+            raise LLMClientError(response.status_code, detail, trace_id)
+
+class LLMClient(_ClientBase):
+    """Blocking client; an toàn khi dùng chung giữa nhiều threads"""
+
+    def __init__(self, base_url="http://localhost:9000", timeout=60.0, max_connections=32,
+                 max_concurrency=16, max_retries=3, backoff_base=0.5, backoff_max=30.0, model=MODEL_NAME):
+        super().__init__(base_url, timeout, max_connections, max_concurrency,
+                         max_retries, backoff_base, backoff_max, model)
+        self._client = httpx.Client(base_url=self.base_url, timeout=timeout, limits=self.limits)
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._client.close()
+
+    def _send(self, method, path, trace_id, stream=False, **kwargs):
+        """Gửi request với retries; response trả về chưa đọc body khi stream=True"""
+        headers = {"X-Trace-Id": trace_id}
+        attempt = 0
+        while True:
+            try:
+                request = self._client.build_request(method, path, headers=headers, **kwargs)
+                response = self._client.send(request, stream=stream)
+            except httpx.ConnectError:
+                if attempt >= self.max_retries:
+                    raise
+                time.sleep(self._retry_delay(attempt))
+                attempt += 1
+                continue
+            if not self._should_retry(response, attempt):
+                return response
+            response.close()
+            time.sleep(self._retry_delay(attempt, response))
+            attempt += 1
+
+    def request(self, method, path, trace_id=None, **kwargs):
+        trace_id = trace_id or new_trace_id()
+        with self._semaphore:
+            response = self._send(method, path, trace_id, **kwargs)
+        self._raise_for_status(response, trace_id)
+        return response
+
+    def health(self):
+        return self.request("GET", "/health").json()
+
+    def chat(self, messages, trace_id=None, **params):
+        """POST /chat -> {"response", "usage", "trace_id"}"""
+        trace_id = trace_id or new_trace_id()
+        path, body = self._chat_request(messages, trace_id, params)
+        return self.request("POST", path, trace_id=trace_id, json=body).json()
+
+    def chat_completions(self, messages, model=None, trace_id=None, **params):
+        """POST /v1/chat/completions (OpenAI format), response có thêm trace_id"""
+        path, body = self._completions_request(messages, model, False, params)
+        return self.request("POST", path, trace_id=trace_id, json=body).json()
+
+    def stream_chat_completions(self, messages, model=None, trace_id=None, **params):
+        """Yield từng SSE event (dict) của /v1/chat/completions với stream=true"""
+        trace_id = trace_id or new_trace_id()
+        path, body = self._completions_request(messages, model, True, params)
+        # The concurrency slot is held until the stream is fully consumed or closed
+        with self._semaphore:
+            response = self._send("POST", path, trace_id, stream=True, json=body)
+            try:
+                if response.status_code >= 400:
+                    response.read()
+                    self._raise_for_status(response, trace_id)
+                for line in response.iter_lines():
+                    event = parse_sse_line(line)
+                    if event is not None:
+                        yield event
+            finally:
+                response.close()
+
+class AsyncLLMClient(_ClientBase):
+    """asyncio client; dùng một instance cho cả event loop"""
+
+    def __init__(self, base_url="http://localhost:9000", timeout=60.0, max_connections=64,
+                 max_concurrency=32, max_retries=3, backoff_base=0.5, backoff_max=30.0, model=MODEL_NAME):
+        super().__init__(base_url, timeout, max_connections, max_concurrency,
+                         max_retries, backoff_base, backoff_max, model)
+        self._client = httpx.AsyncClient(base_url=self.base_url, timeout=timeout, limits=self.limits)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        await self._client.aclose()
+
+    async def _send(self, method, path, trace_id, stream=False, **kwargs):
+        headers = {"X-Trace-Id": trace_id}
+        attempt = 0
+        while True:
+            try:
+                request = self._client.build_request(method, path, headers=headers, **kwargs)
+                response = await self._client.send(request, stream=stream)
+            except httpx.ConnectError:
+                if attempt >= self.max_retries:
+                    raise
+                await asyncio.sleep(self._retry_delay(attempt))
+                attempt += 1
+                continue
+            if not self._should_retry(response, attempt):
+                return response
+            await response.aclose()
+            await asyncio.sleep(self._retry_delay(attempt, response))
+            attempt += 1
+
+    async def request(self, method, path, trace_id=None, **kwargs):
+        trace_id = trace_id or new_trace_id()
+        async with self._semaphore:
+            response = await self._send(method, path, trace_id, **kwargs)
+        self._raise_for_status(response, trace_id)
+        return response
+
+    async def health(self):
+        return (await self.request("GET", "/health")).json()
+
+    async def chat(self, messages, trace_id=None, **params):
+        trace_id = trace_id or new_trace_id()
+        path, body = self._chat_request(messages, trace_id, params)
+        return (await self.request("POST", path, trace_id=trace_id, json=body)).json()
+
+    async def chat_completions(self, messages, model=None, trace_id=None, **params):
+        path, body = self._completions_request(messages, model, False, params)
+        return (await self.request("POST", path, trace_id=trace_id, json=body)).json()
+
+    async def stream_chat_completions(self, messages, model=None, trace_id=None, **params):
+        """Async iterator over SSE events"""
+        trace_id = trace_id or new_trace_id()
+        path, body = self._completions_request(messages, model, True, params)
+        async with self._semaphore:
+            response = await self._send("POST", path, trace_id, stream=True, json=body)
+            try:
+                if response.status_code >= 400:
+                    await response.aread()
+                    self._raise_for_status(response, trace_id)
+                async for line in response.aiter_lines():
+                    event = parse_sse_line(line)
+                    if event is not None:
+                        yield event
+            finally:
+                await response.aclose()
@@ -0,0 +1,77 @@
+"""
+Prefix-cache accounting
+Số prompt tokens được phục vụ từ prefix cache của vLLM, báo trong usage theo
+format của OpenAI (usage.prompt_tokens_details.cached_tokens). Khi engine hoặc
+backend không báo con số này (vLLM 0.5.x), PrefixCacheEstimator mô phỏng
+prefix cache: chuỗi hash các segments của prompt (token blocks trong
+app/main.py, messages trong proxy) trong một LRU giới hạn theo số tokens,
+giống cách vLLM chỉ tái sử dụng các full blocks của prefix chung.
+Dùng chung bởi app/main.py và langfuse_proxy.py.
+"""
+
+import hashlib
+from collections import OrderedDict
+
+# vLLM's default KV-cache block size; only full blocks are reused
+BLOCK_SIZE = 16
+
+def cached_tokens_from_usage(usage):
+    """cached_tokens từ usage kiểu OpenAI, None nếu backend không báo"""
+    details = (usage or {}).get("prompt_tokens_details") or {}
+    cached = details.get("cached_tokens")
+    return cached if isinstance(cached, int) else None
+
+def set_cached_tokens(usage, cached_tokens):
+    details = dict(usage.get("prompt_tokens_details") or {})
+    details["cached_tokens"] = cached_tokens
+    usage["prompt_tokens_details"] = details
+    return usage
+
+def token_blocks(token_ids, block_size=BLOCK_SIZE):
+    """Full blocks của prompt dưới dạng segments (key, tokens) cho PrefixCacheEstimator"""
+    return [
+        (tuple(token_ids[start:start + block_size]), block_size)
+        for start in range(0, len(token_ids) - block_size + 1, block_size)
+    ]
+
+class PrefixCacheEstimator:
+    def __init__(self, capacity_tokens, block_size=BLOCK_SIZE):
+        self.capacity_tokens = capacity_tokens
+        self.block_size = block_size
+        # chained prefix hash -> tokens of that segment, oldest first
+        self.entries = OrderedDict()
+        self.tokens = 0
+        self.lookups = 0
+        self.cached_tokens = 0
+
+    def observe(self, segments):
+        """Cached tokens của prompt gồm các `segments` [(key, tokens)], rồi ghi prompt vào cache"""
+        parent = b""
+        cached = 0
+        hit = True
+        for key, tokens in segments:
+            parent = hashlib.blake2b(parent + repr(key).encode("utf-8"), digest_size=16).digest()
+            if parent in self.entries:
+                self.entries.move_to_end(parent)
+                if hit:
+                    cached += tokens
+                continue
+            hit = False
+            self.entries[parent] = tokens
+            self.tokens += tokens
+        while self.tokens > self.capacity_tokens and self.entries:
+            _, tokens = self.entries.popitem(last=False)
+            self.tokens -= tokens
+
+        cached -= cached % self.block_size
+        self.lookups += 1
+        self.cached_tokens += cached
+        return cached
+
+    def stats(self):
+        return {
+            "capacity_tokens": self.capacity_tokens,
+            "tokens": self.tokens,
+            "lookups": self.lookups,
+            "cached_tokens": self.cached_tokens
+        }
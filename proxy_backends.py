@@ -0,0 +1,382 @@
+"""
+Backend pool cho Langfuse proxy
+Chọn vLLM backend ít tải nhất (requests đang chạy + queue depth từ /metrics), theo dõi latency từng backend và
+hỗ trợ hedged requests: nếu backend đầu chưa trả lời sau một delay theo
+percentile latency, gửi bản sao tới backend khác và hủy request chậm hơn.
+Một background prober kiểm tra /health của từng backend; circuit breaker mở
+sau nhiều lỗi liên tiếp để requests fail fast thay vì treo trên GPU đã chết.
+Requests của một conversation session có thể được gắn cố định vào một backend.
+"""
+
+import asyncio
+import contextlib
+import hashlib
+import logging
+import time
+from collections import deque
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Backend responses that mean "this backend is in trouble", not "bad request"
+FAILURE_STATUS_CODES = (502, 503, 504)
+
+class NoBackendAvailable(Exception):
+    """Tất cả backends đều đang open circuit (hoặc không có backend nào)"""
+
+class Backend:
+    """Một vLLM backend, latency gần đây và trạng thái circuit breaker của nó"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, url, window=256, failure_threshold=3, reset_timeout=10.0):
+        self.url = url.rstrip("/")
+        self.inflight = 0
+        self.latencies = deque(maxlen=window)
+        # Only requests that could be hedged (short, non-streaming) set the hedge delay
+        self.hedge_latencies = deque(maxlen=window)
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.trial_inflight = False
+        self.healthy = None
+        self.probe_latency = None
+        self.last_probe = None
+        self.last_error = None
+        # Latest vLLM /metrics snapshot (proxy_telemetry), None when unknown or stale
+        self.telemetry = None
+        self.telemetry_at = None
+
+    def load(self):
+        """Requests của proxy đang chạy trên backend + hàng đợi của vLLM (từ mọi clients)"""
+        waiting = (self.telemetry or {}).get("waiting") or 0
+        return self.inflight + waiting
+
+    def record_latency(self, seconds, hedgeable=False):
+        self.latencies.append(seconds)
+        if hedgeable:
+            self.hedge_latencies.append(seconds)
+
+    def available(self):
+        """Có nhận request không; open circuit chuyển sang half-open sau reset_timeout"""
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            self.trial_inflight = False
+            logger.info(f"Circuit half-open for {self.url}")
+        if self.state == self.HALF_OPEN:
+            return not self.trial_inflight
+        return self.state == self.CLOSED
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info(f"Circuit closed for {self.url}")
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.trial_inflight = False
+        self.last_error = None
+
+    def record_failure(self, error):
+        self.consecutive_failures += 1
+        self.last_error = str(error) or type(error).__name__
+        self.trial_inflight = False
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(f"Circuit open for {self.url}: {self.last_error}")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def stats(self):
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "circuit": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "last_error": self.last_error,
+            "probe_latency": self.probe_latency,
+            "last_probe_age": None if self.last_probe is None else time.monotonic() - self.last_probe,
+            "inflight": self.inflight,
+            "queue_waiting": (self.telemetry or {}).get("waiting"),
+            "kv_cache_usage": (self.telemetry or {}).get("kv_cache_usage"),
+            "latency_p50": percentile(self.latencies, 50),
+            "latency_p95": percentile(self.latencies, 95),
+            "hedgeable_latency_p95": percentile(self.hedge_latencies, 95)
+        }
+
+def affinity_score(key, url):
+    """Rendezvous hashing: backend có score cao nhất cho `key` nhận mọi request của key đó"""
+    return hashlib.blake2b(f"{key}\0{url}".encode("utf-8"), digest_size=8).digest()
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+class HedgeBudget:
+    """Token bucket: mỗi request thường nạp `ratio` token, mỗi hedge tốn 1 token.
+
+    Giữ số hedge <= ratio * số requests (cộng một burst nhỏ), nên hedging không
+    thể nhân đôi tải lên backends.
+    """
+
+    def __init__(self, ratio, burst):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+        self.requests = 0
+        self.hedges = 0
+
+    def on_request(self):
+        self.requests += 1
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def try_acquire(self):
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.hedges += 1
+            return True
+        return False
+
+class BackendPool:
+    """Gửi requests tới nhiều vLLM backends qua một httpx client dùng chung"""
+
+    def __init__(self, urls, hedge_percentile=95, hedge_min_delay=0.05,
+                 hedge_max_ratio=0.1, hedge_burst=5, failure_threshold=3,
+                 reset_timeout=10.0, probe_interval=5.0, probe_timeout=2.0):
+        self.backends = [
+            Backend(url, failure_threshold=failure_threshold, reset_timeout=reset_timeout)
+            for url in urls
+        ]
+        self.client = None
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self._probe_task = None
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_budget = HedgeBudget(hedge_max_ratio, hedge_burst)
+        self._next = 0
+
+    async def start(self):
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=100)
+        )
+        self._probe_task = asyncio.create_task(self._probe_loop())
+
+    async def close(self):
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+        if self.client is not None:
+            await self.client.aclose()
+
+    async def _probe(self, backend):
+        start = time.monotonic()
+        try:
+            response = await self.client.get(f"{backend.url}/health", timeout=self.probe_timeout)
+            backend.last_probe = time.monotonic()
+            backend.probe_latency = backend.last_probe - start
+            backend.healthy = response.status_code == 200
+            if backend.healthy:
+                # Only a closed or half-open circuit may be closed by a probe;
+                # an open one waits for reset_timeout like real traffic does
+                if backend.state != Backend.OPEN:
+                    backend.record_success()
+            else:
+                backend.record_failure(f"health check returned {response.status_code}")
+        except Exception as e:
+            backend.last_probe = time.monotonic()
+            backend.healthy = False
+            backend.record_failure(e)
+
+    async def _probe_loop(self):
+        while True:
+            # available() moves expired open circuits to half-open so the probe acts as the trial
+            for backend in self.backends:
+                backend.available()
+            await asyncio.gather(*(self._probe(b) for b in self.backends))
+            await asyncio.sleep(self.probe_interval)
+
+    def pick(self, exclude=(), affinity=None):
+        """Backend khả dụng có load thấp nhất (round-robin khi bằng nhau).
+
+        Với `affinity` (session id), cùng một key luôn tới cùng backend để tận
+        dụng prefix cache của nó; khi backend đó không khả dụng chỉ các keys
+        của nó chuyển sang backend khác.
+        """
+        candidates = [b for b in self.backends if b not in exclude and b.available()]
+        if not candidates:
+            return None
+        if affinity is not None:
+            return max(candidates, key=lambda b: affinity_score(affinity, b.url))
+        self._next = (self._next + 1) % len(candidates)
+        rotated = candidates[self._next:] + candidates[:self._next]
+        # Queue depth is only comparable when every candidate reports it
+        if all(b.telemetry is not None for b in candidates):
+            return min(rotated, key=lambda b: b.load())
+        return min(rotated, key=lambda b: b.inflight)
+
+    def healthy(self):
+        return any(b.available() for b in self.backends)
+
+    def hedge_delay(self):
+        """Percentile latency của các hedgeable requests; long generations không làm delay phình ra"""
+        latencies = [x for b in self.backends for x in b.hedge_latencies]
+        delay = percentile(latencies, self.hedge_percentile)
+        if delay is None:
+            return None
+        return max(self.hedge_min_delay, delay)
+
+    async def _send(self, backend, method, path, headers, timeout, hedgeable=False, **kwargs):
+        if backend.state == Backend.HALF_OPEN:
+            backend.trial_inflight = True
+        backend.inflight += 1
+        start = time.monotonic()
+        try:
+            response = await self.client.request(
+                method, f"{backend.url}{path}", headers=headers, timeout=timeout, **kwargs
+            )
+        except httpx.TransportError as e:
+            backend.record_failure(e)
+            raise
+        except asyncio.CancelledError:
+            # Cancelled hedge loser: say nothing about the backend's health
+            backend.trial_inflight = False
+            raise
+        finally:
+            backend.inflight -= 1
+
+        if response.status_code in FAILURE_STATUS_CODES:
+            backend.record_failure(f"HTTP {response.status_code}")
+        else:
+            backend.record_success()
+            if response.status_code < 500:
+                backend.record_latency(time.monotonic() - start, hedgeable)
+        return backend, response
+
+    @contextlib.asynccontextmanager
+    async def stream(self, method, path, headers=None, content=None, timeout=60.0):
+        """Mở streaming request tới backend khả dụng, yield (backend, response).
+
+        Body không được buffer nên không retry/hedge được; response được đóng
+        khi thoát context.
+        """
+        backend = self.pick()
+        if backend is None:
+            raise NoBackendAvailable("no healthy vLLM backend available")
+        if backend.state == Backend.HALF_OPEN:
+            backend.trial_inflight = True
+        backend.inflight += 1
+        try:
+            request = self.client.build_request(
+                method, f"{backend.url}{path}", headers=headers, content=content, timeout=timeout
+            )
+            try:
+                response = await self.client.send(request, stream=True)
+            except httpx.TransportError as e:
+                backend.record_failure(e)
+                raise
+            except asyncio.CancelledError:
+                backend.trial_inflight = False
+                raise
+
+            if response.status_code in FAILURE_STATUS_CODES:
+                backend.record_failure(f"HTTP {response.status_code}")
+            else:
+                backend.record_success()
+            try:
+                yield backend, response
+            finally:
+                await response.aclose()
+        finally:
+            backend.inflight -= 1
+
+    async def request(self, method, path, headers=None, timeout=60.0, hedge=False, hedgeable=None,
+                      affinity=None, **kwargs):
+        """Gửi request tới backend khả dụng, có thể hedge sang backend thứ hai.
+
+        Returns (backend, response, hedged). Lỗi kết nối (request chưa tới
+        backend) được thử lại trên backend khác. `hedgeable`: request thuộc
+        loại có thể hedge (mặc định = `hedge`), latency của nó dùng cho
+        hedge_delay(). `affinity`: xem pick(). Raises NoBackendAvailable khi
+        mọi circuit đều open.
+        """
+        if hedgeable is None:
+            hedgeable = hedge
+        self.hedge_budget.on_request()
+        deadline = time.monotonic() + timeout
+        tried = set()
+        while True:
+            primary = self.pick(exclude=tried, affinity=affinity)
+            if primary is None:
+                raise NoBackendAvailable("no healthy vLLM backend available")
+            tried.add(primary)
+            try:
+                return await self._request_once(
+                    primary, method, path, headers, deadline, hedge, hedgeable, **kwargs
+                )
+            except httpx.ConnectError as e:
+                logger.warning(f"Cannot connect to {primary.url}, trying another backend: {e}")
+                if time.monotonic() >= deadline:
+                    raise
+
+    async def _request_once(self, primary, method, path, headers, deadline, hedge, hedgeable, **kwargs):
+        """Returns (backend, response, hedged). Request thua cuộc bị cancel, httpx
+        đóng connection nên vLLM abort generation đó.
+        """
+        timeout = max(0.0, deadline - time.monotonic())
+        hedged = False
+        error = None
+        fallback = None
+        tasks = {asyncio.create_task(self._send(primary, method, path, headers, timeout, hedgeable, **kwargs))}
+        try:
+            if hedge and len(self.backends) > 1:
+                delay = self.hedge_delay()
+                if delay is not None and delay < timeout:
+                    done, _ = await asyncio.wait(tasks, timeout=delay)
+                    secondary = self.pick(exclude=(primary,))
+                    if not done and secondary is not None and self.hedge_budget.try_acquire():
+                        remaining = max(0.0, deadline - time.monotonic())
+                        logger.info(f"Hedging request to {secondary.url} after {delay:.3f}s")
+                        tasks.add(asyncio.create_task(
+                            self._send(secondary, method, path, headers, remaining, hedgeable, **kwargs)
+                        ))
+                        hedged = True
+
+            while tasks:
+                remaining = deadline - time.monotonic()
+                done, tasks = await asyncio.wait(
+                    tasks, timeout=max(0.0, remaining), return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    raise httpx.ReadTimeout("request deadline exceeded")
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    backend, response = task.result()
+                    # A 5xx from one backend is only returned if the other one fails too
+                    if response.status_code >= 500:
+                        fallback = (backend, response)
+                        continue
+                    return backend, response, hedged
+            if fallback is not None:
+                return fallback[0], fallback[1], hedged
+            raise error
+        finally:
+            # Cancelling the loser closes its connection so vLLM aborts the generation
+            for task in tasks:
+                task.cancel()
+
+    def stats(self):
+        return {
+            "healthy": self.healthy(),
+            "backends": [b.stats() for b in self.backends],
+            "hedge_delay": self.hedge_delay(),
+            "requests": self.hedge_budget.requests,
+            "hedges": self.hedge_budget.hedges
+        }
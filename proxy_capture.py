@@ -0,0 +1,77 @@
+"""
+Request capture cho Langfuse proxy
+Ghi mỗi request đã trace (body đầy đủ, latency, usage) thành một dòng JSONL
+để replay_traffic.py có thể phát lại traffic thật. Ghi file trong background
+thread; khi queue đầy entry bị bỏ (và được đếm) thay vì làm chậm requests.
+"""
+
+import json
+import queue
+import logging
+import threading
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+class RequestCapture:
+    def __init__(self, path, max_queue=10000):
+        self.path = path
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.recorded = 0
+        self.dropped = 0
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def start(self):
+        if not self.enabled or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._writer, name="request-capture", daemon=True)
+        self._thread.start()
+        logger.info(f"Capturing requests to {self.path}")
+
+    def record(self, endpoint, body, status_code, latency, usage, trace_id, streamed=False):
+        if not self.enabled:
+            return
+        entry = {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "endpoint": endpoint,
+            "body": body,
+            "status_code": status_code,
+            "latency": round(latency, 4),
+            "usage": usage,
+            "trace_id": trace_id,
+            "streamed": streamed
+        }
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def _writer(self):
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                entry = self.queue.get()
+                if entry is None:
+                    return
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                self.recorded += 1
+                # Flush once the backlog is drained so a crash loses little
+                if self.queue.empty():
+                    f.flush()
+
+    def close(self):
+        if self._thread is not None:
+            self.queue.put(None)
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "recorded": self.recorded,
+            "dropped": self.dropped,
+            "queued": self.queue.qsize()
+        }
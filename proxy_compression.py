@@ -0,0 +1,299 @@
+"""
+Compressed transport cho Langfuse proxy
+ASGI middleware: giải nén request bodies gzip/deflate/zstd theo từng chunk (có
+giới hạn kích thước, kể cả giữa chừng một chunk), và nén responses theo
+Accept-Encoding của client (bỏ qua responses nhỏ).
+"""
+
+import zlib
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import JSONResponse, PlainTextResponse
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIBLE_TYPES = ("application/json", "text/", "application/x-ndjson")
+# Output produced per decompression step; bounds memory used beyond max_request_size
+DECODE_STEP_SIZE = 64 * 1024
+
+class BodyTooLarge(Exception):
+    """Body giải nén vượt giới hạn (dừng trước khi giải nén hết)"""
+
+class _ZlibDecoder:
+    def __init__(self, wbits):
+        self._decoder = zlib.decompressobj(wbits)
+
+    def decompress(self, data, limit, final):
+        """Tối đa `limit` bytes đã giải nén, giải nén từng bước DECODE_STEP_SIZE"""
+        chunks = []
+        total = 0
+        step_full = False
+        # Output may still be pending after the input is consumed when a step filled up
+        while data or step_full:
+            # max_length=0 means unlimited, so always ask for at least one byte
+            step = max(1, min(DECODE_STEP_SIZE, limit - total + 1))
+            chunk = self._decoder.decompress(data, step)
+            total += len(chunk)
+            if total > limit:
+                raise BodyTooLarge()
+            chunks.append(chunk)
+            data = self._decoder.unconsumed_tail
+            step_full = len(chunk) == step
+        if final:
+            chunk = self._decoder.flush()
+            total += len(chunk)
+            if total > limit:
+                raise BodyTooLarge()
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+class _BoundedSink:
+    """Nhận output của zstd stream_writer, raise ngay khi vượt limit"""
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+        self.limit = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.limit:
+            raise BodyTooLarge()
+        self.chunks.append(data)
+        return len(data)
+
+class _ZstdDecoder:
+    def __init__(self):
+        self._sink = _BoundedSink()
+        # Output reaches the sink DECODE_STEP_SIZE bytes at a time
+        self._writer = zstandard.ZstdDecompressor().stream_writer(self._sink, write_size=DECODE_STEP_SIZE)
+
+    def decompress(self, data, limit, final):
+        self._sink.chunks, self._sink.size, self._sink.limit = [], 0, limit
+        self._writer.write(data)
+        if final:
+            self._writer.flush()
+        return b"".join(self._sink.chunks)
+
+def make_decoder(encoding):
+    """Streaming decoder có giới hạn cho Content-Encoding, None nếu không hỗ trợ"""
+    if encoding in ("gzip", "x-gzip"):
+        return _ZlibDecoder(16 + zlib.MAX_WBITS)
+    if encoding == "deflate":
+        return _ZlibDecoder(zlib.MAX_WBITS)
+    if encoding == "zstd" and zstandard is not None:
+        return _ZstdDecoder()
+    return None
+
+def supported_encodings():
+    return ("zstd", "gzip") if zstandard is not None else ("gzip",)
+
+def choose_encoding(accept_encoding):
+    """Encoding tốt nhất mà client chấp nhận (q > 0), ưu tiên zstd rồi gzip"""
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name.strip().lower()] = quality
+    for encoding in supported_encodings():
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+class _Encoder:
+    def __init__(self, encoding, level):
+        if encoding == "zstd":
+            self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+            self._sync_flush = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        else:
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self._sync_flush = zlib.Z_SYNC_FLUSH
+
+    def compress(self, data, final):
+        if final:
+            return self._compressor.compress(data) + self._compressor.flush()
+        # Sync flush so streamed chunks (e.g. SSE tokens) reach the client immediately
+        return self._compressor.compress(data) + self._compressor.flush(self._sync_flush)
+
+class _DecompressingBody:
+    """Giải nén request body cho app; body hỏng (400) hoặc quá lớn (413) được
+    trả lời trực tiếp từ middleware thay cho response của app.
+
+    App chỉ thấy http.disconnect nên không đọc được body lỗi, dù handler bắt
+    exception theo kiểu nào.
+    """
+
+    def __init__(self, receive, send, decoder, max_size):
+        self._receive = receive
+        self._send = send
+        self.decoder = decoder
+        self.max_size = max_size
+        self.total = 0
+        self.error = None
+        self.response_started = False
+
+    async def receive(self):
+        if self.error is not None:
+            return {"type": "http.disconnect"}
+        message = await self._receive()
+        if message["type"] != "http.request":
+            return message
+        final = not message.get("more_body", False)
+        try:
+            body = self.decoder.decompress(message.get("body", b""), self.max_size - self.total, final)
+        except BodyTooLarge:
+            self.error = (413, "Decompressed request body too large")
+            return {"type": "http.disconnect"}
+        except Exception as e:
+            self.error = (400, f"Invalid compressed body: {e}")
+            return {"type": "http.disconnect"}
+        self.total += len(body)
+        return {**message, "body": body}
+
+    async def send(self, message):
+        # The app's reaction to the broken body (usually a 500) is replaced by send_error
+        if self.error is not None and not self.response_started:
+            return
+        if message["type"] == "http.response.start":
+            self.response_started = True
+        await self._send(message)
+
+    async def send_error(self, scope):
+        if self.error is None or self.response_started:
+            return
+        self.response_started = True
+        status_code, detail = self.error
+        await JSONResponse({"detail": detail}, status_code=status_code)(scope, self._receive, self._send)
+
+class CompressionMiddleware:
+    """Giải nén request bodies và nén responses đủ lớn"""
+
+    def __init__(self, app, minimum_size=1024, max_request_size=64 * 1024 * 1024,
+                 gzip_level=6, zstd_level=3):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.max_request_size = max_request_size
+        self.levels = {"gzip": gzip_level, "zstd": zstd_level}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        content_encoding = headers.get("content-encoding", "identity").strip().lower()
+        if content_encoding != "identity":
+            decoder = make_decoder(content_encoding)
+            if decoder is None:
+                response = PlainTextResponse(
+                    f"Unsupported Content-Encoding: {content_encoding}", status_code=415
+                )
+                await response(scope, receive, send)
+                return
+            scope = dict(scope)
+            request_headers = MutableHeaders(scope=scope)
+            del request_headers["content-encoding"]
+            # The decoded length is unknown up front
+            if "content-length" in request_headers:
+                del request_headers["content-length"]
+            request_headers["transfer-encoding"] = "chunked"
+            body = _DecompressingBody(receive, send, decoder, self.max_request_size)
+            receive, send = body.receive, body.send
+        else:
+            body = None
+
+        encoding = choose_encoding(headers.get("accept-encoding", ""))
+        if encoding is not None:
+            send = _CompressingSend(send, encoding, self.levels[encoding], self.minimum_size)
+
+        try:
+            await self.app(scope, receive, send)
+        except Exception:
+            # Failing on the disconnect we reported is expected; anything else propagates
+            if body is None or body.error is None:
+                raise
+        if body is not None:
+            await body.send_error(scope)
+
+class _CompressingSend:
+    """Wrap ASGI send: quyết định nén khi thấy body chunk đầu tiên"""
+
+    def __init__(self, send, encoding, level, minimum_size):
+        self.send = send
+        self.encoding = encoding
+        self.level = level
+        self.minimum_size = minimum_size
+        self.start_message = None
+        self.encoder = None
+        self.passthrough = False
+
+    def _should_compress(self, headers, body, more_body):
+        if "content-encoding" in headers:
+            return False
+        content_type = headers.get("content-type", "")
+        if not any(content_type.startswith(t) for t in COMPRESSIBLE_TYPES) and "event-stream" not in content_type:
+            return False
+        # Small bodies are not worth the CPU; streams of unknown length are always compressed
+        if "content-length" in headers:
+            return int(headers["content-length"]) >= self.minimum_size
+        return more_body or len(body) >= self.minimum_size
+
+    async def __call__(self, message):
+        if message["type"] == "http.response.start":
+            self.start_message = message
+            return
+        if message["type"] != "http.response.body":
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        if self.start_message is not None:
+            start, self.start_message = self.start_message, None
+            headers = MutableHeaders(raw=start["headers"])
+            if self._should_compress(headers, body, more_body):
+                self.encoder = _Encoder(self.encoding, self.level)
+                headers["content-encoding"] = self.encoding
+                headers.add_vary_header("Accept-Encoding")
+                if "content-length" in headers:
+                    del headers["content-length"]
+            else:
+                self.passthrough = True
+            await self.send(start)
+
+        if self.passthrough:
+            await self.send(message)
+            return
+
+        await self.send({
+            "type": "http.response.body",
+            "body": self.encoder.compress(body, final=not more_body),
+            "more_body": more_body
+        })
+
+def enable_langfuse_gzip(langfuse):
+    """Gửi ingestion batches của Langfuse SDK dạng gzip.
+
+    SDK 2.x đã hỗ trợ gzip trong LangfuseClient.post nhưng task manager luôn
+    gọi batch_post(gzip=False); client được chia sẻ với mọi consumer thread
+    nên chỉ cần wrap một chỗ. Langfuse server (hoặc reverse proxy phía trước)
+    phải chấp nhận Content-Encoding: gzip.
+    """
+    client = langfuse.task_manager._client
+    batch_post = client.batch_post
+
+    def gzip_batch_post(gzip=False, **kwargs):
+        return batch_post(gzip=True, **kwargs)
+
+    client.batch_post = gzip_batch_post
@@ -0,0 +1,137 @@
+"""
+Content-addressed dedup cho trace inputs
+Multi-turn chats gửi lại toàn bộ history mỗi request; lần đầu thấy một message
+proxy export nội dung của nó lên một trace riêng cho hash đó (content trace,
+id có namespace ngẫu nhiên nên client không ghi đè được), các lần sau thay bằng
+reference {"ref": <hash>, "trace_id": <content trace>}. reassemble() khôi phục
+input đầy đủ từ các references (dùng bởi langfuse_cli.py --full-input).
+"""
+
+import json
+import uuid
+import hashlib
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Tag of content traces, so the traces list API can filter them
+CONTENT_TRACE_TAG = "dedup-content"
+
+def message_hash(message):
+    """Hash của toàn bộ message (role, content, các field khác)"""
+    payload = json.dumps(message, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+def is_reference(message):
+    return isinstance(message, dict) and "ref" in message and "content" not in message
+
+def is_content_trace(trace):
+    """Content trace của dedup (chỉ chứa một message), không phải một request"""
+    metadata = trace.get("metadata") or {}
+    return bool(metadata.get("dedup_content")) or CONTENT_TRACE_TAG in (trace.get("tags") or [])
+
+def langfuse_exporter(langfuse, project):
+    """export(content_trace_id, message) ghi message lên content trace của nó"""
+    def export(content_trace_id, message):
+        langfuse.trace(
+            id=content_trace_id,
+            name=f"{project}-message",
+            input={"messages": [message]},
+            metadata={"project": project, "dedup_content": True},
+            tags=[CONTENT_TRACE_TAG]
+        )
+    return export
+
+class MessageDeduplicator:
+    """Bounded LRU của message hashes đã export -> content trace chứa nội dung đầy đủ"""
+
+    def __init__(self, export, cache_size=100000, min_chars=64):
+        self.export = export
+        self.cache_size = cache_size
+        self.min_chars = min_chars
+        # Content trace ids are never accepted from clients: the per-process
+        # namespace keeps them from being guessed and overwritten
+        self.namespace = uuid.uuid4().hex[:12]
+        self.exported = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.export_errors = 0
+
+    def content_trace_id(self, digest):
+        return f"msg-{self.namespace}-{digest}"
+
+    def compact(self, messages, trace_id):
+        """Messages cho trace input: nội dung đầy đủ lần đầu, reference các lần sau"""
+        compacted = []
+        for message in messages:
+            content = message.get("content") if isinstance(message, dict) else None
+            # Short messages cost less than a reference
+            if content is None or len(json.dumps(content, ensure_ascii=False)) < self.min_chars:
+                compacted.append(message)
+                continue
+
+            digest = message_hash(message)
+            source = self.exported.get(digest)
+            if source is not None:
+                self.exported.move_to_end(digest)
+                self.hits += 1
+                compacted.append({"role": message.get("role"), "ref": digest, "trace_id": source})
+                continue
+
+            self.misses += 1
+            source = self.content_trace_id(digest)
+            try:
+                self.export(source, {**message, "hash": digest})
+            except Exception as e:
+                # Not marked exported: the next request carries the content again
+                self.export_errors += 1
+                logger.warning(f"Failed to export message {digest} for trace {trace_id}: {e}")
+            else:
+                self.exported[digest] = source
+                if len(self.exported) > self.cache_size:
+                    self.exported.popitem(last=False)
+            compacted.append(message)
+        return compacted
+
+    def stats(self):
+        return {
+            "entries": len(self.exported),
+            "cache_size": self.cache_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "export_errors": self.export_errors
+        }
+
+def reassemble(messages, fetch_trace):
+    """Thay references bằng message đầy đủ.
+
+    `fetch_trace(trace_id)` trả về trace dict (hoặc None). Returns
+    (messages, missing) với missing là các hashes không tìm được nội dung.
+    """
+    resolved = {}
+    missing = []
+    result = []
+    for message in messages:
+        if not is_reference(message):
+            if isinstance(message, dict) and "hash" in message:
+                message = {key: value for key, value in message.items() if key != "hash"}
+            result.append(message)
+            continue
+
+        digest = message["ref"]
+        if digest not in resolved:
+            source = fetch_trace(message.get("trace_id")) if message.get("trace_id") else None
+            source_input = (source or {}).get("input")
+            source_messages = source_input.get("messages") if isinstance(source_input, dict) else None
+            for candidate in source_messages or []:
+                if isinstance(candidate, dict) and candidate.get("hash") and "content" in candidate:
+                    resolved[candidate["hash"]] = {
+                        key: value for key, value in candidate.items() if key != "hash"
+                    }
+        if digest in resolved:
+            result.append(resolved[digest])
+        else:
+            missing.append(digest)
+            result.append(message)
+    return result, missing
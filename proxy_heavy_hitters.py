@@ -0,0 +1,167 @@
+"""
+Heavy-hitter detection cho Langfuse proxy
+Count-min sketch + top-K candidates trên sliding windows, cho từng dimension
+(project, user/API key, system-prompt hash). Memory cố định: mỗi window là
+một ring các sketches width x depth, candidates giới hạn ở capacity, không
+phụ thuộc số keys khác nhau.
+"""
+
+import time
+import hashlib
+from array import array
+
+DEFAULT_WINDOWS = {
+    # name -> (bucket width in seconds, number of buckets)
+    "minute": (10, 6),
+    "hour": (300, 12)
+}
+DIMENSIONS = ("project", "user", "system_prompt")
+
+class CountMinSketch:
+    def __init__(self, width=2048, depth=4):
+        if not 1 <= depth <= 16:
+            raise ValueError("depth must be between 1 and 16")
+        self.width = width
+        self.depth = depth
+        self.rows = [array("q", [0]) * width for _ in range(depth)]
+
+    def indexes(self, key):
+        """Một cell mỗi row; tính một lần rồi dùng cho mọi sketch cùng kích thước"""
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=4 * self.depth).digest()
+        return [
+            int.from_bytes(digest[4 * row:4 * row + 4], "little") % self.width
+            for row in range(self.depth)
+        ]
+
+    def add(self, indexes, count):
+        for row, index in zip(self.rows, indexes):
+            row[index] += count
+
+    def estimate(self, indexes):
+        return min(row[index] for row, index in zip(self.rows, indexes))
+
+    def clear(self):
+        self.rows = [array("q", [0]) * self.width for _ in range(self.depth)]
+
+class SlidingSketch:
+    """Ring các sketches theo bucket thời gian; estimate = tổng các bucket còn trong window"""
+
+    def __init__(self, bucket_width, size, width, depth):
+        self.bucket_width = bucket_width
+        self.size = size
+        self.starts = [None] * size
+        self.sketches = [CountMinSketch(width, depth) for _ in range(size)]
+        self.totals = [0] * size
+
+    def _live(self, now):
+        oldest = int(now // self.bucket_width) * self.bucket_width - (self.size - 1) * self.bucket_width
+        return [
+            index for index, start in enumerate(self.starts)
+            if start is not None and start >= oldest
+        ]
+
+    def indexes(self, key):
+        return self.sketches[0].indexes(key)
+
+    def add(self, ts, indexes, count):
+        start = int(ts // self.bucket_width) * self.bucket_width
+        index = (start // self.bucket_width) % self.size
+        if self.starts[index] != start:
+            self.starts[index] = start
+            self.sketches[index].clear()
+            self.totals[index] = 0
+        self.sketches[index].add(indexes, count)
+        self.totals[index] += count
+
+    def estimate(self, indexes, now):
+        return sum(self.sketches[index].estimate(indexes) for index in self._live(now))
+
+    def total(self, now):
+        return sum(self.totals[index] for index in self._live(now))
+
+class HeavyHitters:
+    """Top token consumers theo từng dimension và window"""
+
+    def __init__(self, windows=None, width=2048, depth=4, top_k=10, candidate_factor=4):
+        self.top_k = top_k
+        self.capacity = top_k * candidate_factor
+        self.sketches = {
+            dimension: {
+                name: SlidingSketch(bucket_width, size, width, depth)
+                for name, (bucket_width, size) in (windows or DEFAULT_WINDOWS).items()
+            }
+            for dimension in DIMENSIONS
+        }
+        # dimension -> window -> {key: last estimate}
+        self.candidates = {
+            dimension: {name: {} for name in self.sketches[dimension]}
+            for dimension in DIMENSIONS
+        }
+        # Human-readable labels (e.g. system prompt preview), only kept for candidates
+        self.labels = {}
+
+    @property
+    def windows(self):
+        return list(self.sketches[DIMENSIONS[0]])
+
+    def record(self, keys, tokens, labels=None, ts=None):
+        """keys: {dimension: key}; tokens: prompt + completion tokens của request"""
+        if not tokens:
+            return
+        ts = time.time() if ts is None else ts
+        for dimension, key in keys.items():
+            indexes = None
+            for name, sketch in self.sketches[dimension].items():
+                indexes = indexes or sketch.indexes(key)
+                sketch.add(ts, indexes, tokens)
+                candidates = self.candidates[dimension][name]
+                estimate = sketch.estimate(indexes, ts)
+                if key in candidates or len(candidates) < self.capacity:
+                    candidates[key] = estimate
+                else:
+                    smallest = min(candidates, key=candidates.get)
+                    if estimate > candidates[smallest]:
+                        del candidates[smallest]
+                        candidates[key] = estimate
+                if labels and key in candidates and dimension in labels:
+                    self.labels[(dimension, key)] = labels[dimension]
+        self._prune_labels()
+
+    def _prune_labels(self):
+        if len(self.labels) <= self.capacity * len(DIMENSIONS) * len(self.windows):
+            return
+        live = {
+            (dimension, key)
+            for dimension, windows in self.candidates.items()
+            for candidates in windows.values()
+            for key in candidates
+        }
+        self.labels = {item: label for item, label in self.labels.items() if item in live}
+
+    def top(self, window="minute", k=None, now=None):
+        now = time.time() if now is None else now
+        k = k or self.top_k
+        report = {"window": window, "dimensions": {}}
+        for dimension in DIMENSIONS:
+            sketch = self.sketches[dimension][window]
+            candidates = self.candidates[dimension][window]
+            # Re-estimate: buckets may have expired since the candidate was last seen
+            for key in list(candidates):
+                candidates[key] = sketch.estimate(sketch.indexes(key), now)
+                if not candidates[key]:
+                    del candidates[key]
+            total = sketch.total(now)
+            ranked = sorted(candidates.items(), key=lambda item: item[1], reverse=True)[:k]
+            report["dimensions"][dimension] = {
+                "total_tokens": total,
+                "top": [
+                    {
+                        "key": key,
+                        "label": self.labels.get((dimension, key)),
+                        "tokens": estimate,
+                        "share": round(min(estimate, total) / total, 4) if total else None
+                    }
+                    for key, estimate in ranked
+                ]
+            }
+        return report
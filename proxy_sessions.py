@@ -0,0 +1,232 @@
+"""
+Server-side conversation sessions cho Langfuse proxy
+Client gửi session_id và chỉ các messages mới thay vì toàn bộ history; proxy
+giữ history trong một LRU giới hạn theo số sessions, tổng bytes và thời gian
+không hoạt động (TTL), rồi ghép lại prompt đầy đủ trước khi gửi tới backend.
+Khi có persist_dir, mỗi session được ghi thành một file JSON (trong background
+thread) và được load lại khi proxy restart. Các turns của cùng một session
+được chạy tuần tự (turn()) để không turn nào đọc history cũ hoặc ghi đè lên nhau.
+"""
+
+import os
+import json
+import time
+import queue
+import asyncio
+import contextlib
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from context_budget import trim_messages
+
+logger = logging.getLogger(__name__)
+
+def message_size(message):
+    return len(json.dumps(message, ensure_ascii=False).encode("utf-8"))
+
+class Session:
+    __slots__ = ("session_id", "messages", "size", "turns", "last_used")
+
+    def __init__(self, session_id, messages=(), turns=0, last_used=None):
+        self.session_id = session_id
+        self.messages = list(messages)
+        self.size = sum(message_size(message) for message in self.messages)
+        self.turns = turns
+        self.last_used = last_used if last_used is not None else time.time()
+
+    def to_dict(self):
+        return {
+            "session_id": self.session_id,
+            "messages": self.messages,
+            "turns": self.turns,
+            "last_used": self.last_used
+        }
+
+class SessionStore:
+    def __init__(self, max_sessions=10000, max_bytes=256 * 1024 * 1024, ttl=3600.0, persist_dir="",
+                 max_session_bytes=1024 * 1024):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        # Per-session cap: oldest turns are dropped (system prompt kept) beyond it
+        self.max_session_bytes = max_session_bytes
+        self.ttl = ttl
+        self.persist_dir = persist_dir
+        # session_id -> Session, least recently used first
+        self.sessions = OrderedDict()
+        self.bytes = 0
+        self.evicted = 0
+        self.expired = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        # session_id -> [lock, waiters]; dropped when no turn holds or waits for it
+        self._locks = {}
+
+    def _path(self, session_id):
+        digest = hashlib.sha256(session_id.encode("utf-8")).hexdigest()[:32]
+        return os.path.join(self.persist_dir, f"{digest}.json")
+
+    def load(self):
+        """Load các sessions còn hạn từ persist_dir (gọi một lần lúc startup)"""
+        if not self.persist_dir:
+            return
+        os.makedirs(self.persist_dir, exist_ok=True)
+        now = time.time()
+        loaded = []
+        for name in os.listdir(self.persist_dir):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.persist_dir, name)
+            try:
+                with open(path, encoding="utf-8") as f:
+                    data = json.load(f)
+                session = Session(data["session_id"], data["messages"], data.get("turns", 0), data["last_used"])
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logger.warning(f"Skipping unreadable session file {path}: {e}")
+                continue
+            if now - session.last_used > self.ttl:
+                with contextlib.suppress(OSError):
+                    os.remove(path)
+                continue
+            loaded.append(session)
+        for session in sorted(loaded, key=lambda s: s.last_used):
+            self.sessions[session.session_id] = session
+            self.bytes += session.size
+        self._evict()
+        logger.info(f"Loaded {len(self.sessions)} sessions from {self.persist_dir}")
+
+    def start(self):
+        if not self.persist_dir or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._writer, name="session-store", daemon=True)
+        self._thread.start()
+
+    def _writer(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            path, payload = item
+            try:
+                if payload is None:
+                    if os.path.exists(path):
+                        os.remove(path)
+                    continue
+                # Write then rename so a crash never leaves a half-written session
+                tmp_path = f"{path}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(payload)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logger.warning(f"Failed to persist session to {path}: {e}")
+
+    def _persist(self, session):
+        if self._thread is not None:
+            self._queue.put((self._path(session.session_id), json.dumps(session.to_dict(), ensure_ascii=False)))
+
+    def _remove(self, session_id):
+        session = self.sessions.pop(session_id)
+        self.bytes -= session.size
+        if self._thread is not None:
+            self._queue.put((self._path(session_id), None))
+
+    def _evict(self):
+        now = time.time()
+        # Least recently used first, so expired sessions are at the front
+        while self.sessions:
+            session_id, session = next(iter(self.sessions.items()))
+            if now - session.last_used > self.ttl:
+                self.expired += 1
+            elif len(self.sessions) > self.max_sessions or self.bytes > self.max_bytes:
+                self.evicted += 1
+            else:
+                break
+            self._remove(session_id)
+
+    def get(self, session_id):
+        """History của session (list messages), None nếu chưa có, đã hết hạn hoặc bị evict"""
+        self._evict()
+        session = self.sessions.get(session_id)
+        if session is None:
+            return None
+        session.last_used = time.time()
+        self.sessions.move_to_end(session_id)
+        return list(session.messages)
+
+    @contextlib.asynccontextmanager
+    async def turn(self, session_id):
+        """Chạy các turns của một session lần lượt: get() ... save() không bị xen kẽ"""
+        entry = self._locks.get(session_id)
+        if entry is None:
+            entry = self._locks[session_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[session_id]
+
+    def save(self, session_id, messages):
+        """Ghi history mới của session sau một turn (history đã cắt + turn mới + assistant reply).
+
+        Returns số turns của session.
+        """
+        messages, dropped, _ = trim_messages(messages, self.max_session_bytes, message_size)
+        if dropped:
+            logger.info(f"Session {session_id}: dropped {dropped} old messages over {self.max_session_bytes} bytes")
+        session = self.sessions.get(session_id)
+        if session is None:
+            session = self.sessions[session_id] = Session(session_id)
+        self.bytes -= session.size
+        session.messages = list(messages)
+        session.size = sum(message_size(message) for message in session.messages)
+        session.turns += 1
+        session.last_used = time.time()
+        self.bytes += session.size
+        self.sessions.move_to_end(session_id)
+        self._evict()
+        if session_id in self.sessions:
+            self._persist(session)
+        return session.turns
+
+    def info(self, session_id):
+        """Thông tin session (không tính là dùng session), None nếu chưa có, đã hết hạn hoặc bị evict"""
+        self._evict()
+        session = self.sessions.get(session_id)
+        if session is None:
+            return None
+        return {
+            "session_id": session_id,
+            "messages": len(session.messages),
+            "turns": session.turns,
+            "bytes": session.size,
+            "idle": round(time.time() - session.last_used, 3)
+        }
+
+    def delete(self, session_id):
+        if session_id not in self.sessions:
+            return False
+        self._remove(session_id)
+        return True
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def stats(self):
+        return {
+            "sessions": len(self.sessions),
+            "bytes": self.bytes,
+            "max_sessions": self.max_sessions,
+            "max_bytes": self.max_bytes,
+            "max_session_bytes": self.max_session_bytes,
+            "ttl": self.ttl,
+            "evicted": self.evicted,
+            "expired": self.expired,
+            "persist_dir": self.persist_dir or None
+        }
@@ -0,0 +1,162 @@
+"""
+Shadow traffic cho Langfuse proxy
+Mirror một phần requests tới candidate backend (vLLM version/model mới),
+fire-and-forget: response của shadow bị bỏ, lỗi hoặc chậm của shadow không
+ảnh hưởng primary. Mỗi cặp primary/shadow được ghi lại để so sánh latency,
+TTFT và tokens side-by-side.
+"""
+
+import json
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+
+import httpx
+
+from proxy_backends import percentile
+from proxy_stream import UsageSniffer
+
+logger = logging.getLogger(__name__)
+
+STREAMABLE_PATHS = ("/v1/chat/completions", "/v1/completions")
+
+class ShadowRequest:
+    """Một request được mirror; kết quả của primary và shadow được ghép khi cả hai xong"""
+
+    def __init__(self, mirror, path):
+        self.mirror = mirror
+        self.path = path
+        self.primary = None
+        self.shadow = None
+
+    def record_primary(self, latency, ttft=None, usage=None, ok=True):
+        self.primary = {"latency": latency, "ttft": ttft, "usage": usage or {}, "ok": ok}
+        self.mirror._pair(self)
+
+    def record_shadow(self, latency, ttft=None, usage=None, ok=True):
+        self.shadow = {"latency": latency, "ttft": ttft, "usage": usage or {}, "ok": ok}
+        self.mirror._pair(self)
+
+class ShadowMirror:
+    def __init__(self, url, fraction=0.1, max_inflight=4, timeout=120.0, model=None, window=1000):
+        self.url = url.rstrip("/") if url else ""
+        self.fraction = fraction
+        self.max_inflight = max_inflight
+        self.timeout = timeout
+        self.model = model
+        self.samples = deque(maxlen=window)
+        self.client = None
+        self.inflight = 0
+        self.tasks = set()
+        self.mirrored = 0
+        self.dropped = 0
+        self.errors = 0
+
+    @property
+    def enabled(self):
+        return bool(self.url) and self.fraction > 0
+
+    async def start(self):
+        if self.enabled:
+            # Own pool so a slow candidate can never hold connections the primary needs
+            limits = httpx.Limits(max_connections=self.max_inflight, max_keepalive_connections=self.max_inflight)
+            self.client = httpx.AsyncClient(base_url=self.url, timeout=self.timeout, limits=limits)
+            logger.info(f"Mirroring {self.fraction:.0%} of traffic to shadow backend {self.url}")
+
+    async def close(self):
+        for task in list(self.tasks):
+            task.cancel()
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def mirror(self, path, body):
+        """Bắt đầu shadow request nếu được sample; returns ShadowRequest hoặc None"""
+        if self.client is None or random.random() >= self.fraction:
+            return None
+        if self.inflight >= self.max_inflight:
+            self.dropped += 1
+            return None
+        shadow_body = {key: value for key, value in body.items() if key != "trace_id"}
+        if self.model:
+            shadow_body["model"] = self.model
+        if path in STREAMABLE_PATHS:
+            # Streaming lets us measure TTFT on the shadow side
+            shadow_body["stream"] = True
+            shadow_body["stream_options"] = {"include_usage": True}
+
+        request = ShadowRequest(self, path)
+        self.inflight += 1
+        self.mirrored += 1
+        task = asyncio.create_task(self._send(request, json.dumps(shadow_body).encode("utf-8")))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return request
+
+    async def _send(self, request, content):
+        started = time.monotonic()
+        ttft = None
+        try:
+            async with self.client.stream(
+                "POST", request.path, content=content, headers={"Content-Type": "application/json"}
+            ) as response:
+                sniffer = UsageSniffer(response.headers.get("content-type"))
+                async for chunk in response.aiter_raw():
+                    if ttft is None:
+                        ttft = time.monotonic() - started
+                    sniffer.feed(chunk)
+                usage, _ = sniffer.finish()
+                ok = response.status_code == 200
+            if not ok:
+                self.errors += 1
+            request.record_shadow(time.monotonic() - started, ttft, usage, ok=ok)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.errors += 1
+            logger.debug(f"Shadow request failed: {e}")
+            request.record_shadow(time.monotonic() - started, ttft, ok=False)
+        finally:
+            self.inflight -= 1
+
+    def _pair(self, request):
+        if request.primary is None or request.shadow is None:
+            return
+        if request.primary["ok"] and request.shadow["ok"]:
+            self.samples.append((request.path, request.primary, request.shadow))
+
+    def stats(self):
+        def summary(results):
+            latencies = [result["latency"] for result in results]
+            ttfts = [result["ttft"] for result in results if result["ttft"] is not None]
+            completion = [result["usage"].get("completion_tokens") or 0 for result in results]
+            decode_rates = [
+                tokens / result["latency"]
+                for tokens, result in zip(completion, results)
+                if result["latency"] > 0 and tokens
+            ]
+            return {
+                "latency_p50": percentile(latencies, 50),
+                "latency_p95": percentile(latencies, 95),
+                "ttft_p50": percentile(ttfts, 50),
+                "ttft_p95": percentile(ttfts, 95),
+                "completion_tokens_avg": sum(completion) / len(completion) if completion else None,
+                "tokens_per_second_p50": percentile(decode_rates, 50)
+            }
+
+        samples = list(self.samples)
+        return {
+            "enabled": self.enabled,
+            "url": self.url,
+            "fraction": self.fraction,
+            "max_inflight": self.max_inflight,
+            "inflight": self.inflight,
+            "mirrored": self.mirrored,
+            "dropped_over_capacity": self.dropped,
+            "shadow_errors": self.errors,
+            "paired_samples": len(samples),
+            "primary": summary([primary for _, primary, _ in samples]),
+            "shadow": summary([shadow for _, _, shadow in samples])
+        }
@@ -0,0 +1,192 @@
+"""
+Streaming pass-through helpers cho Langfuse proxy
+Forward request/response bodies theo từng chunk (không buffer toàn bộ) và
+trích usage từ response trong khi stream, với memory giới hạn.
+"""
+
+import json
+
+# Hop-by-hop headers (RFC 7230) plus the ones httpx/uvicorn recompute themselves
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailer", "trailers", "transfer-encoding", "upgrade", "host"
+}
+
+def forward_headers(headers):
+    """Bỏ hop-by-hop headers, giữ nguyên phần còn lại"""
+    return {
+        name: value
+        for name, value in headers.items()
+        if name.lower() not in HOP_BY_HOP_HEADERS
+    }
+
+def request_stream_usage(request_body):
+    """Bật stream_options.include_usage cho streamed request để response có usage chunk.
+
+    Returns True nếu proxy tự bật (client không yêu cầu): usage chunk đó
+    phải bị bỏ khỏi response (UsageSniffer(strip_usage=True)).
+    """
+    if not isinstance(request_body, dict) or not request_body.get("stream"):
+        return False
+    stream_options = request_body.get("stream_options") or {}
+    if stream_options.get("include_usage"):
+        return False
+    request_body["stream_options"] = {**stream_options, "include_usage": True}
+    return True
+
+class BoundedCapture:
+    """Giữ tối đa `limit` bytes đầu của một body để trace; phần còn lại chỉ được đếm"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.chunks = []
+        self.captured = 0
+        self.size = 0
+
+    def feed(self, chunk):
+        self.size += len(chunk)
+        if self.captured < self.limit:
+            piece = chunk[:self.limit - self.captured]
+            self.chunks.append(piece)
+            self.captured += len(piece)
+
+    @property
+    def complete(self):
+        return self.size == self.captured
+
+    def json(self):
+        """Body đã parse nếu được capture đầy đủ, ngược lại None"""
+        if not self.complete or not self.size:
+            return None
+        try:
+            return json.loads(b"".join(self.chunks))
+        except ValueError:
+            return None
+
+class UsageSniffer:
+    """Trích usage (và một phần response text) từ response đang stream qua proxy.
+
+    - SSE (text/event-stream): parse từng event "data: {...}", lấy usage của
+      event có usage và ghép delta content tối đa `text_limit` ký tự. Với
+      strip_usage, feed() trả về stream đã bỏ usage chunk ("choices": []) mà
+      client không yêu cầu.
+    - JSON: giữ head (để parse cả body khi nhỏ) và tail (usage là key cuối
+      trong response của vLLM), nên memory không phụ thuộc kích thước body.
+    """
+
+    def __init__(self, content_type, head_limit=256 * 1024, tail_limit=64 * 1024, text_limit=16 * 1024,
+                 strip_usage=False):
+        self.sse = "text/event-stream" in (content_type or "")
+        self.strip_usage = strip_usage and self.sse
+        self.head = BoundedCapture(head_limit)
+        self.tail = b""
+        self.tail_limit = tail_limit
+        self.text_limit = text_limit
+        self.text_parts = []
+        self.text_length = 0
+        self.usage = None
+        # SSE events that carried generated text (~ one token each on vLLM)
+        self.content_events = 0
+        self._pending = b""
+
+    def feed(self, chunk):
+        """Sniff một chunk, returns bytes cần forward cho client"""
+        if self.strip_usage:
+            return self._feed_events(chunk)
+        if self.sse:
+            self._pending += chunk
+            *lines, self._pending = self._pending.split(b"\n")
+            for line in lines:
+                self._handle_sse_line(line.strip())
+            # An absurdly long line without newline would otherwise grow forever
+            if len(self._pending) > self.tail_limit:
+                self._pending = b""
+        else:
+            self.head.feed(chunk)
+            self.tail = (self.tail + chunk)[-self.tail_limit:]
+        return chunk
+
+    def _feed_events(self, chunk):
+        # Whole events are needed to drop one; vLLM separates them with a blank line
+        self._pending += chunk
+        *events, self._pending = self._pending.split(b"\n\n")
+        forwarded = []
+        for event in events:
+            if not self._handle_sse_event(event):
+                forwarded.append(event + b"\n\n")
+        # An absurdly long event is never a usage chunk: relay what we have
+        if len(self._pending) > self.tail_limit:
+            forwarded.append(self._pending)
+            self._pending = b""
+        return b"".join(forwarded)
+
+    def _handle_sse_event(self, event):
+        """Sniff một SSE event, returns True nếu đó là usage chunk cần bỏ"""
+        usage_only = False
+        for line in event.split(b"\n"):
+            parsed = self._handle_sse_line(line.strip())
+            if isinstance(parsed, dict) and parsed.get("usage") and not parsed.get("choices"):
+                usage_only = True
+        return usage_only
+
+    def flush(self):
+        """Bytes còn giữ lại khi stream kết thúc (chỉ với strip_usage)"""
+        if not self.strip_usage or not self._pending:
+            return b""
+        pending, self._pending = self._pending, b""
+        return b"" if self._handle_sse_event(pending) else pending
+
+    def _append_text(self, text):
+        if text and self.text_length < self.text_limit:
+            text = text[:self.text_limit - self.text_length]
+            self.text_parts.append(text)
+            self.text_length += len(text)
+
+    def _handle_sse_line(self, line):
+        if not line.startswith(b"data:"):
+            return None
+        data = line[5:].strip()
+        if not data or data == b"[DONE]":
+            return None
+        try:
+            event = json.loads(data)
+        except ValueError:
+            return None
+        if not isinstance(event, dict):
+            return None
+        if event.get("usage"):
+            self.usage = event["usage"]
+        for choice in event.get("choices") or []:
+            delta = choice.get("delta") or {}
+            text = delta.get("content") or choice.get("text")
+            if text:
+                self.content_events += 1
+            self._append_text(text)
+        return event
+
+    def finish(self):
+        """Returns (usage or None, response_text)"""
+        if self.sse:
+            if self._pending:
+                self._handle_sse_event(self._pending)
+                self._pending = b""
+            return self.usage, "".join(self.text_parts)
+
+        body = self.head.json()
+        if isinstance(body, dict):
+            for choice in body.get("choices") or []:
+                message = choice.get("message") or {}
+                self._append_text(message.get("content") or choice.get("text"))
+            return body.get("usage"), "".join(self.text_parts)
+
+        # Large body: find the last "usage" object in the tail
+        index = self.tail.rfind(b'"usage"')
+        if index >= 0:
+            start = self.tail.find(b"{", index)
+            if start >= 0:
+                try:
+                    usage, _ = json.JSONDecoder().raw_decode(self.tail[start:].decode("utf-8", "ignore"))
+                    return usage, ""
+                except ValueError:
+                    pass
+        return None, ""
@@ -0,0 +1,105 @@
+"""
+vLLM telemetry cho Langfuse proxy
+Background collector scrape /metrics (Prometheus text format) của từng
+backend theo chu kỳ ngắn, giữ snapshot mới nhất trên Backend: queue depth
+được dùng khi chọn backend, và snapshot lúc request bắt đầu được gắn vào
+trace metadata.
+"""
+
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# vLLM metric -> (snapshot key, how to combine several label sets)
+VLLM_METRICS = {
+    "vllm:num_requests_running": ("running", sum),
+    "vllm:num_requests_waiting": ("waiting", sum),
+    "vllm:num_requests_swapped": ("swapped", sum),
+    "vllm:gpu_cache_usage_perc": ("kv_cache_usage", max),
+    "vllm:cpu_cache_usage_perc": ("cpu_cache_usage", max),
+    "vllm:gpu_prefix_cache_hit_rate": ("prefix_cache_hit_rate", max),
+    "vllm:avg_prompt_throughput_toks_per_s": ("prompt_tokens_per_s", sum),
+    "vllm:avg_generation_throughput_toks_per_s": ("generation_tokens_per_s", sum)
+}
+# Subset attached to each trace
+TRACE_KEYS = ("running", "waiting", "kv_cache_usage", "prefix_cache_hit_rate")
+
+def parse_metrics(text, metrics=VLLM_METRICS):
+    """Giá trị của các metrics cần dùng từ Prometheus text exposition"""
+    values = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        name_part, _, value = line.rpartition(" ")
+        name = name_part.split("{", 1)[0].strip()
+        if name not in metrics:
+            continue
+        try:
+            values.setdefault(name, []).append(float(value))
+        except ValueError:
+            continue
+    return {
+        metrics[name][0]: metrics[name][1](samples)
+        for name, samples in values.items()
+    }
+
+class TelemetryCollector:
+    def __init__(self, pool, interval=2.0, timeout=1.0):
+        self.pool = pool
+        self.interval = interval
+        self.timeout = timeout
+        self._task = None
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    def start(self):
+        if self.enabled:
+            self._task = asyncio.create_task(self._loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _scrape(self, backend):
+        try:
+            response = await self.pool.client.get(f"{backend.url}/metrics", timeout=self.timeout)
+            response.raise_for_status()
+            backend.telemetry = parse_metrics(response.text)
+            backend.telemetry_at = time.monotonic()
+        except Exception as e:
+            # A stale snapshot is worse than none for routing
+            backend.telemetry = None
+            logger.debug(f"Metrics scrape failed for {backend.url}: {e}")
+
+    async def _loop(self):
+        while True:
+            await asyncio.gather(*(self._scrape(b) for b in self.pool.backends))
+            await asyncio.sleep(self.interval)
+
+    def capture(self):
+        """Snapshot gọn (TRACE_KEYS) của mọi backend, lấy lúc request bắt đầu"""
+        return {
+            backend.url: {key: backend.telemetry.get(key) for key in TRACE_KEYS}
+            for backend in self.pool.backends
+            if backend.telemetry is not None
+        }
+
+    def snapshot(self):
+        now = time.monotonic()
+        return {
+            "enabled": self.enabled,
+            "interval": self.interval,
+            "backends": [
+                {
+                    "url": backend.url,
+                    "age": None if backend.telemetry_at is None else now - backend.telemetry_at,
+                    "metrics": backend.telemetry
+                }
+                for backend in self.pool.backends
+            ]
+        }
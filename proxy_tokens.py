@@ -0,0 +1,98 @@
+"""
+Token counting cho Langfuse proxy
+Load tokenizer của model một lần, đếm prompt tokens với LRU cache theo hash
+của từng message để system prompt lặp lại không phải tokenize lại.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# ChatML framing per message: <|im_start|>, role, "\n", <|im_end|>, "\n"
+TOKENS_PER_MESSAGE = 5
+# Assistant reply priming appended by the chat template: <|im_start|>assistant\n
+TOKENS_PER_REPLY = 3
+
+class TokenCounter:
+    """Đếm tokens bằng tokenizer của model được serve"""
+
+    def __init__(self, model_name, max_model_len, cache_size=4096):
+        self.model_name = model_name
+        self.max_model_len = max_model_len
+        self.cache_size = cache_size
+        self.tokenizer = None
+        self._load_task = None
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def start(self):
+        """Load tokenizer trong background thread; đếm tokens được bỏ qua tới khi ready"""
+        if self._load_task is None:
+            self._load_task = asyncio.create_task(asyncio.to_thread(self.load))
+
+    def load(self):
+        """Load tokenizer (blocking; gọi một lần lúc startup)"""
+        try:
+            from transformers import AutoTokenizer
+        except ImportError:
+            logger.warning("transformers is not installed, proxy token counting disabled")
+            return False
+
+        try:
+            self.tokenizer = AutoTokenizer.from_pretrained(self.model_name, trust_remote_code=True)
+            logger.info(f"Tokenizer loaded for {self.model_name} (max_model_len={self.max_model_len})")
+            return True
+        except Exception as e:
+            logger.warning(f"Failed to load tokenizer for {self.model_name}: {e}")
+            return False
+
+    @property
+    def ready(self):
+        return self.tokenizer is not None
+
+    def count_text(self, text):
+        if not self.ready or not text:
+            return 0
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def count_message(self, message):
+        """Tokens của một message kể cả overhead của chat template (cached)"""
+        content = message.get("content") or ""
+        if not isinstance(content, str):
+            # OpenAI content parts (list of dicts) - count their JSON form
+            content = json.dumps(content, ensure_ascii=False)
+        key = hashlib.sha1(f"{message.get('role', '')}\0{content}".encode("utf-8")).digest()
+
+        count = self._cache.get(key)
+        if count is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return count
+
+        self.misses += 1
+        count = self.count_text(content) + TOKENS_PER_MESSAGE
+        self._cache[key] = count
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return count
+
+    def count_messages(self, messages):
+        """Số prompt tokens (ước lượng theo chat template), None nếu chưa có tokenizer"""
+        if not self.ready:
+            return None
+        return sum(self.count_message(message) for message in messages) + TOKENS_PER_REPLY
+
+    def stats(self):
+        return {
+            "model": self.model_name,
+            "ready": self.ready,
+            "max_model_len": self.max_model_len,
+            "cache_entries": len(self._cache),
+            "cache_hits": self.hits,
+            "cache_misses": self.misses
+        }
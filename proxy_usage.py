@@ -0,0 +1,116 @@
+"""
+Usage rollups cho Langfuse proxy
+Tổng hợp requests / prompt tokens / completion tokens theo phút, giờ, ngày
+cho từng (project, model, backend) trong ring buffers kích thước cố định,
+để xem token burn hiện tại mà không cần query Langfuse.
+"""
+
+import time
+from datetime import datetime, timezone
+
+# name -> (bucket width in seconds, number of buckets kept)
+DEFAULT_WINDOWS = {
+    "minute": (60, 60),
+    "hour": (3600, 48),
+    "day": (86400, 30)
+}
+
+class RingBuffer:
+    """N buckets cố định; bucket cũ bị ghi đè khi thời gian quay vòng"""
+
+    def __init__(self, width, size):
+        self.width = width
+        self.size = size
+        self.starts = [None] * size
+        self.buckets = [None] * size
+
+    def _slot(self, ts):
+        start = int(ts // self.width) * self.width
+        index = (start // self.width) % self.size
+        if self.starts[index] != start:
+            self.starts[index] = start
+            self.buckets[index] = {}
+        return self.buckets[index]
+
+    def add(self, ts, key, prompt_tokens, completion_tokens):
+        counters = self._slot(ts).setdefault(key, [0, 0, 0])
+        counters[0] += 1
+        counters[1] += prompt_tokens
+        counters[2] += completion_tokens
+
+    def snapshot(self, now):
+        """Buckets còn nằm trong cửa sổ, cũ nhất trước"""
+        oldest = int(now // self.width) * self.width - (self.size - 1) * self.width
+        live = [
+            (start, bucket)
+            for start, bucket in zip(self.starts, self.buckets)
+            if start is not None and start >= oldest
+        ]
+        return sorted(live, key=lambda item: item[0])
+
+class UsageRollup:
+    """Rolling aggregates theo project, model và backend"""
+
+    def __init__(self, windows=None):
+        self.windows = {
+            name: RingBuffer(width, size)
+            for name, (width, size) in (windows or DEFAULT_WINDOWS).items()
+        }
+
+    def record(self, project, model, backend, prompt_tokens, completion_tokens, ts=None):
+        ts = time.time() if ts is None else ts
+        key = (project, model, backend)
+        for ring in self.windows.values():
+            ring.add(ts, key, prompt_tokens or 0, completion_tokens or 0)
+
+    def report(self, window="minute", now=None):
+        now = time.time() if now is None else now
+        ring = self.windows[window]
+        buckets = []
+        totals = {}
+        for start, bucket in ring.snapshot(now):
+            rows = []
+            for (project, model, backend), (requests, prompt, completion) in bucket.items():
+                rows.append({
+                    "project": project,
+                    "model": model,
+                    "backend": backend,
+                    "requests": requests,
+                    "prompt_tokens": prompt,
+                    "completion_tokens": completion,
+                    "total_tokens": prompt + completion
+                })
+                total = totals.setdefault(project, {
+                    "requests": 0, "prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0
+                })
+                total["requests"] += requests
+                total["prompt_tokens"] += prompt
+                total["completion_tokens"] += completion
+                total["total_tokens"] += prompt + completion
+            buckets.append({
+                "start": datetime.fromtimestamp(start, tz=timezone.utc).isoformat(),
+                "rows": rows
+            })
+        return {
+            "window": window,
+            "bucket_seconds": ring.width,
+            "span_seconds": ring.width * ring.size,
+            "projects": totals,
+            "buckets": buckets
+        }
+
+    def report_text(self, window="minute", now=None):
+        report = self.report(window, now)
+        lines = [f"usage window={window} bucket={report['bucket_seconds']}s span={report['span_seconds']}s"]
+        for project, total in report["projects"].items():
+            lines.append(
+                f"TOTAL {project} req={total['requests']} in={total['prompt_tokens']} "
+                f"out={total['completion_tokens']} total={total['total_tokens']}"
+            )
+        for bucket in report["buckets"]:
+            for row in bucket["rows"]:
+                lines.append(
+                    f"{bucket['start']} {row['project']} {row['model']} {row['backend']} "
+                    f"req={row['requests']} in={row['prompt_tokens']} out={row['completion_tokens']}"
+                )
+        return "\n".join(lines) + "\n"
@@ -5,16 +5,20 @@ Sử dụng để check nhanh token in/out trong database
 """
 
 import requests
+import argparse
 from datetime import datetime, timedelta
 
-def quick_token_check():
-    """Xem nhanh tổng token usage"""
+from langfuse_hosts import add_host_arguments, hosts_from_args, query_hosts
+from proxy_dedup import is_content_trace
+
+def fetch_usage(host, session):
+    """Tổng token usage (30 ngày) của một Langfuse host; None nếu lỗi"""
     
     try:
         # Query traces từ 30 ngày qua
         since = datetime.now() - timedelta(days=30)
         
-        url = "http://localhost:3000/api/public/traces"
+        url = f"{host.host}/api/public/traces"
         params = {
             "limit": 1000,
             "from": since.isoformat(),
@@ -22,45 +26,101 @@ def quick_token_check():
             "orderDirection": "desc"
         }
         
-        print("🔍 Querying token usage...")
-        response = requests.get(url, params=params, timeout=5)
+        response = session.get(url, params=params, timeout=5)
+        if response.status_code != 200:
+            print(f"❌ {host.name}: Error {response.status_code}")
+            return None
+        
+        totals = {"prompt": 0, "cached": 0, "completion": 0, "requests": 0}
+        for trace in response.json().get('data', []):
+            if is_content_trace(trace):
+                continue
+            if trace.get('output') and isinstance(trace['output'], dict):
+                if 'usage' in trace['output']:
+                    usage = trace['output']['usage']
+                    totals["prompt"] += usage.get('prompt_tokens', 0)
+                    totals["cached"] += (usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0
+                    totals["completion"] += usage.get('completion_tokens', 0)
+                    totals["requests"] += 1
+        return totals
+    
+    except Exception as e:
+        print(f"❌ {host.name}: {e}")
+        print(f"💡 Make sure Langfuse is running on {host.host}")
+        return None
+
+def quick_token_check(hosts):
+    """Xem nhanh tổng token usage, gộp từ mọi Langfuse hosts (query song song)"""
+    
+    print(f"🔍 Querying token usage from {len(hosts)} Langfuse host(s)...")
+    results = query_hosts(hosts, fetch_usage)
+    
+    total_prompt = sum(totals["prompt"] for _, totals in results if totals)
+    total_cached = sum(totals["cached"] for _, totals in results if totals)
+    total_completion = sum(totals["completion"] for _, totals in results if totals)
+    total_requests = sum(totals["requests"] for _, totals in results if totals)
+    
+    print("\n📊 TOKEN USAGE SUMMARY (30 days)")
+    print("=" * 40)
+    print(f"📥 Total IN (prompt): {total_prompt:,}")
+    if total_prompt > 0:
+        print(f"♻️  Cached IN (prefix cache): {total_cached:,} ({total_cached / total_prompt:.1%})")
+    print(f"📤 Total OUT (completion): {total_completion:,}")
+    print(f"📊 Total tokens: {total_prompt + total_completion:,}")
+    print(f"🔢 Total requests: {total_requests:,}")
+    
+    if total_requests > 0:
+        avg_in = total_prompt / total_requests
+        avg_out = total_completion / total_requests
+        print(f"📈 Avg IN per request: {avg_in:.1f}")
+        print(f"📈 Avg OUT per request: {avg_out:.1f}")
+    
+    if len(hosts) > 1:
+        print("-" * 40)
+        for host, totals in results:
+            if totals is None:
+                print(f"🖥️  {host.name}: ❌ unavailable")
+            else:
+                print(f"🖥️  {host.name}: IN {totals['prompt']:,} (cached {totals['cached']:,}) / OUT {totals['completion']:,} / {totals['requests']:,} requests")
+    
+    print("=" * 40)
+
+def quick_proxy_check(proxy_url, window="day"):
+    """Xem nhanh token usage từ endpoint /usage của proxy (không query Langfuse)"""
+    
+    try:
+        print(f"🔍 Querying {proxy_url}/usage...")
+        response = requests.get(f"{proxy_url}/usage", params={"window": window}, timeout=5)
         
         if response.status_code == 200:
-            traces = response.json()
-            
-            total_prompt = 0
-            total_completion = 0
-            total_requests = 0
+            report = response.json()
+            span_hours = report['span_seconds'] / 3600
             
-            for trace in traces.get('data', []):
-                if trace.get('output') and isinstance(trace['output'], dict):
-                    if 'usage' in trace['output']:
-                        usage = trace['output']['usage']
-                        total_prompt += usage.get('prompt_tokens', 0)
-                        total_completion += usage.get('completion_tokens', 0)
-                        total_requests += 1
-            
-            print("\n📊 TOKEN USAGE SUMMARY (30 days)")
+            print(f"\n📊 TOKEN USAGE SUMMARY (proxy, last {span_hours:g}h by {window})")
             print("=" * 40)
-            print(f"📥 Total IN (prompt): {total_prompt:,}")
-            print(f"📤 Total OUT (completion): {total_completion:,}")
-            print(f"📊 Total tokens: {total_prompt + total_completion:,}")
-            print(f"🔢 Total requests: {total_requests:,}")
-            
-            if total_requests > 0:
-                avg_in = total_prompt / total_requests
-                avg_out = total_completion / total_requests
-                print(f"📈 Avg IN per request: {avg_in:.1f}")
-                print(f"📈 Avg OUT per request: {avg_out:.1f}")
-            
+            if not report['projects']:
+                print("📭 No requests in this window")
+            for project, total in report['projects'].items():
+                print(f"🏷️  {project}")
+                print(f"📥 Total IN (prompt): {total['prompt_tokens']:,}")
+                print(f"📤 Total OUT (completion): {total['completion_tokens']:,}")
+                print(f"📊 Total tokens: {total['total_tokens']:,}")
+                print(f"🔢 Total requests: {total['requests']:,}")
             print("=" * 40)
-            
         else:
             print(f"❌ Error: {response.status_code}")
             
     except Exception as e:
         print(f"❌ Error: {e}")
-        print("💡 Make sure Langfuse is running on http://localhost:3000")
 
 if __name__ == "__main__":
-    quick_token_check() 
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Quick Token Check')
+    parser.add_argument('--proxy', help='Proxy URL (vd: http://localhost:9000) để đọc /usage thay vì Langfuse')
+    parser.add_argument('--window', default='day', choices=['minute', 'hour', 'day'], help='Độ mịn của /usage')
+    add_host_arguments(parser)
+    args = parser.parse_args()
+    
+    if args.proxy:
+        quick_proxy_check(args.proxy.rstrip('/'), args.window)
+    else:
+        quick_token_check(hosts_from_args(args))
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Replay Traffic - Phát lại traffic thật để test capacity
+Đọc requests đã ghi (JSONL capture của proxy với REQUEST_CAPTURE_PATH, hoặc
+trace inputs trên Langfuse), gửi lại tới target theo đúng khoảng cách thời
+gian giữa các requests (hoặc nhanh hơn --speedup lần) và so sánh latency
+percentiles, throughput với lần chạy gốc.
+
+Requests được gửi open-loop: request tiếp theo không chờ request trước xong,
+nên target quá tải sẽ thấy latency tăng giống production.
+"""
+
+import os
+import json
+import time
+import uuid
+import asyncio
+import argparse
+from datetime import datetime, timedelta, timezone
+
+import httpx
+from tabulate import tabulate
+
+from langfuse_cli import LangfuseCLI, parse_timestamp, trace_usage
+from proxy_backends import percentile
+from proxy_dedup import is_content_trace
+
+MODEL_NAME = os.getenv("MODEL_NAME", "Qwen/Qwen2.5-7B-Instruct")
+
+PERCENTILES = (50, 90, 95, 99)
+REQUEST_FIELDS = ("model", "messages", "prompt", "input", "max_tokens", "temperature", "top_p")
+
+def replay_body(endpoint, body, model):
+    """Body gửi lại: bỏ các field chỉ proxy hiểu, non-streaming để đo usage chính xác"""
+    body = {key: value for key, value in body.items() if key not in ("trace_id", "stream", "stream_options")}
+    if endpoint in ("/v1/chat/completions", "/v1/completions") and model:
+        body["model"] = model
+    body.setdefault("model", MODEL_NAME)
+    return body
+
+def load_capture(path):
+    """Records từ JSONL capture của proxy, theo thứ tự thời gian"""
+    records = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if not isinstance(entry.get("body"), dict):
+                continue
+            records.append({
+                "timestamp": parse_timestamp(entry["timestamp"]),
+                "endpoint": entry.get("endpoint", "/v1/chat/completions"),
+                "body": entry["body"],
+                "latency": entry.get("latency"),
+                "usage": entry.get("usage") or {}
+            })
+    records.sort(key=lambda record: record["timestamp"])
+    return records
+
+def trace_endpoint(trace):
+    metadata = trace.get("metadata") or {}
+    if metadata.get("endpoint"):
+        return metadata["endpoint"]
+    trace_input = trace.get("input") or {}
+    if "messages" in trace_input:
+        return "/v1/chat/completions"
+    if "prompt" in trace_input:
+        return "/v1/completions"
+    if "input" in trace_input:
+        return "/v1/embeddings"
+    return None
+
+def load_langfuse(cli, since, until, project=None, limit=None, page_size=100):
+    """Records từ trace inputs trên Langfuse (message references được khôi phục)"""
+    records = []
+    page = 1
+    while True:
+        result = cli.get_traces_since(since, limit=page_size, page=page)
+        data = (result or {}).get("data") or []
+        for trace in data:
+            timestamp = parse_timestamp(trace.get("timestamp"))
+            if timestamp is None or timestamp > until or is_content_trace(trace):
+                continue
+            metadata = trace.get("metadata") or {}
+            if project and metadata.get("project") != project:
+                continue
+            endpoint = trace_endpoint(trace)
+            if endpoint is None:
+                continue
+            trace_input, missing = cli.reassemble_input(trace)
+            if missing:
+                continue
+            records.append({
+                "timestamp": timestamp,
+                "endpoint": endpoint,
+                "body": {key: trace_input[key] for key in REQUEST_FIELDS if key in trace_input},
+                "latency": trace.get("latency") or metadata.get("latency"),
+                "usage": dict(zip(("prompt_tokens", "completion_tokens"), trace_usage(trace)))
+            })
+            if limit and len(records) >= limit:
+                return records
+        total_pages = ((result or {}).get("meta") or {}).get("totalPages")
+        if not data or len(data) < page_size or (total_pages and page >= total_pages):
+            return records
+        page += 1
+
+async def send(client, semaphore, record, model):
+    body = replay_body(record["endpoint"], record["body"], model)
+    headers = {"X-Trace-Id": f"replay-{uuid.uuid4().hex[:8]}"}
+    # Time spent waiting for a slot counts: the original callers did not wait either
+    started = time.monotonic()
+    async with semaphore:
+        try:
+            response = await client.post(record["endpoint"], json=body, headers=headers)
+            latency = time.monotonic() - started
+            usage = (response.json().get("usage") or {}) if response.status_code == 200 else {}
+            return {"status_code": response.status_code, "latency": latency, "usage": usage, "error": None}
+        except (httpx.HTTPError, ValueError) as e:
+            return {"status_code": None, "latency": time.monotonic() - started, "usage": {}, "error": str(e)}
+
+async def replay(records, target, speedup, max_inflight, timeout, model):
+    """Gửi từng record tại offset gốc / speedup; returns (results, wall time)"""
+    limits = httpx.Limits(max_connections=max_inflight, max_keepalive_connections=max_inflight)
+    semaphore = asyncio.Semaphore(max_inflight)
+    origin = records[0]["timestamp"]
+    async with httpx.AsyncClient(base_url=target, timeout=timeout, limits=limits) as client:
+        started = time.monotonic()
+        tasks = []
+        for record in records:
+            offset = (record["timestamp"] - origin).total_seconds() / speedup
+            delay = started + offset - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(send(client, semaphore, record, model)))
+        results = await asyncio.gather(*tasks)
+        return results, time.monotonic() - started
+
+def summarize(latencies, usages, duration, errors=0):
+    latencies = [latency for latency in latencies if latency is not None]
+    prompt_tokens = sum(usage.get("prompt_tokens") or 0 for usage in usages)
+    completion_tokens = sum(usage.get("completion_tokens") or 0 for usage in usages)
+    summary = {
+        "requests": len(usages),
+        "errors": errors,
+        "duration": duration,
+        "req/s": len(usages) / duration if duration else None,
+        "prompt tok/s": prompt_tokens / duration if duration else None,
+        "completion tok/s": completion_tokens / duration if duration else None,
+        "prompt tokens p50": percentile([usage.get("prompt_tokens") or 0 for usage in usages], 50)
+    }
+    for pct in PERCENTILES:
+        summary[f"latency p{pct}"] = percentile(latencies, pct)
+    return summary
+
+def display_comparison(original, replayed):
+    def fmt(value):
+        if value is None:
+            return "-"
+        return f"{value:,.3f}" if isinstance(value, float) else f"{value:,}"
+
+    rows = []
+    for key in replayed:
+        before, after = original.get(key), replayed[key]
+        change = f"{(after - before) / before * 100:+.1f}%" if before and after is not None else "-"
+        rows.append([key, fmt(before), fmt(after), change])
+    print(tabulate(rows, headers=["Metric", "Original", "Replay", "Change"], tablefmt="grid"))
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay Traffic - Phát lại requests đã ghi để test capacity')
+    parser.add_argument('target', help='URL của target (proxy hoặc vLLM OpenAI server)')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--capture', help='JSONL capture của proxy (REQUEST_CAPTURE_PATH)')
+    source.add_argument('--langfuse', metavar='HOST', help='Lấy requests từ trace inputs trên Langfuse host')
+    parser.add_argument('--hours', type=float, default=1.0, help='Khoảng thời gian lấy từ Langfuse (giờ gần nhất)')
+    parser.add_argument('--project', help='Chỉ replay traces của project này (Langfuse)')
+    parser.add_argument('--limit', type=int, help='Số requests tối đa')
+    parser.add_argument('--speedup', type=float, default=1.0, help='Phát nhanh hơn N lần so với timing gốc')
+    parser.add_argument('--max-inflight', type=int, default=256, help='Số requests đồng thời tối đa')
+    parser.add_argument('--timeout', type=float, default=300.0, help='Timeout mỗi request (giây)')
+    parser.add_argument('--model', help='Ghi đè model trong request (ví dụ khi target phục vụ model khác tên)')
+    parser.add_argument('--output', help='Ghi kết quả từng request ra JSONL')
+
+    args = parser.parse_args()
+
+    if args.capture:
+        records = load_capture(args.capture)
+    else:
+        until = datetime.now(timezone.utc)
+        records = load_langfuse(
+            LangfuseCLI(args.langfuse.rstrip('/')),
+            until - timedelta(hours=args.hours),
+            until,
+            project=args.project,
+            limit=args.limit
+        )
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        print("❌ No requests to replay")
+        return
+
+    span = (records[-1]["timestamp"] - records[0]["timestamp"]).total_seconds()
+    print(f"🔁 Replaying {len(records):,} requests ({span:,.0f}s original, ~{span / args.speedup:,.0f}s at {args.speedup}x) to {args.target}")
+    results, duration = asyncio.run(replay(
+        records, args.target.rstrip('/'), args.speedup, args.max_inflight, args.timeout, args.model
+    ))
+
+    ok = [result for result in results if result["status_code"] == 200]
+    original = summarize(
+        [record["latency"] for record in records],
+        [record["usage"] for record in records],
+        span
+    )
+    replayed = summarize(
+        [result["latency"] for result in ok],
+        [result["usage"] for result in ok],
+        duration,
+        errors=len(results) - len(ok)
+    )
+    display_comparison(original, replayed)
+    if args.speedup != 1:
+        print(f"💡 Offered load is {args.speedup}x the original, so throughput should scale by up to {args.speedup}x")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            for record, result in zip(records, results):
+                f.write(json.dumps({
+                    "endpoint": record["endpoint"],
+                    "original_latency": record["latency"],
+                    "original_usage": record["usage"],
+                    **result
+                }, ensure_ascii=False) + "\n")
+        print(f"💾 Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -6,44 +6,82 @@ Sử dụng để xem nhanh tổng số token in/out trong database
 
 import requests
 import json
-from datetime import datetime, timedelta
+import os
+from datetime import datetime, timedelta, timezone
 import argparse
 
-def get_token_summary(host="http://localhost:3000", days=30):
-    """Lấy tổng token usage từ database"""
+from langfuse_hosts import add_host_arguments, hosts_from_args, query_hosts
+from proxy_dedup import is_content_trace
+
+# Traces per page of /api/public/traces
+PAGE_SIZE = 100
+
+def fetch_traces(host="http://localhost:3000", days=30, session=None, max_traces=100000):
+    """Lấy traces của X ngày gần nhất từ Langfuse, tối đa `max_traces` (session: pooled, có auth).
+
+    Returns {'data': [...], 'truncated': bool}; truncated khi còn traces sau giới hạn.
+    """
     
     try:
         # Tính thời gian từ X ngày trước
-        since = datetime.now() - timedelta(days=days)
+        since = datetime.now(timezone.utc) - timedelta(days=days)
         
         url = f"{host}/api/public/traces"
-        params = {
-            "limit": 1000,  # Lấy nhiều traces
-            "from": since.isoformat(),
-            "orderBy": "timestamp",
-            "orderDirection": "desc"
-        }
-        
-        print(f"🔍 Querying traces from {host} (last {days} days)...")
-        response = requests.get(url, params=params, timeout=10)
+        print(f"🔍 Querying traces from {host} (last {days} days, up to {max_traces:,})...")
+        data = []
+        fetched = 0
+        page = 1
+        while True:
+            params = {
+                "page": page,
+                # Fixed: Langfuse offsets pages by (page - 1) * limit
+                "limit": PAGE_SIZE,
+                "fromTimestamp": since.isoformat().replace("+00:00", "Z"),
+                "orderBy": "timestamp.desc"
+            }
+            response = (session or requests).get(url, params=params, timeout=30)
+            if response.status_code != 200:
+                print(f"❌ Error: {response.status_code}")
+                return None
+            result = response.json()
+            page_data = result.get('data') or []
+            total_pages = (result.get('meta') or {}).get('totalPages')
+            last_page = len(page_data) < PAGE_SIZE or (total_pages is not None and page >= total_pages)
+            if len(page_data) > max_traces - fetched:
+                page_data = page_data[:max_traces - fetched]
+                last_page = False
+            fetched += len(page_data)
+            # Dedup content traces hold a message, not a request
+            data.extend(trace for trace in page_data if not is_content_trace(trace))
+            if last_page or fetched >= max_traces:
+                break
+            page += 1
         
-        if response.status_code == 200:
-            traces = response.json()
-            return calculate_summary(traces, days)
-        else:
-            print(f"❌ Error: {response.status_code}")
-            return None
+        truncated = not last_page
+        if truncated:
+            print(f"⚠️  {host}: stopped at --max-traces {max_traces:,}; older traces are not included "
+                  f"(use --from-export for large ranges)")
+        return {'data': data, 'truncated': truncated}
             
     except Exception as e:
         print(f"❌ Connection error: {e}")
         return None
 
+def get_token_summary(host="http://localhost:3000", days=30):
+    """Lấy tổng token usage từ database"""
+    
+    traces = fetch_traces(host, days)
+    if traces is None:
+        return None
+    return calculate_summary(traces, days)
+
 def calculate_summary(traces, days):
     """Tính toán tổng token usage"""
     
     if not traces or not traces.get('data'):
         return {
             'total_prompt_tokens': 0,
+            'total_cached_prompt_tokens': 0,
             'total_completion_tokens': 0,
             'total_tokens': 0,
             'total_requests': 0,
@@ -52,6 +90,7 @@ def calculate_summary(traces, days):
         }
     
     total_prompt = 0
+    total_cached = 0
     total_completion = 0
     total_requests = 0
     projects = {}
@@ -62,8 +101,11 @@ def calculate_summary(traces, days):
                 usage = trace['output']['usage']
                 prompt_tokens = usage.get('prompt_tokens', 0)
                 completion_tokens = usage.get('completion_tokens', 0)
+                # Prompt tokens served from the vLLM prefix cache (OpenAI usage format)
+                cached_tokens = (usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0
                 
                 total_prompt += prompt_tokens
+                total_cached += cached_tokens
                 total_completion += completion_tokens
                 total_requests += 1
                 
@@ -72,15 +114,18 @@ def calculate_summary(traces, days):
                 if project not in projects:
                     projects[project] = {
                         'prompt_tokens': 0,
+                        'cached_prompt_tokens': 0,
                         'completion_tokens': 0,
                         'requests': 0
                     }
                 projects[project]['prompt_tokens'] += prompt_tokens
+                projects[project]['cached_prompt_tokens'] += cached_tokens
                 projects[project]['completion_tokens'] += completion_tokens
                 projects[project]['requests'] += 1
     
     return {
         'total_prompt_tokens': total_prompt,
+        'total_cached_prompt_tokens': total_cached,
         'total_completion_tokens': total_completion,
         'total_tokens': total_prompt + total_completion,
         'total_requests': total_requests,
@@ -88,6 +133,34 @@ def calculate_summary(traces, days):
         'days': days
     }
 
+def merge_summaries(results, days):
+    """Gộp summaries của nhiều Langfuse hosts, giữ breakdown theo host (None = host lỗi)"""
+    merged = calculate_summary(None, days)
+    merged['hosts'] = {}
+    for host, summary in results:
+        merged['hosts'][host.name] = summary
+        if summary is None:
+            continue
+        merged['total_prompt_tokens'] += summary['total_prompt_tokens']
+        merged['total_cached_prompt_tokens'] += summary['total_cached_prompt_tokens']
+        merged['total_completion_tokens'] += summary['total_completion_tokens']
+        merged['total_tokens'] += summary['total_tokens']
+        merged['total_requests'] += summary['total_requests']
+        for project, data in summary['projects'].items():
+            total = merged['projects'].setdefault(project, {
+                'prompt_tokens': 0,
+                'cached_prompt_tokens': 0,
+                'completion_tokens': 0,
+                'requests': 0
+            })
+            for key in total:
+                total[key] += data[key]
+    return merged
+
+def cache_hit_rate(cached_tokens, prompt_tokens):
+    """Tỷ lệ prompt tokens lấy từ prefix cache, dạng chuỗi phần trăm"""
+    return f"{cached_tokens / prompt_tokens:.1%}" if prompt_tokens else "n/a"
+
 def display_summary(summary):
     """Hiển thị tổng token usage"""
     
@@ -102,6 +175,8 @@ def display_summary(summary):
     print(f"📅 Thời gian: {summary['days']} ngày gần nhất")
     print(f"🔢 Tổng số requests: {summary['total_requests']:,}")
     print(f"📥 Tổng prompt tokens (IN): {summary['total_prompt_tokens']:,}")
+    print(f"♻️  Prompt tokens từ prefix cache: {summary['total_cached_prompt_tokens']:,} "
+          f"({cache_hit_rate(summary['total_cached_prompt_tokens'], summary['total_prompt_tokens'])})")
     print(f"📤 Tổng completion tokens (OUT): {summary['total_completion_tokens']:,}")
     print(f"📊 Tổng tokens: {summary['total_tokens']:,}")
     
@@ -123,21 +198,271 @@ def display_summary(summary):
             print(f"   {project}:")
             print(f"     Requests: {data['requests']:,}")
             print(f"     Prompt tokens (IN): {data['prompt_tokens']:,}")
+            print(f"     Cached prompt tokens: {data['cached_prompt_tokens']:,} "
+                  f"({cache_hit_rate(data['cached_prompt_tokens'], data['prompt_tokens'])})")
             print(f"     Completion tokens (OUT): {data['completion_tokens']:,}")
             print(f"     Total tokens: {total_project:,}")
             print()
     
+    # Hiển thị theo Langfuse host
+    if len(summary.get('hosts') or {}) > 1:
+        print("🖥️  Token Usage theo Langfuse host:")
+        for name, data in summary['hosts'].items():
+            if data is None:
+                print(f"   {name}: ❌ không lấy được dữ liệu")
+                continue
+            print(f"   {name}: {data['total_requests']:,} requests, "
+                  f"IN {data['total_prompt_tokens']:,} "
+                  f"(cached {cache_hit_rate(data['total_cached_prompt_tokens'], data['total_prompt_tokens'])}), OUT {data['total_completion_tokens']:,}, "
+                  f"total {data['total_tokens']:,}")
+        print()
+    
+    print("=" * 60)
+
+PERCENTILES = (50, 90, 95, 99)
+
+def load_usage_arrays(traces):
+    """Chuyển traces thành NumPy arrays (một phần tử mỗi request có usage)"""
+    import numpy as np
+    
+    timestamps, projects, prompt, completion, latency = [], [], [], [], []
+    for trace in (traces or {}).get('data', []):
+        output = trace.get('output')
+        if not isinstance(output, dict) or 'usage' not in output:
+            continue
+        usage = output['usage']
+        metadata = trace.get('metadata') or {}
+        try:
+            ts = datetime.fromisoformat(trace['timestamp'].replace('Z', '+00:00')).timestamp()
+        except (KeyError, AttributeError, ValueError):
+            continue
+        timestamps.append(ts)
+        projects.append(metadata.get('project', 'unknown'))
+        prompt.append(usage.get('prompt_tokens', 0) or 0)
+        completion.append(usage.get('completion_tokens', 0) or 0)
+        trace_latency = trace.get('latency', metadata.get('latency'))
+        latency.append(trace_latency if trace_latency is not None else np.nan)
+    
+    return {
+        'timestamp': np.asarray(timestamps, dtype=np.float64),
+        'project': np.asarray(projects, dtype=object),
+        'prompt_tokens': np.asarray(prompt, dtype=np.float64),
+        'completion_tokens': np.asarray(completion, dtype=np.float64),
+        'latency': np.asarray(latency, dtype=np.float64)
+    }
+
+def load_usage_arrays_from_export(path):
+    """Đọc usage arrays từ thư mục export Parquet/Arrow (export_traces.py)"""
+    import numpy as np
+    import pyarrow.dataset as ds
+    
+    file_format = 'ipc' if any(
+        name.endswith('.arrow') for _, _, files in os.walk(path) for name in files
+    ) else 'parquet'
+    table = ds.dataset(path, format=file_format).to_table(
+        columns=['timestamp', 'project', 'prompt_tokens', 'completion_tokens', 'latency']
+    )
+    timestamps = table.column('timestamp').cast('int64').to_numpy(zero_copy_only=False) / 1000.0
+    return {
+        'timestamp': timestamps.astype(np.float64),
+        'project': np.asarray(table.column('project').fill_null('unknown').to_numpy(zero_copy_only=False), dtype=object),
+        'prompt_tokens': table.column('prompt_tokens').to_numpy(zero_copy_only=False).astype(np.float64),
+        'completion_tokens': table.column('completion_tokens').to_numpy(zero_copy_only=False).astype(np.float64),
+        'latency': table.column('latency').to_numpy(zero_copy_only=False).astype(np.float64)
+    }
+
+def grouped_percentiles(codes, values, n_groups, percentiles=PERCENTILES):
+    """Percentiles của `values` theo từng group, không loop Python theo record.
+    
+    Sort một lần theo (group, value), rồi nội suy tuyến tính tại vị trí
+    percentile của từng group. Returns array shape (n_groups, len(percentiles)), NaN cho group rỗng.
+    """
+    import numpy as np
+    
+    valid = ~np.isnan(values)
+    codes, values = codes[valid], values[valid]
+    order = np.lexsort((values, codes))
+    sorted_values = values[order]
+    counts = np.bincount(codes, minlength=n_groups)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    
+    q = np.asarray(percentiles, dtype=np.float64)[None, :] / 100.0
+    positions = starts[:, None] + q * np.maximum(counts - 1, 0)[:, None]
+    lower = np.floor(positions).astype(np.int64)
+    upper = np.ceil(positions).astype(np.int64)
+    weight = positions - lower
+    
+    result = np.full((n_groups, len(percentiles)), np.nan)
+    has_data = counts > 0
+    if sorted_values.size:
+        lower = np.clip(lower, 0, sorted_values.size - 1)
+        upper = np.clip(upper, 0, sorted_values.size - 1)
+        interpolated = sorted_values[lower] * (1 - weight) + sorted_values[upper] * weight
+        result[has_data] = interpolated[has_data]
+    return result
+
+def compute_analytics(arrays):
+    """Percentiles, histograms và ước lượng concurrency, toàn bộ vectorized"""
+    import numpy as np
+    
+    n = arrays['timestamp'].size
+    if n == 0:
+        return None
+    
+    project_names, project_codes = np.unique(arrays['project'].astype(str), return_inverse=True)
+    hour_codes = ((arrays['timestamp'] // 3600) % 24).astype(np.int64)
+    
+    latency = arrays['latency']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tokens_per_s = np.where(latency > 0, arrays['completion_tokens'] / latency, np.nan)
+    
+    metrics = {
+        'prompt_tokens': arrays['prompt_tokens'],
+        'completion_tokens': arrays['completion_tokens'],
+        'latency': latency,
+        'tokens_per_s': tokens_per_s
+    }
+    
+    per_project = {
+        name: grouped_percentiles(project_codes, values, len(project_names))
+        for name, values in metrics.items()
+    }
+    per_hour = {
+        name: grouped_percentiles(hour_codes, values, 24)
+        for name, values in metrics.items()
+    }
+    
+    # Histograms with power-of-two bins, matching how max_tokens limits are usually chosen
+    histograms = {}
+    for name in ('prompt_tokens', 'completion_tokens'):
+        top = max(1.0, float(np.nanmax(metrics[name])))
+        edges = 2.0 ** np.arange(0, int(np.ceil(np.log2(top))) + 2)
+        edges = np.concatenate(([0.0], edges))
+        counts, edges = np.histogram(metrics[name], bins=edges)
+        histograms[name] = (counts, edges)
+    
+    # Little's law: average concurrency in a bucket = sum(latency in bucket) / bucket length
+    concurrency = {}
+    known_latency = ~np.isnan(latency)
+    for label, width in (('minute', 60), ('hour', 3600)):
+        buckets = (arrays['timestamp'][known_latency] // width).astype(np.int64)
+        if buckets.size == 0:
+            concurrency[label] = None
+            continue
+        buckets -= buckets.min()
+        busy = np.bincount(buckets, weights=latency[known_latency]) / width
+        requests = np.bincount(buckets)
+        peak = int(np.argmax(busy))
+        concurrency[label] = {
+            'peak_concurrency': float(busy[peak]),
+            'peak_requests': int(requests[peak]),
+            'p95_concurrency': float(np.percentile(busy[requests > 0], 95))
+        }
+    
+    return {
+        'records': n,
+        'projects': list(project_names),
+        'project_counts': np.bincount(project_codes, minlength=len(project_names)),
+        'hour_counts': np.bincount(hour_codes, minlength=24),
+        'per_project': per_project,
+        'per_hour': per_hour,
+        'histograms': histograms,
+        'concurrency': concurrency
+    }
+
+def format_percentiles(row, precision=0):
+    return " / ".join("-" if value != value else f"{value:,.{precision}f}" for value in row)
+
+def display_analytics(analytics):
+    """Hiển thị analytics (percentiles p50 / p90 / p95 / p99)"""
+    
+    if not analytics:
+        print("❌ Không có usage records để phân tích")
+        return
+    
+    labels = {
+        'prompt_tokens': ('📥 Prompt tokens', 0),
+        'completion_tokens': ('📤 Completion tokens', 0),
+        'latency': ('⏱️  Latency (s)', 2),
+        'tokens_per_s': ('⚡ Tokens/s', 1)
+    }
+    pct_header = " / ".join(f"p{p}" for p in PERCENTILES)
+    
+    print("\n" + "=" * 60)
+    print("📊 USAGE ANALYTICS")
+    print("=" * 60)
+    print(f"🔢 Records: {analytics['records']:,}")
+    
+    print(f"\n🏷️  Theo Project ({pct_header}):")
+    for index, project in enumerate(analytics['projects']):
+        print(f"   {project} ({analytics['project_counts'][index]:,} requests):")
+        for name, (label, precision) in labels.items():
+            print(f"     {label}: {format_percentiles(analytics['per_project'][name][index], precision)}")
+    
+    print(f"\n🕐 Theo giờ trong ngày (UTC, {pct_header}):")
+    for hour in range(24):
+        count = analytics['hour_counts'][hour]
+        if not count:
+            continue
+        prompt = format_percentiles(analytics['per_hour']['prompt_tokens'][hour])
+        completion = format_percentiles(analytics['per_hour']['completion_tokens'][hour])
+        latency = format_percentiles(analytics['per_hour']['latency'][hour], 2)
+        print(f"   {hour:02d}h  req={count:,}  IN {prompt}  OUT {completion}  latency {latency}")
+    
+    for name, (label, _) in labels.items():
+        if name not in analytics['histograms']:
+            continue
+        counts, edges = analytics['histograms'][name]
+        print(f"\n{label} histogram:")
+        peak = max(1, counts.max())
+        for count, low, high in zip(counts, edges[:-1], edges[1:]):
+            if count:
+                bar = "█" * max(1, int(40 * count / peak))
+                print(f"   {int(low):>7,}-{int(high):<7,} {count:>9,} {bar}")
+    
+    print("\n🔥 Ước lượng concurrency (Little's law):")
+    for label, stats in analytics['concurrency'].items():
+        if stats is None:
+            print(f"   {label}: không có latency data")
+            continue
+        print(f"   Peak {label}: {stats['peak_concurrency']:.1f} requests đồng thời "
+              f"({stats['peak_requests']:,} requests), p95 {label}: {stats['p95_concurrency']:.1f}")
+    
     print("=" * 60)
 
 def main():
     parser = argparse.ArgumentParser(description='Token Summary - Query tổng token usage')
-    parser.add_argument('--host', default='http://localhost:3000', help='Langfuse host')
+    add_host_arguments(parser)
     parser.add_argument('--days', type=int, default=30, help='Số ngày gần nhất để query')
+    parser.add_argument('--analytics', action='store_true',
+                        help='Percentiles, histograms và concurrency (cần numpy)')
+    parser.add_argument('--from-export', help='Đọc records từ thư mục export_traces.py thay vì Langfuse (cần pyarrow)')
+    parser.add_argument('--max-traces', type=int, default=100000,
+                        help='Số traces tối đa đọc từ mỗi Langfuse host (range lớn hơn: dùng --from-export)')
     
     args = parser.parse_args()
     
-    summary = get_token_summary(args.host, args.days)
-    display_summary(summary)
+    if args.from_export:
+        print(f"📂 Loading usage records from {args.from_export}...")
+        display_analytics(compute_analytics(load_usage_arrays_from_export(args.from_export)))
+        return
+    
+    # Query tất cả Langfuse hosts song song
+    hosts = hosts_from_args(args)
+    results = query_hosts(hosts, lambda host, session: fetch_traces(host.host, args.days, session, args.max_traces))
+    
+    if args.analytics:
+        merged = {'data': [trace for _, traces in results if traces for trace in traces.get('data') or []]}
+        print(f"📊 Analysing {len(merged['data']):,} traces from {len(hosts)} host(s)"
+              + (" (truncated at --max-traces)" if any(traces and traces['truncated'] for _, traces in results) else ""))
+        display_analytics(compute_analytics(load_usage_arrays(merged)))
+        return
+    
+    summaries = [(host, calculate_summary(traces, args.days) if traces is not None else None) for host, traces in results]
+    if len(hosts) == 1:
+        display_summary(summaries[0][1])
+    else:
+        display_summary(merge_summaries(summaries, args.days))
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file